@@ -0,0 +1,116 @@
+"""Portfolio analytics computed inside the database.
+
+Nothing here loads ORM objects. Portfolio totals and the per-project rollup
+read the denormalized ``project_summary`` table (see :mod:`summary`); only
+the per-stage breakdowns still aggregate the stage tables themselves.
+
+Definitions used throughout:
+
+* spend -- sum of every stage ``cost`` column
+* shipping -- ``Shipping.avg_cost`` x ``Launch.units_sold``
+* revenue -- ``Launch.cash_collected``
+* gross margin -- revenue - spend - ``Launch.commission_paid`` - shipping
+* stage duration -- days from a stage's ``start_date`` to its ``end_date``
+"""
+import math
+from sqlalchemy import and_, func, literal, select, union_all
+from database import db_session, engine
+from models import ProjectSummary, STAGES
+
+PERCENTILES = (0.5, 0.9, 0.95)
+
+COST_STAGES = [(name, model) for name, model in STAGES if 'cost' in model.__table__.c]
+DURATION_STAGES = [(name, model) for name, model in STAGES
+                   if 'start_date' in model.__table__.c and 'end_date' in model.__table__.c]
+
+
+def days_between(start, end):
+    if engine.dialect.name == 'sqlite':
+        return func.julianday(end) - func.julianday(start)
+    return end - start
+
+
+def money(value):
+    """An amount with NULL (nothing recorded) counted as zero."""
+    return func.coalesce(value, 0.0)
+
+
+def portfolio_totals():
+    """Portfolio-wide totals: one scan of ``project_summary`` plus per-stage spend subqueries."""
+    totals = select(
+        func.count().label('projects'),
+        money(func.sum(ProjectSummary.total_spend)).label('spend'),
+        func.coalesce(func.sum(ProjectSummary.units_sold), 0).label('units_sold'),
+        money(func.sum(ProjectSummary.revenue)).label('revenue'),
+        money(func.sum(ProjectSummary.commission)).label('commission'),
+        money(func.sum(ProjectSummary.shipping_cost)).label('shipping'),
+        money(func.sum(ProjectSummary.gross_margin)).label('gross_margin'),
+    )
+    row = db_session.execute(totals).one()._asdict()
+    by_stage = [select(money(func.sum(model.cost))).scalar_subquery().label(name) for name, model in COST_STAGES]
+    row['spend_by_stage'] = db_session.execute(select(*by_stage)).one()._asdict()
+    row['gross_margin_pct'] = row['gross_margin'] / row['revenue'] if row['revenue'] else None
+    return row
+
+
+def stage_duration_stats(percentiles=PERCENTILES):
+    """Count, mean and nearest-rank percentiles of each stage's duration in days.
+
+    Durations are whole days, so the database returns a histogram -- one row
+    per (stage, days) with its count -- and the percentiles are read off the
+    cumulative counts here. That keeps the result to a few hundred rows
+    instead of sorting and shipping every duration.
+    """
+    durations = []
+    for name, model in DURATION_STAGES:
+        durations.append(
+            select(literal(name).label('stage'),
+                   days_between(model.start_date, model.end_date).label('days'))
+            .where(and_(model.start_date.isnot(None), model.end_date.isnot(None)))
+        )
+    durations = union_all(*durations).subquery()
+    histogram = {}
+    rows = db_session.execute(
+        select(durations.c.stage, durations.c.days, func.count())
+        .group_by(durations.c.stage, durations.c.days)
+        .order_by(durations.c.stage, durations.c.days)
+    )
+    for stage, days, count in rows:
+        histogram.setdefault(stage, []).append((days, count))
+
+    stats = {name: None for name, _ in DURATION_STAGES}
+    for stage, buckets in histogram.items():
+        stats[stage] = histogram_stats(buckets, percentiles)
+    return stats
+
+
+def histogram_stats(buckets, percentiles=PERCENTILES):
+    """Count, mean and nearest-rank percentiles from ascending ``(value, count)`` buckets."""
+    total = sum(count for _, count in buckets)
+    values = {'count': total, 'mean': sum(days * count for days, count in buckets) / total}
+    for p in percentiles:
+        rank, seen = math.ceil(p * total), 0
+        for days, count in buckets:
+            seen += count
+            if seen >= rank:
+                values[_pct(p)] = days
+                break
+    return values
+
+
+def _pct(p):
+    return f'p{int(round(p * 100))}'
+
+
+def project_rollup_query():
+    """Per-project spend, revenue and margin, read straight from ``project_summary``."""
+    return db_session.query(
+        ProjectSummary.project_id,
+        ProjectSummary.project_name,
+        ProjectSummary.creator_name,
+        ProjectSummary.current_stage,
+        ProjectSummary.total_spend.label('spend'),
+        ProjectSummary.revenue,
+        ProjectSummary.shipping_cost.label('shipping'),
+        ProjectSummary.gross_margin,
+    )
@@ -1,90 +1,140 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, make_response
-from werkzeug.utils import secure_filename
-from database import init_db, db_session
-from models import CustomerService, Launch, Project, Communication, Design, Modeling, Prototype, ProductPictures, Contract, Production, Packaging, Freight, Shipping, File, Tooling
-from datetime import datetime
-import os
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, make_response, send_file
+from werkzeug.exceptions import HTTPException
+from database import init_db, db_session, engine
+from sqlalchemy import select
+from sqlalchemy.orm import configure_mappers
+from pagination import keyset_page, requested_limit
+from parsing import safe_int
+from queries import load_project_aggregate, delete_projects
+from models import Project, File, ProjectSummary
+from datetime import timedelta
 import logging
+import logconfig
+import tasks
+import threading
+import time
+from storage import ContentStore, remove_unreferenced
+from uploads import (STORED, allowed_file, spool_uploads, discard_spooled, queue_uploads, resume_pending_uploads,
+                     stored_hooks, expire_chunked_uploads)
+import thumbnails
+import downloads
+import metrics
+import analytics
+import search
+import stages
+import summary  # also keeps project_summary current on every commit
+import transitions  # records stage changes on every commit
+import feed  # logs every commit's project changes for /events
+import cache
+from cache import cached_page, project_key, ALL_PROJECTS
+import os
+from routes import projects as projects_api, attachments as attachments_api
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
+# Outside static/, so attachments are only reachable through the download routes (migration 17 moved them).
+app.config['UPLOAD_FOLDER'] = 'instance/uploads'
 app.config['ALLOWED_EXTENSIONS'] = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
+app.config['DASHBOARD_PAGE_SIZE'] = 50
+app.config['DASHBOARD_MAX_PAGE_SIZE'] = 200
+app.config['BULK_DELETE_MAX_IDS'] = 1000
+app.config['THUMBNAIL_FOLDER'] = 'instance/thumbnails'
+app.config['THUMBNAIL_CACHE_BYTES'] = 512 * 1024 * 1024
+app.config['PAGE_CACHE_SIZE'] = 256
+app.config['PAGE_CACHE_TTL'] = 300
+app.config['API_BATCH_MAX_OPERATIONS'] = 100
+# Days a client may wait on a reply before their project counts as overdue in the follow-up queue.
+app.config['FOLLOW_UP_SLA_DAYS'] = 2
+# Behind nginx, set to the prefix of an internal location aliased to UPLOAD_FOLDER
+# (e.g. '/_attachments/') to hand file bodies off with X-Accel-Redirect.
+app.config['ATTACHMENT_ACCEL_REDIRECT'] = None
+# A background upload claimed longer ago than this is assumed abandoned by a dead worker.
+app.config['UPLOAD_CLAIM_TIMEOUT'] = timedelta(hours=1)
+# Chunked uploads: largest file accepted, and how long an unfinished one is kept.
+app.config['CHUNKED_UPLOAD_MAX_BYTES'] = 4 * 1024 ** 3
+app.config['CHUNKED_UPLOAD_EXPIRY'] = timedelta(hours=24)
+app.config['CHUNKED_UPLOAD_EXPIRY_INTERVAL'] = timedelta(hours=1)
+# A chunk still being written after this long is assumed abandoned; its range can be sent again.
+app.config['CHUNK_CLAIM_TIMEOUT'] = timedelta(minutes=30)
+# Change feed: whether dashboards follow /events live, how long events are
+# kept for reconnecting clients (and how often older ones are trimmed), how
+# often a stream polls for other workers' commits, and how long one stream
+# lasts. Every open dashboard holds a worker for a whole stream and reconnects
+# when it ends, so only turn the live feed on under threaded or async workers
+# (gunicorn -k gthread/gevent); with sync workers a few open tabs take them all.
+app.config['CHANGE_FEED_LIVE'] = False
+app.config['CHANGE_FEED_RETENTION'] = timedelta(days=1)
+app.config['CHANGE_FEED_TRIM_INTERVAL'] = timedelta(hours=1)
+app.config['CHANGE_FEED_POLL_SECONDS'] = 2.0
+app.config['CHANGE_FEED_STREAM_SECONDS'] = 25
+app.config['SLOW_REQUEST_MS'] = 500
+# Bearer token /metrics scrapers must send; /metrics is off while unset.
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Per-logger levels ('' is the root); $LOG_LEVELS overrides, e.g. "INFO,uploads=DEBUG".
+app.config['LOG_LEVELS'] = {'': 'INFO', 'metrics.slow': 'WARNING'}
+app.config['LOG_DEBUG_SAMPLE_EVERY'] = 100
+app.config['LOG_REDACT_FIELDS'] = logconfig.DEFAULT_REDACT | {'creator_name', 'project_name', 'filename'}
 app.secret_key = 'your_secret_key_here'  # Set a secret key for flash messages
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
-
-def save_files(files, parent_id, parent_type):
-    saved_files = []
-    for file in files:
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            new_file = File(
-                filename=filename,
-                file_path=file_path,
-                upload_date=datetime.now(),
-                file_type=file.filename.rsplit('.', 1)[1].lower()
-            )
-            if parent_type == 'design':
-                new_file.design_id = parent_id
-            elif parent_type == 'modeling':
-                new_file.modeling_id = parent_id
-            elif parent_type == 'prototype':
-                new_file.prototype_id = parent_id
-            elif parent_type == 'product_pictures':
-                new_file.product_pictures_id = parent_id
-            elif parent_type == 'contract':
-                new_file.contract_id = parent_id
-            elif parent_type == 'tooling':
-                new_file.tooling_id = parent_id
-            elif parent_type == 'production':
-                new_file.production_id = parent_id
-            elif parent_type == 'packaging':
-                new_file.packaging_id = parent_id
-            elif parent_type == 'launch':
-                new_file.launch_id = parent_id
-            
-            saved_files.append(new_file)
-    return saved_files
-
-def get_project_or_404(project_id):
-    project = Project.query.get(project_id)
-    if project is None:
-        abort(404, description="Project not found")
-    return project
-
-def safe_date(date_string):
-    if date_string:
-        try:
-            return datetime.strptime(date_string, '%Y-%m-%d').date()
-        except ValueError:
-            return None
-    return None
-
-def safe_float(float_string):
-    if float_string:
-        try:
-            return float(float_string)
-        except ValueError:
-            return None
-    return None
-
-def safe_int(int_string):
-    if int_string:
-        try:
-            return int(int_string)
-        except ValueError:
-            return None
-    return None
-
-@app.before_first_request
-def initialize_database():
-    init_db()
+content_store = ContentStore(app.config['UPLOAD_FOLDER'])
+app.extensions['content_store'] = content_store
+thumbnail_cache = thumbnails.ThumbnailCache(app.config['THUMBNAIL_FOLDER'], app.config['THUMBNAIL_CACHE_BYTES'])
+stored_hooks.append(thumbnail_cache.pregenerate)
+cache.page_cache = cache.LRUCache(app.config['PAGE_CACHE_SIZE'], app.config['PAGE_CACHE_TTL'])
+# Render None as an empty string so edit forms post back blank, not "None".
+app.jinja_env.finalize = lambda value: '' if value is None else value
+app.jinja_env.globals.update(thumbnails_enabled=thumbnails.available(),
+                             thumbnail_types=thumbnails.IMAGE_TYPES)
+
+metrics.init_app(app, engine)
+
+app.register_blueprint(projects_api.bp)
+app.register_blueprint(attachments_api.bp)
+
+_startup_lock = threading.Lock()
+_started = {}
+
+def create_app(warm=True):
+    """Finish start-up: logging, the schema check and warming. Safe to call repeatedly.
+
+    Call it before forking workers (``gunicorn --preload 'app:create_app()'``)
+    so this runs once instead of in every worker: the schema check (a single
+    version lookup on a current schema), mapper configuration and template
+    compilation are then shared copy-on-write. The engine's connections are
+    closed afterwards so no worker inherits an open database handle.
+    """
+    with _startup_lock:
+        if not _started.get('app'):
+            logconfig.configure(app.config['LOG_LEVELS'], app.config['LOG_DEBUG_SAMPLE_EVERY'],
+                                app.config['LOG_REDACT_FIELDS'])
+            init_db()
+            if warm:
+                configure_mappers()
+                for name in app.jinja_env.list_templates():
+                    app.jinja_env.get_template(name)
+            engine.dispose()
+            _started['app'] = True
+    return app
+
+@app.before_request
+def start_worker():
+    # Once per process: each (forked) worker resumes uploads left pending and
+    # starts its housekeeping timers, and servers that never called create_app
+    # (flask run, the test client) get it here.
+    pid = os.getpid()
+    if _started.get('worker') == pid:
+        return
+    # Warming up front only pays when it is shared by forked workers.
+    create_app(warm=False)
+    with _startup_lock:
+        if _started.get('worker') != pid:
+            resume_pending_uploads(content_store, app.config['UPLOAD_CLAIM_TIMEOUT'])
+            tasks.every(app.config['CHUNKED_UPLOAD_EXPIRY_INTERVAL'].total_seconds(),
+                        expire_chunked_uploads, app.config['CHUNKED_UPLOAD_EXPIRY'])
+            tasks.every(app.config['CHANGE_FEED_TRIM_INTERVAL'].total_seconds(),
+                        feed.trim, app.config['CHANGE_FEED_RETENTION'])
+            _started['worker'] = pid
 
 @app.teardown_appcontext
 def shutdown_session(exception=None):
@@ -92,18 +142,183 @@ def shutdown_session(exception=None):
 
 @app.errorhandler(400)
 def bad_request_error(error):
-    logger.error(f"400 Error: {error}", exc_info=True)
+    logger.warning("400 Error: %s", error)
     return 'Bad Request', 400
 
 @app.errorhandler(Exception)
 def unhandled_exception(e):
-    logger.error(f"Unhandled Exception: {str(e)}", exc_info=True)
+    if isinstance(e, HTTPException):
+        return e
+    logger.error("Unhandled Exception: %s", e, exc_info=True)
     return 'Internal Server Error', 500
 
 @app.route('/')
+@cached_page(lambda: [ALL_PROJECTS])
 def dashboard():
-    projects = Project.query.all()
-    return render_template('dashboard.html', projects=projects)
+    stage = request.args.get('stage') or None
+    creator = request.args.get('creator', '').strip() or None
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    columns = summary.SORTS.get(sort.lstrip('-'))
+    if columns is None:
+        sort, descending, columns = 'id', False, summary.SORTS['id']
+    limit = requested_limit()
+
+    query = ProjectSummary.query
+    if stage in Project.current_stage.type.enums:
+        query = query.filter(ProjectSummary.current_stage == stage)
+    else:
+        stage = None
+    if creator:
+        query = query.filter(ProjectSummary.creator_name == creator)
+
+    page = keyset_page(query, columns, limit,
+                       after=request.args.get('after'),
+                       before=request.args.get('before'),
+                       descending=descending)
+    filters = {'stage': stage, 'creator': creator, 'sort': sort, 'limit': request.args.get('limit')}
+    filters = {k: v for k, v in filters.items() if v}
+    return render_template('dashboard.html',
+                           projects=page.items,
+                           page=page,
+                           filters=filters,
+                           stages=Project.current_stage.type.enums,
+                           live_updates=app.config['CHANGE_FEED_LIVE'],
+                           last_event_id=feed.latest_id(db_session) if app.config['CHANGE_FEED_LIVE'] else None)
+
+@app.route('/project/<int:project_id>/row')
+@cached_page(lambda project_id: [project_key(project_id)])
+def dashboard_row(project_id):
+    project = db_session.get(ProjectSummary, project_id)
+    if project is None:
+        abort(404)
+    return render_template('_project_row.html', project=project)
+
+@app.route('/events')
+def change_events():
+    if not app.config['CHANGE_FEED_LIVE']:
+        abort(404)
+    # EventSource resends the last id it saw when it reconnects; the first
+    # connection passes the id the page was rendered at.
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('last_event_id', type=int)
+    events = feed.stream(last_id, poll=app.config['CHANGE_FEED_POLL_SECONDS'],
+                         lifetime=app.config['CHANGE_FEED_STREAM_SECONDS'])
+    response = app.response_class(events, mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    # Tell nginx not to buffer the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/files/<int:file_id>/thumbnail/<size>')
+def file_thumbnail(file_id, size):
+    if size not in thumbnails.SIZES or not thumbnails.available():
+        abort(404)
+    file = File.query.get(file_id)
+    if file is None or file.status != STORED or not thumbnails.is_image(file.file_type):
+        abort(404)
+    if file.sha256 is None:
+        # Saved before content addressing and not yet hashed: nothing to key the variants on.
+        abort(404)
+    # Variants are derived from immutable content, so the hash is a strong validator.
+    etag = f'{file.sha256}-{size}'
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        path = thumbnail_cache.get(file.file_path, file.sha256, size, file.file_type)
+        response = send_file(os.path.abspath(path),
+                             mimetype=f'image/{thumbnails.output_format(file.file_type).lower()}')
+    response.set_etag(etag)
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/files/<int:file_id>/download')
+def file_download(file_id):
+    file = File.query.get(file_id)
+    if file is None or file.status != STORED:
+        abort(404)
+    try:
+        return downloads.send_attachment(file, content_store.root, as_attachment=not request.args.get('inline'))
+    except FileNotFoundError:
+        abort(404)
+
+@app.route('/project/<int:project_id>/attachments.zip')
+def project_attachments_zip(project_id):
+    project = load_project_aggregate(project_id)
+    if project is None:
+        abort(404)
+    # Everything the stream needs is read here; the generator never touches the session.
+    entries = downloads.archive_entries(
+        (stage.name, [file for file in getattr(project, stage.name).files if file.status == STORED])
+        for stage in stages.STAGES if getattr(project, stage.name) is not None
+    )
+    etag = downloads.archive_etag(entries)
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = app.response_class(downloads.stream_zip(entries), mimetype='application/zip')
+        response.headers.set('Content-Disposition', 'attachment', filename=f'project-{project_id}-attachments.zip')
+    response.set_etag(etag)
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    return response
+
+def analytics_report():
+    limit = requested_limit()
+    page = keyset_page(analytics.project_rollup_query(), (ProjectSummary.project_id,), limit,
+                       after=request.args.get('after'), before=request.args.get('before'))
+    return {
+        'portfolio': analytics.portfolio_totals(),
+        'stage_durations': analytics.stage_duration_stats(),
+        'funnel': transitions.funnel(),
+        'time_in_stage': transitions.time_in_stage(),
+        'projects': [row._asdict() for row in page.items],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+    }
+
+@app.route('/analytics')
+@cached_page(lambda: [ALL_PROJECTS])
+def analytics_page():
+    return render_template('analytics.html', report=analytics_report(),
+                           percentiles=[f'p{int(round(p * 100))}' for p in analytics.PERCENTILES])
+
+@app.route('/analytics.json')
+@cached_page(lambda: [ALL_PROJECTS])
+def analytics_json():
+    return jsonify(analytics_report())
+
+def search_results():
+    if not search.available():
+        abort(404)
+    terms = request.args.get('q', '').strip()
+    limit = requested_limit()
+    page = search.search(terms, limit, after=request.args.get('after'), before=request.args.get('before'))
+    return terms, page
+
+@app.route('/search')
+@cached_page(lambda: [ALL_PROJECTS])
+def search_page():
+    terms, page = search_results()
+    filters = {'q': terms, 'limit': request.args.get('limit')}
+    return render_template('search.html', terms=terms, page=page,
+                           filters={k: v for k, v in filters.items() if v})
+
+@app.route('/search.json')
+@cached_page(lambda: [ALL_PROJECTS])
+def search_json():
+    terms, page = search_results()
+    return jsonify({
+        'query': terms,
+        'ranked': page.ranked if page else None,
+        'results': [row._asdict() for row in page.items] if page else [],
+        'next_cursor': page.next_cursor if page else None,
+        'prev_cursor': page.prev_cursor if page else None,
+    })
 
 @app.route('/favicon.ico')
 def favicon():
@@ -112,500 +327,121 @@ def favicon():
 @app.route('/project/new', methods=['GET', 'POST'])
 def new_project():
     if request.method == 'POST':
-        print("Form Data:")
-        for key, value in request.form.items():
-            print(f"{key}: {value}")
-        
-        print("Files:")
-        for key, file in request.files.items():
-            print(f"{key}: {file.filename}")
-
+        spooled = {}
         try:
-            logger.debug("Processing new project form submission")
-
-            project = Project(
-                creator_name=request.form['creator_name'],
-                project_name=request.form['project_name'],
-                current_stage=request.form['current_stage'],
-                first_contact_date=safe_date(request.form['first_contact_date']),
-                first_response_date=safe_date(request.form['first_response_date']),
-                last_contact_date=safe_date(request.form['last_contact_date']),
-                last_response_date=safe_date(request.form['last_response_date']),
-                primary_communication_method=request.form['primary_communication_method'],
-            )
-            logger.debug("Project object created")
-
-            db_session.add(project)
-            db_session.flush()  # This assigns an id to the project
-            logger.debug("Project object added")
-
-            communication = Communication(
-                project_id=project.id,
-                num_phone_calls=safe_int(request.form['num_phone_calls']),
-                num_messages_client=safe_int(request.form['num_messages_client']),
-                num_messages_us=safe_int(request.form['num_messages_us']),
-                response_time_max_client=safe_int(request.form['response_time_max_client']),
-                response_time_avg_client=safe_int(request.form['response_time_avg_client']),
-                response_time_min_client=safe_int(request.form['response_time_min_client']),
-                response_time_max_us=safe_int(request.form['response_time_max_us']),
-                response_time_avg_us=safe_int(request.form['response_time_avg_us']),
-                response_time_min_us=safe_int(request.form['response_time_min_us'])
-            )
-            db_session.add(communication)
-            logger.debug("Communication object added")
-            communication.files = save_files(request.files.getlist('communication_files'), communication.id, 'communication')
-
-
-            design = Design(
-                project_id=project.id,
-                start_date=safe_date(request.form['design_start_date']),
-                end_date=safe_date(request.form['design_end_date']),
-                cost=safe_float(request.form['design_cost']),
-                artist=request.form['design_artist']
-            )
-            db_session.add(design)
-            logger.debug("Design object added")
-            design.files = save_files(request.files.getlist('design_files'), design.id, 'design')
-
-        
-            modeling = Modeling(
-                project_id=project.id,
-                start_date=safe_date(request.form['modeling_start_date']),
-                end_date=safe_date(request.form['modeling_end_date']),
-                cost=safe_float(request.form['modeling_cost']),
-                artist=request.form['modeling_artist']
-            )
-            db_session.add(modeling)
-            db_session.flush()
-            modeling.files = save_files(request.files.getlist('modeling_files'), modeling.id, 'modeling')
-            db_session.add_all(modeling.files)
-            logger.debug("Modeling object added")
-
-
-            prototype = Prototype(
-                project_id=project.id,
-                start_date=safe_date(request.form['prototype_start_date']),
-                end_date=safe_date(request.form['prototype_end_date']),
-                cost=safe_float(request.form['prototype_cost']),
-                num_exploded_pieces=safe_int(request.form['num_exploded_pieces']),
-                shipped_date=safe_date(request.form['prototype_shipped_date']),
-                dimensions_height=safe_float(request.form['prototype_dimensions_height']),
-                dimensions_length=safe_float(request.form['prototype_dimensions_length']),
-                dimensions_depth=safe_float(request.form['prototype_dimensions_depth']),
-                weight=safe_float(request.form['prototype_weight']),
-            )
-            db_session.add(prototype)
-            prototype.files = save_files(request.files.getlist('prototype_files'), prototype.id, 'prototype')
-            logger.debug("Prototype object added")
-
-
-
-            product_pictures = ProductPictures(
-                project_id=project.id,
-                start_date=safe_date(request.form['product_pictures_start_date']),
-                end_date=safe_date(request.form['product_pictures_end_date']),
-                cost=safe_float(request.form['product_pictures_cost'])
-            )
-            db_session.add(product_pictures)
-            product_pictures.files = save_files(request.files.getlist('product_pictures_files'), product_pictures.id, 'product_pictures')
-            logger.debug("Product Pictures object added")
-
-
-            contract = Contract(
-                project_id=project.id,
-                sent_date=safe_date(request.form['contract_sent_date']),
-                signed_date=safe_date(request.form['contract_signed_date']),
-            )
-            db_session.add(contract)
-            contract.files = save_files(request.files.getlist('contract_files'), contract.id, 'contract')
-            logger.debug("Contract object added")
-
-
-            tooling = Tooling(
-                project_id=project.id,
-                num_tools=safe_int(request.form['tooling_num_tools']),
-                cost=safe_float(request.form['tooling_cost']),
-                start_date=safe_date(request.form['tooling_start_date']),
-                end_date=safe_date(request.form['tooling_end_date']),
-            )
-            db_session.add(tooling)
+            spooled = spool_uploads(request.files, content_store, allowed_file, stages.FILES_KEYS)
+            logger.debug("Processing new project form submission",
+                         extra={'fields': {'form_fields': len(request.form),
+                                           'files': sum(len(files) for files in spooled.values())}})
+            project, files = stages.create_project(db_session, request.form, spooled)
             db_session.flush()
-            logger.debug("Tooling object added")
-            tooling.files = save_files(request.files.getlist('tooling_files'), tooling.id, 'tooling')
-        
-
-            production = Production(
-                project_id=project.id,
-                start_date=safe_date(request.form['production_start_date']),
-                end_date=safe_date(request.form['production_end_date']),
-                cost=safe_float(request.form['production_cost'])
-            )
-            db_session.add(production)
-            production.files = save_files(request.files.getlist('production_files'), production.id, 'production')
-            logger.debug("Production object added")
-
-
-            packaging = Packaging(
-                project_id=project.id,
-                start_date=safe_date(request.form['packaging_start_date']),
-                end_date=safe_date(request.form['packaging_end_date']),
-                cost=safe_float(request.form['packaging_cost']),
-                artist=request.form['packaging_artist']
-            )
-            db_session.add(packaging)
-            packaging.files = save_files(request.files.getlist('packaging_files'), packaging.id, 'packaging')
-            logger.debug("Packaging object added")
-
-
-            launch = Launch(
-                project_id=project.id,
-                start_date=safe_date(request.form['launch_start_date']),
-                end_date=safe_date(request.form['launch_end_date']),
-                units_sold=safe_int(request.form['units_sold']),
-                retail_price=safe_float(request.form['retail_price']),
-                cash_collected=safe_float(request.form['cash_collected']),
-                commission_paid=safe_float(request.form['commission_paid'])
-            )
-            db_session.add(launch)
-            launch.files = save_files(request.files.getlist('launch_files'), launch.id, 'launch')
-            logger.debug("Launch object added")
-
-
-            customer_service = CustomerService(
-                project_id=project.id,
-                num_breakages=safe_int(request.form['num_breakages']),
-                num_refunds=safe_int(request.form['num_refunds']),
-                num_customer_service_messages=safe_int(request.form['num_customer_service_messages'])
-            )
-            db_session.add(customer_service)
-            customer_service.files = save_files(request.files.getlist('customer_service_files'), customer_service.id, 'customer_service')
-            logger.debug("Customer Service object added")
-
-
-            freight = Freight(
-                project_id=project.id,
-                freight_type=request.form['freight_type'],
-                cost=safe_float(request.form['freight_cost']),
-                size=request.form['freight_size'],
-                weight=safe_float(request.form['freight_weight']),
-                start_date=safe_date(request.form['freight_start_date']),
-                end_date=safe_date(request.form['freight_end_date']),
-            )
-            db_session.add(freight)
-            freight.files = save_files(request.files.getlist('freight_files'), freight.id, 'freight')
-            logger.debug("Freight object added")
-
-
-            shipping = Shipping(
-                project_id=project.id,
-                start_date=safe_date(request.form['shipping_start_date']),
-                end_date=safe_date(request.form['shipping_end_date']),
-                avg_price=safe_float(request.form['shipping_avg_price']),
-                avg_cost=safe_float(request.form['shipping_avg_cost']),
-                domestic_price=safe_float(request.form['shipping_domestic_price']),
-                avg_international_price=safe_float(request.form['shipping_avg_international_price']),
-                avg_international_cost=safe_float(request.form['shipping_avg_international_cost'])
-            )
-            db_session.add(shipping)
-            shipping.files = save_files(request.files.getlist('shipping_files'), shipping.id, 'shipping')
-            logger.debug("Shipping object added")
-
+            file_ids = [file.id for file in files]
             db_session.commit()
+            queue_uploads(content_store, file_ids)
             flash('New project created successfully!', 'success')
             return redirect(url_for('dashboard'))
+        except stages.ValidationError as e:
+            db_session.rollback()
+            discard_spooled(spooled)
+            # The problems quote what was typed; only the field names go to the log.
+            logger.warning("Invalid new project form", extra={'fields': {'invalid_fields': e.fields}})
+            flash(f'Error creating new project: {str(e)}', 'error')
         except Exception as e:
             db_session.rollback()
-            logger.error(f"Error creating new project: {str(e)}")
+            discard_spooled(spooled)
+            logger.error("Error creating new project: %s", e, exc_info=True)
             flash(f'Error creating new project: {str(e)}', 'error')
     return render_template('project_form.html')
 
 @app.route('/project/<int:project_id>/edit', methods=['GET', 'POST'])
+@cached_page(lambda project_id: [project_key(project_id)])
 def edit_project(project_id):
-    project = get_project_or_404(project_id)
-
-    # Explicitly fetch all related objects
-    communication = Communication.query.filter_by(project_id=project_id).first()
-    design = Design.query.filter_by(project_id=project_id).first()
-    modeling = Modeling.query.filter_by(project_id=project_id).first()
-    prototype = Prototype.query.filter_by(project_id=project_id).first()
-    product_pictures = ProductPictures.query.filter_by(project_id=project_id).first()
-    contract = Contract.query.filter_by(project_id=project_id).first()
-    tooling = Tooling.query.filter_by(project_id=project_id).first()
-    production = Production.query.filter_by(project_id=project_id).first()
-    packaging = Packaging.query.filter_by(project_id=project_id).first()
-    launch = Launch.query.filter_by(project_id=project_id).first()
-    customer_service = CustomerService.query.filter_by(project_id=project_id).first()
-    freight = Freight.query.filter_by(project_id=project_id).first()
-    shipping = Shipping.query.filter_by(project_id=project_id).first()
+    project = load_project_aggregate(project_id)
+    if project is None:
+        abort(404, description="Project not found")
 
+    status = 200
     if request.method == 'POST':
-        # Update main project details
-        project.creator_name = request.form['creator_name']
-        project.project_name = request.form['project_name']
-        project.current_stage = request.form['current_stage']
-        project.current_stage = request.form['current_stage']
-        project.first_contact_date = safe_date(request.form['first_contact_date']),
-        project.first_response_date = safe_date(request.form['first_response_date']),
-        project.last_contact_date = safe_date(request.form['last_contact_date']),
-        project.last_response_date = safe_date(request.form['last_response_date']),
-        project.primary_communication_method = request.form['primary_communication_method']
-
-        # Update or create related entities
-        if project.communication:
-            communication = project.communication
-        else:
-            communication = Communication(project_id=project.id)
-            db_session.add(communication)
-        
-        communication.num_phone_calls =safe_int(request.form['num_phone_calls'])
-        communication.num_messages_client =safe_int(request.form['num_messages_client'])
-        communication.num_messages_us =safe_int(request.form['num_messages_us'])
-        communication.response_time_max_client =safe_int(request.form['response_time_max_client'])
-        communication.response_time_avg_client =safe_int(request.form['response_time_avg_client'])
-        communication.response_time_min_client =safe_int(request.form['response_time_min_client'])
-        communication.response_time_max_us =safe_int(request.form['response_time_max_us'])
-        communication.response_time_avg_us =safe_int(request.form['response_time_avg_us'])
-        communication.response_time_min_us =safe_int(request.form['response_time_min_us'])
-
-        if project.design:
-            design = project.design
-        else:
-            design = Design(project_id=project.id)
-            db_session.add(design)
-        
-        design.start_date = safe_date(request.form['design_start_date'])
-        design.end_date = safe_date(request.form['design_end_date'])
-        design.cost = safe_float(request.form['design_cost'])
-        design.artist = request.form['design_artist']
-
-        new_files = save_files(request.files.getlist('design_files'), design.id, 'design')
-        for file in new_files:
-            db_session.add(file)
-
-
-        if project.modeling:
-            modeling = project.modeling
-        else:
-            modeling = Modeling(project_id=project.id)
-            db_session.add(modeling)
-        
-        modeling.start_date = safe_date(request.form['modeling_start_date'])
-        modeling.end_date = safe_date(request.form['modeling_end_date'])
-        modeling.cost = safe_float(request.form['modeling_cost'])
-        modeling.artist = request.form['modeling_artist']
-        modeling.num_exploded_pieces = safe_int(request.form['num_exploded_pieces'])
-        
-        new_files = save_files(request.files.getlist('modeling_files'), modeling.id, 'modeling')
-        for file in new_files:
-            db_session.add(file)
-
-        if project.prototype:
-            prototype = project.prototype
-        else:
-            prototype = Prototype(project_id=project.id)
-            db_session.add(prototype)
-        
-        prototype.start_date = safe_date(request.form['prototype_start_date'])
-        prototype.end_date = safe_date(request.form['prototype_end_date'])
-        prototype.cost = safe_float(request.form['prototype_cost'])
-        prototype.shipped_date = safe_date(request.form['prototype_shipped_date'])
-        prototype.dimensions_height = safe_float(request.form['prototype_dimensions_height'])
-        prototype.dimensions_length = safe_float(request.form['prototype_dimensions_length'])
-        prototype.dimensions_depth = safe_float(request.form['prototype_dimensions_depth'])
-        prototype.weight = safe_float(request.form['prototype_weight'])
-        new_files = save_files(request.files.getlist('prototype_files'), prototype.id, 'prototype')
-        for file in new_files:
-            db_session.add(file)
-
-        if project.product_pictures:
-            product_pictures = project.product_pictures
-        else:
-            product_pictures = ProductPictures(project_id=project.id)
-            db_session.add(product_pictures)
-        
-        product_pictures.start_date = safe_date(request.form['product_pictures_start_date'])
-        product_pictures.end_date = safe_date(request.form['product_pictures_end_date'])
-        product_pictures.cost = safe_float(request.form['product_pictures_cost'])
-        new_files = save_files(request.files.getlist('product_pictures_files'), product_pictures.id, 'product_pictures')
-        for file in new_files:
-            db_session.add(file)
-
-        if project.contract:
-            contract = project.contract
-        else:
-            contract = Contract(project_id=project.id)
-            db_session.add(contract)
-        
-        contract.sent_date = safe_date(request.form['contract_sent_date'])
-        contract.signed_date = safe_date(request.form['contract_signed_date'])
-        new_files = save_files(request.files.getlist('contract_files'), contract.id, 'contract')
-        for file in new_files:
-            db_session.add(file)
-
-        if project.launch:
-            launch = project.launch
-        else:
-            launch = Launch(project_id=project.id)
-            db_session.add(launch)
-        
-        launch.start_date = safe_date(request.form['launch_start_date'])
-        launch.end_date = safe_date(request.form['launch_end_date'])
-        launch.units_sold = safe_int(request.form['units_sold'])
-        launch.retail_price = safe_float(request.form['retail_price'])
-        launch.cash_collected = safe_float(request.form['cash_collected'])
-        launch.commission_paid = safe_float(request.form['commission_paid'])
-        new_files = save_files(request.files.getlist('launch_files'), launch.id, 'launch')
-        for file in new_files:
-            db_session.add(file)
-
-        if project.tooling:
-            tooling = project.tooling
-        else:
-            tooling = Tooling(project_id=project.id)
-            db_session.add(tooling)
-        
-        tooling.num_tools = safe_int(request.form['num_tools'])
-        tooling.cost = safe_float(request.form['tooling_cost'])
-        tooling.start_date = safe_date(request.form['tooling_start_date'])
-        tooling.end_date = safe_date(request.form['tooling_end_date'])
-        new_files = save_files(request.files.getlist('tooling_files'), tooling.id, 'tooling')
-        for file in new_files:
-            db_session.add(file)
-
-        if project.production:
-            production = project.production
-        else:
-            production = Production(project_id=project.id)
-            db_session.add(production)
-        
-        production.start_date = safe_date(request.form['production_start_date'])
-        production.end_date = safe_date(request.form['production_end_date'])
-        production.cost = safe_float(request.form['production_cost'])
-        new_files = save_files(request.files.getlist('production_files'), production.id, 'production')
-        for file in new_files:
-            db_session.add(file)
-
-        if project.packaging:
-            packaging = project.packaging
-        else:
-            packaging = Packaging(project_id=project.id)
-            db_session.add(packaging)
-        
-        packaging.start_date = safe_date(request.form['packaging_start_date'])
-        packaging.end_date = safe_date(request.form['packaging_end_date'])
-        packaging.cost = safe_float(request.form['packaging_cost'])
-        new_files = save_files(request.files.getlist('packaging_files'), packaging.id, 'packaging')
-        for file in new_files:
-            db_session.add(file)
-
-        if project.customer_service:
-            customer_service = project.customer_service
-        else:
-            customer_service = CustomerService(project_id=project.id)
-            db_session.add(customer_service)
-        
-        customer_service.num_breakages = safe_int(request.form['num_breakages'])
-        customer_service.num_refunds = safe_int(request.form['num_refunds'])
-        customer_service.num_customer_service_messages = safe_int(request.form['num_customer_service_messages'])
-        new_files = save_files(request.files.getlist('customer_service_files'), customer_service.id, 'customer_service')
-        for file in new_files:
-            db_session.add(file)
-
-        if project.freight:
-            freight = project.freight
-        else:
-            freight = Freight(project_id=project.id)
-            db_session.add(freight)
-        
-        freight.freight_type = request.form['freight_type']
-        freight.cost = safe_float(request.form['freight_cost']) if request.form['freight_cost'] else None
-        freight.size = request.form['freight_size']
-        freight.weight = safe_float(request.form['freight_weight'])
-        freight.start_date = safe_date(request.form['freight_start_date'])
-        freight.end_date = safe_date(request.form['freight_end_date'])
-        new_files = save_files(request.files.getlist('freight_files'), freight.id, 'freight')
-        for file in new_files:
-            db_session.add(file)
-
-        if project.shipping:
-            shipping = project.shipping
-        else:
-            shipping = Shipping(project_id=project.id)
-            db_session.add(shipping)
-        
-        shipping.start_date = safe_date(request.form['shipping_start_date'])
-        shipping.end_date = safe_date(request.form['shipping_end_date'])
-        shipping.avg_price = safe_float(request.form['shipping_avg_price'])
-        shipping.avg_cost = safe_float(request.form['shipping_avg_cost'])
-        shipping.domestic_price = safe_float(request.form['shipping_domestic_price'])
-        shipping.avg_international_price = safe_float(request.form['shipping_avg_international_price'])
-        shipping.avg_international_cost = safe_float(request.form['shipping_avg_international_cost'])
-        new_files = save_files(request.files.getlist('shipping_files'), shipping.id, 'shipping')
-        for file in new_files:
-            db_session.add(file)
-        
-        db_session.commit()
-        return redirect(url_for('project_detail', project_id=project.id))
-    return render_template('project_form.html', 
-                           project=project,
-                           communication=communication,
-                           design=design,
-                           modeling=modeling,
-                           prototype=prototype,
-                           product_pictures=product_pictures,
-                           contract=contract,
-                           tooling=tooling,
-                           production=production,
-                           packaging=packaging,
-                           launch=launch,
-                           customer_service=customer_service,
-                           freight=freight,
-                           shipping=shipping)
+        spooled = {}
+        try:
+            spooled = spool_uploads(request.files, content_store, allowed_file, stages.FILES_KEYS)
+            changed, files = stages.update_project(db_session, project, request.form, spooled,
+                                                   safe_int(request.form.get('revision')))
+            db_session.flush()
+            file_ids = [file.id for file in files]
+            db_session.commit()
+            queue_uploads(content_store, file_ids)
+            flash('Project updated successfully!' if changed else 'No changes to save.', 'success')
+            return redirect(url_for('edit_project', project_id=project_id))
+        except stages.StaleEditError:
+            db_session.rollback()
+            discard_spooled(spooled)
+            flash('This project was changed by someone else while you were editing it. '
+                  'Your changes were not saved; review the current values and try again.', 'error')
+            status = 409
+            project = load_project_aggregate(project_id)
+        except stages.ValidationError as e:
+            db_session.rollback()
+            discard_spooled(spooled)
+            logger.warning("Invalid edit of project %s", project_id,
+                           extra={'fields': {'project_id': project_id, 'invalid_fields': e.fields}})
+            flash(f'Error updating project: {str(e)}', 'error')
+            project = load_project_aggregate(project_id)
+        except Exception as e:
+            db_session.rollback()
+            discard_spooled(spooled)
+            logger.error("Error updating project %s: %s", project_id, e, exc_info=True,
+                         extra={'fields': {'project_id': project_id}})
+            flash(f'Error updating project: {str(e)}', 'error')
+            project = load_project_aggregate(project_id)
+        if project is None:
+            # Deleted by someone else while this edit was being made.
+            abort(404, description="Project not found")
+    return render_template('project_form.html', project=project,
+                           **{stage.name: getattr(project, stage.name) for stage in stages.STAGES}), status
 
 @app.route('/project/<int:project_id>/delete', methods=['POST'])
 def delete_project(project_id):
     try:
-        project = get_project_or_404(project_id)
-        
-        # Manually delete associated files and records
-        associated_models = [
-            (Communication, 'communication_id'),
-            (Design, 'design_id'),
-            (Modeling, 'modeling_id'),
-            (Prototype, 'prototype_id'),
-            (ProductPictures, 'product_pictures_id'),
-            (Contract, 'contract_id'),
-            (Tooling, 'tooling_id'),
-            (Production, 'production_id'),
-            (Packaging, 'packaging_id'),
-            (Launch, 'launch_id'),
-            (CustomerService, 'customer_service_id'),
-            (Freight, 'freight_id'),
-            (Shipping, 'shipping_id')
-        ]
-
-        for model, id_column in associated_models:
-            associated_record = model.query.filter_by(project_id=project_id).first()
-            if associated_record:
-                # Delete associated files
-                associated_files = File.query.filter_by(**{id_column: associated_record.id}).all()
-                for file in associated_files:
-                    if os.path.exists(file.file_path):
-                        os.remove(file.file_path)
-                    db_session.delete(file)
-                
-                # Delete the associated record
-                db_session.delete(associated_record)
-
-        # Delete the project
-        db_session.delete(project)
+        deleted, paths = delete_projects([project_id])
+        if not deleted:
+            db_session.rollback()
+            return jsonify({"success": False, "message": "Project not found"}), 404
         db_session.commit()
-        
+        tasks.submit(remove_unreferenced, paths, time.time())
+
         return jsonify({"success": True, "message": "Project deleted successfully"}), 200
     except Exception as e:
         db_session.rollback()
-        logger.error(f"Error deleting project: {str(e)}")
+        logger.error("Error deleting project %s: %s", project_id, e, exc_info=True,
+                     extra={'fields': {'project_id': project_id}})
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/projects/delete', methods=['POST'])
+def bulk_delete_projects():
+    payload = request.get_json(silent=True) or {}
+    ids = payload.get('ids')
+    stage = payload.get('stage')
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return jsonify({"success": False, "message": "ids must be a list of integers"}), 400
+        if len(ids) > app.config['BULK_DELETE_MAX_IDS']:
+            return jsonify({"success": False, "message": f"At most {app.config['BULK_DELETE_MAX_IDS']} ids per request"}), 400
+        selection = ids
+    elif stage in Project.current_stage.type.enums:
+        selection = select(Project.id).where(Project.current_stage == stage)
+    else:
+        return jsonify({"success": False, "message": "Provide a list of ids or a valid stage"}), 400
+
+    try:
+        deleted, paths = delete_projects(selection)
+        db_session.commit()
+        tasks.submit(remove_unreferenced, paths, time.time())
+        return jsonify({"success": True, "deleted": deleted}), 200
+    except Exception as e:
+        db_session.rollback()
+        logger.error("Error bulk deleting projects: %s", e, exc_info=True)
         return jsonify({"success": False, "message": str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5001)
\ No newline at end of file
+    create_app().run(debug=True, port=5001)
\ No newline at end of file
@@ -0,0 +1,90 @@
+"""Cold-start cost of a worker: import time and time to first response.
+
+Each run is a fresh interpreter measuring
+
+* ``import_ms``: ``import app``;
+* ``startup_ms``: :func:`app.create_app` (logging, schema check, warming);
+* ``first_response_ms``: the first dashboard request right after start-up;
+* ``forked_first_response_ms``: the first request in a worker forked after
+  ``create_app`` -- what a preforking server (``gunicorn --preload``) pays
+  per worker;
+* ``lazy_first_response_ms``: the first request when ``create_app`` was
+  never called (``flask run``, the test client), so start-up happens inside
+  it.
+
+Medians over ``--runs`` go to stdout as JSON. Point ``--database`` at a copy
+of a real database (or one filled by ``generate_data.py``).
+
+    python benchmarks/bench_cold_start.py --database sqlite:////tmp/bench.db --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+RUN = r'''
+import json, os, sys, time
+sys.path.insert(0, {root!r})
+os.chdir({root!r})
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+result = {{'import_ms': (imported - started) * 1000}}
+
+def first_response():
+    started = time.perf_counter()
+    status = app.app.test_client().get('/').status_code
+    assert status == 200, status
+    return (time.perf_counter() - started) * 1000
+
+if {lazy!r}:
+    result['lazy_first_response_ms'] = first_response()
+else:
+    app.create_app()
+    result['startup_ms'] = (time.perf_counter() - imported) * 1000
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        os.write(write_end, json.dumps(first_response()).encode())
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as child:
+        result['forked_first_response_ms'] = json.loads(child.read())
+    os.waitpid(pid, 0)
+    result['first_response_ms'] = first_response()
+print(json.dumps(result))
+'''
+
+
+def measure(lazy, env):
+    output = subprocess.run([sys.executable, '-c', RUN.format(root=ROOT, lazy=lazy)], env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', help='SQLAlchemy URL (default: $DATABASE_URL or the app database)')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    env = dict(os.environ, LOG_LEVELS=os.environ.get('LOG_LEVELS', 'WARNING'))
+    if args.database:
+        env['DATABASE_URL'] = args.database
+
+    samples = {}
+    for _ in range(args.runs):
+        for lazy in (False, True):
+            for key, value in measure(lazy, env).items():
+                samples.setdefault(key, []).append(value)
+    report = {key: round(statistics.median(values), 1) for key, values in samples.items()}
+    report['runs'] = args.runs
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Lookup latency for stage rows and attachments as the tables grow.
+
+Builds throwaway SQLite databases of increasing size and times the two
+lookups the app does per stage -- ``<stage>.project_id = ?`` and
+``files.<stage>_id = ?`` -- with the model indexes in place and again after
+dropping them. Indexed latency should stay flat while the unindexed numbers
+grow with the row count.
+
+    python benchmarks/bench_fk_lookups.py --sizes 1000 10000 100000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import bindparam, create_engine, select  # noqa: E402
+from database import Base  # noqa: E402
+from models import Project, Design, File  # noqa: E402
+
+
+def populate(engine, size):
+    now = datetime.now()
+    with engine.begin() as conn:
+        conn.execute(Project.__table__.insert(), [
+            {'id': i, 'creator_name': 'creator', 'project_name': f'project {i}', 'current_stage': 'DESIGN'}
+            for i in range(1, size + 1)
+        ])
+        conn.execute(Design.__table__.insert(), [
+            {'id': i, 'project_id': i, 'cost': 1.0} for i in range(1, size + 1)
+        ])
+        conn.execute(File.__table__.insert(), [
+            {'filename': f'f{i}.pdf', 'file_path': f'instance/uploads/f{i}.pdf', 'upload_date': now, 'design_id': i}
+            for i in range(1, size + 1)
+        ])
+
+
+def time_lookups(engine, size, lookups):
+    ids = [random.randint(1, size) for _ in range(lookups)]
+    columns = {
+        'stage': Design.__table__.c.project_id,
+        'files': File.__table__.c.design_id,
+    }
+    results = {}
+    with engine.connect() as conn:
+        for label, column in columns.items():
+            query = select(column.table).where(column == bindparam('key'))
+            start = time.perf_counter()
+            for key in ids:
+                conn.execute(query, {'key': key}).fetchall()
+            results[label] = (time.perf_counter() - start) / lookups * 1e6
+    return results
+
+
+def drop_indexes(engine):
+    with engine.begin() as conn:
+        for table in (Design.__table__, File.__table__):
+            for index in table.indexes:
+                index.drop(bind=conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--lookups', type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'stage idx us':>13} {'files idx us':>13} {'stage scan us':>14} {'files scan us':>14}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+            Base.metadata.create_all(engine)
+            populate(engine, size)
+            indexed = time_lookups(engine, size, args.lookups)
+            drop_indexes(engine)
+            scanned = time_lookups(engine, size, max(1, args.lookups // 10))
+            engine.dispose()
+        print(f"{size:>8} {indexed['stage']:>13.1f} {indexed['files']:>13.1f} "
+              f"{scanned['stage']:>14.1f} {scanned['files']:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""CPU per create/edit of a project: stage registry versus the old handlers.
+
+``legacy_create``/``legacy_edit`` replay what ``new_project`` and
+``edit_project`` did before the stage registry: one hand-written block per
+stage, a flush after the project, modeling and tooling rows, and every
+attribute assigned on edit (with the edit path's crashing bugs corrected so
+it can run). ``registry_create``/``registry_edit`` are the current
+``stages.create_project``/``stages.update_project``. Both run against the
+same throwaway SQLite database without uploads, so the numbers compare
+parsing and persistence only; each edit changes two fields of a fully
+populated project. CPU time is measured with ``process_time``.
+
+    python benchmarks/bench_form_handlers.py --requests 2000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine  # noqa: E402
+from werkzeug.datastructures import MultiDict  # noqa: E402
+import database  # noqa: E402
+from database import Base  # noqa: E402
+from models import (Project, Communication, Design, Modeling, Prototype, ProductPictures, Contract,  # noqa: E402
+                    Tooling, Production, Packaging, Launch, CustomerService, Freight, Shipping)
+from parsing import safe_date, safe_float, safe_int  # noqa: E402
+from queries import load_project_aggregate  # noqa: E402
+import stages  # noqa: E402
+import summary  # noqa: E402,F401  the app refreshes project_summary on every commit
+
+
+def sample_form():
+    values = {}
+    for field in stages.PROJECT_FIELDS + tuple(f for stage in stages.STAGES for f in stage.fields):
+        if field.enums:
+            values[field.key] = field.enums[1]
+        elif field.parse is safe_date:
+            values[field.key] = '2024-03-15'
+        elif field.parse is safe_float:
+            values[field.key] = '12.5'
+        elif field.parse is safe_int:
+            values[field.key] = '7'
+        else:
+            values[field.key] = 'sample text'
+    return MultiDict(values)
+
+
+def legacy_create(session, form):
+    project = Project(
+        creator_name=form['creator_name'], project_name=form['project_name'], current_stage=form['current_stage'],
+        first_contact_date=safe_date(form['first_contact_date']), first_response_date=safe_date(form['first_response_date']),
+        last_contact_date=safe_date(form['last_contact_date']), last_response_date=safe_date(form['last_response_date']),
+        primary_communication_method=form['primary_communication_method'],
+    )
+    session.add(project)
+    session.flush()
+    session.add(Communication(
+        project_id=project.id, num_phone_calls=safe_int(form['num_phone_calls']),
+        num_messages_client=safe_int(form['num_messages_client']), num_messages_us=safe_int(form['num_messages_us']),
+        response_time_max_client=safe_int(form['response_time_max_client']),
+        response_time_avg_client=safe_int(form['response_time_avg_client']),
+        response_time_min_client=safe_int(form['response_time_min_client']),
+        response_time_max_us=safe_int(form['response_time_max_us']),
+        response_time_avg_us=safe_int(form['response_time_avg_us']),
+        response_time_min_us=safe_int(form['response_time_min_us'])))
+    session.add(Design(project_id=project.id, start_date=safe_date(form['design_start_date']),
+                       end_date=safe_date(form['design_end_date']), cost=safe_float(form['design_cost']),
+                       artist=form['design_artist']))
+    session.add(Modeling(project_id=project.id, start_date=safe_date(form['modeling_start_date']),
+                         end_date=safe_date(form['modeling_end_date']), cost=safe_float(form['modeling_cost']),
+                         artist=form['modeling_artist']))
+    session.flush()
+    session.add(Prototype(
+        project_id=project.id, start_date=safe_date(form['prototype_start_date']),
+        end_date=safe_date(form['prototype_end_date']), cost=safe_float(form['prototype_cost']),
+        num_exploded_pieces=safe_int(form['num_exploded_pieces']), shipped_date=safe_date(form['prototype_shipped_date']),
+        dimensions_height=safe_float(form['prototype_dimensions_height']),
+        dimensions_length=safe_float(form['prototype_dimensions_length']),
+        dimensions_depth=safe_float(form['prototype_dimensions_depth']), weight=safe_float(form['prototype_weight'])))
+    session.add(ProductPictures(project_id=project.id, start_date=safe_date(form['product_pictures_start_date']),
+                                end_date=safe_date(form['product_pictures_end_date']),
+                                cost=safe_float(form['product_pictures_cost'])))
+    session.add(Contract(project_id=project.id, sent_date=safe_date(form['contract_sent_date']),
+                         signed_date=safe_date(form['contract_signed_date'])))
+    session.add(Tooling(project_id=project.id, num_tools=safe_int(form['tooling_num_tools']),
+                        cost=safe_float(form['tooling_cost']), start_date=safe_date(form['tooling_start_date']),
+                        end_date=safe_date(form['tooling_end_date'])))
+    session.flush()
+    session.add(Production(project_id=project.id, start_date=safe_date(form['production_start_date']),
+                           end_date=safe_date(form['production_end_date']), cost=safe_float(form['production_cost'])))
+    session.add(Packaging(project_id=project.id, start_date=safe_date(form['packaging_start_date']),
+                          end_date=safe_date(form['packaging_end_date']), cost=safe_float(form['packaging_cost']),
+                          artist=form['packaging_artist']))
+    session.add(Launch(project_id=project.id, start_date=safe_date(form['launch_start_date']),
+                       end_date=safe_date(form['launch_end_date']), units_sold=safe_int(form['units_sold']),
+                       retail_price=safe_float(form['retail_price']), cash_collected=safe_float(form['cash_collected']),
+                       commission_paid=safe_float(form['commission_paid'])))
+    session.add(CustomerService(project_id=project.id, num_breakages=safe_int(form['num_breakages']),
+                                num_refunds=safe_int(form['num_refunds']),
+                                num_customer_service_messages=safe_int(form['num_customer_service_messages'])))
+    session.add(Freight(project_id=project.id, freight_type=form['freight_type'], cost=safe_float(form['freight_cost']),
+                        size=form['freight_size'], weight=safe_float(form['freight_weight']),
+                        start_date=safe_date(form['freight_start_date']), end_date=safe_date(form['freight_end_date'])))
+    session.add(Shipping(
+        project_id=project.id, start_date=safe_date(form['shipping_start_date']),
+        end_date=safe_date(form['shipping_end_date']), avg_price=safe_float(form['shipping_avg_price']),
+        avg_cost=safe_float(form['shipping_avg_cost']), domestic_price=safe_float(form['shipping_domestic_price']),
+        avg_international_price=safe_float(form['shipping_avg_international_price']),
+        avg_international_cost=safe_float(form['shipping_avg_international_cost'])))
+    session.commit()
+    return project.id
+
+
+def legacy_edit(session, project_id, form):
+    project = load_project_aggregate(project_id)
+    project.creator_name = form['creator_name']
+    project.project_name = form['project_name']
+    project.current_stage = form['current_stage']
+    project.first_contact_date = safe_date(form['first_contact_date'])
+    project.first_response_date = safe_date(form['first_response_date'])
+    project.last_contact_date = safe_date(form['last_contact_date'])
+    project.last_response_date = safe_date(form['last_response_date'])
+    project.primary_communication_method = form['primary_communication_method']
+    # The remaining stages followed the same pattern: one assignment per column.
+    for stage in stages.STAGES:
+        record = getattr(project, stage.name)
+        for field in stage.fields:
+            raw = form[field.key]
+            setattr(record, field.attr, field.parse(raw) if field.parse is not stages._text else raw)
+    session.commit()
+
+
+def registry_create(session, form):
+    project, _ = stages.create_project(session, form, {})
+    session.commit()
+    return project.id
+
+
+def registry_edit(session, project_id, form):
+    project = load_project_aggregate(project_id)
+    stages.update_project(session, project, form, {}, project.revision)
+    session.commit()
+
+
+def run(label, fn, count):
+    start = time.process_time()
+    results = [fn() for _ in range(count)]
+    elapsed = time.process_time() - start
+    print(f"{label:<16} {elapsed / count * 1e6:>10.0f} us CPU/request")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    form = sample_form()
+    edited = MultiDict(form)
+    edited['project_name'] = 'edited name'
+    edited['design_cost'] = '99.5'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(engine)
+        # queries.load_project_aggregate reads through the app's scoped session.
+        database.db_session.configure(bind=engine)
+        session = database.db_session
+
+        legacy_ids = run('legacy create', lambda: legacy_create(session, form), args.requests)
+        registry_ids = run('registry create', lambda: registry_create(session, form), args.requests)
+        ids = iter(legacy_ids)
+        run('legacy edit', lambda: legacy_edit(session, next(ids), edited), args.requests)
+        ids = iter(registry_ids)
+        run('registry edit', lambda: registry_edit(session, next(ids), edited), args.requests)
+        session.remove()
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
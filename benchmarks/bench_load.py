@@ -0,0 +1,279 @@
+"""Latency and throughput of the main routes under concurrent load.
+
+Runs each scenario -- ``dashboard``, ``new_project``, ``edit_get``,
+``edit_post`` and ``delete_project`` -- for ``--requests`` requests spread
+over ``--concurrency`` threads, either through Flask's test client
+(``--mode client``: app code only) or against a local threaded WSGI server
+(``--mode server``: includes HTTP parsing and sockets). Each edit and delete
+targets its own project, so runs never collide with themselves. With
+``--generate N`` N synthetic projects are added first (see
+``generate_data.py``) and only those are edited and deleted; without it the
+targets come from the existing data, so ``--database`` must name a
+benchmark database -- the app's own is never written to.
+
+Per scenario the report has p50/p95/p99/max latency, throughput, error
+count and the SQL statements per request (read from the ``Server-Timing``
+header); process RSS is sampled before and after. The report is written as
+JSON (default ``benchmarks/results/<commit>.json``) and ``--compare`` prints
+the change against an earlier report.
+
+    python benchmarks/bench_load.py --database sqlite:////tmp/bench.db --generate 5000
+    python benchmarks/bench_load.py --database sqlite:////tmp/bench.db --concurrency 8 --compare old.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ('dashboard', 'new_project', 'edit_get', 'edit_post', 'delete_project')
+EXPECTED_STATUS = {'dashboard': 200, 'new_project': 302, 'edit_get': 200, 'edit_post': 302, 'delete_project': 200}
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def rss_mb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an ascending list."""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def sample_form(rnd):
+    """A complete, valid project form as the edit page would post it."""
+    from parsing import safe_date, safe_float, safe_int
+    import stages
+    form = {}
+    for field in stages.PROJECT_FIELDS + tuple(f for stage in stages.STAGES for f in stage.fields):
+        if field.enums:
+            form[field.key] = rnd.choice(field.enums)
+        elif field.parse is safe_date:
+            form[field.key] = f'2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}'
+        elif field.parse is safe_float:
+            form[field.key] = f'{rnd.uniform(10, 5000):.2f}'
+        elif field.parse is safe_int:
+            form[field.key] = str(rnd.randint(0, 500))
+        else:
+            form[field.key] = f'load test {rnd.randint(0, 10 ** 6)}'[:field.length or None]
+    return form
+
+
+class TestClientTransport:
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, form=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, data=form)
+        response.close()
+        return response.status_code, response.headers.get('Server-Timing', '')
+
+    def close(self):
+        pass
+
+
+class ServerTransport:
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def request(self, method, path, form=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.port, timeout=60)
+        try:
+            body = urlencode(form) if form is not None else None
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body is not None else {}
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status, response.getheader('Server-Timing', '')
+        finally:
+            connection.close()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def plan(scenario, count, rnd, edit_ids, delete_ids, revisions):
+    """``count`` ``(method, path, form)`` requests for ``scenario``."""
+    import summary
+    if scenario == 'dashboard':
+        sorts = [prefix + name for name in summary.SORTS for prefix in ('', '-')]
+        return [('GET', '/?' + urlencode({'sort': rnd.choice(sorts)}), None) for _ in range(count)]
+    if scenario == 'new_project':
+        return [('POST', '/project/new', sample_form(rnd)) for _ in range(count)]
+    if scenario == 'edit_get':
+        return [('GET', f'/project/{rnd.choice(edit_ids)}/edit', None) for _ in range(count)]
+    if scenario == 'edit_post':
+        targets = [edit_ids.pop() for _ in range(min(count, len(edit_ids)))]
+        return [('POST', f'/project/{project_id}/edit', dict(sample_form(rnd), revision=revisions[project_id]))
+                for project_id in targets]
+    if scenario == 'delete_project':
+        targets = [delete_ids.pop() for _ in range(min(count, len(delete_ids)))]
+        return [('POST', f'/project/{project_id}/delete', None) for project_id in targets]
+    raise ValueError(scenario)
+
+
+def run_scenario(transport, scenario, requests, concurrency):
+    def timed(request):
+        started = time.perf_counter()
+        status, timing = transport.request(*request)
+        elapsed = time.perf_counter() - started
+        match = QUERIES.search(timing)
+        return elapsed, status, int(match.group(1)) if match else None
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed, requests))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed * 1000 for elapsed, _, _ in results)
+    queries = [count for _, _, count in results if count is not None]
+    errors = sum(1 for _, status, _ in results if status != EXPECTED_STATUS[scenario])
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'throughput_rps': round(len(results) / wall, 1) if wall else None,
+        'p50_ms': round(percentile(latencies, 0.50), 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95), 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99), 2) if latencies else None,
+        'max_ms': round(latencies[-1], 2) if latencies else None,
+        'queries_mean': round(sum(queries) / len(queries), 1) if queries else None,
+        'queries_max': max(queries) if queries else None,
+    }
+
+
+def compare(report, baseline):
+    print(f"{'scenario':<16} {'p95 ms':>18} {'throughput/s':>20} {'queries':>14}")
+    for name, current in report['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+
+        def cell(key):
+            old, new = before.get(key), current.get(key)
+            if old is None or new is None:
+                return '-'
+            change = f' ({(new - old) / old * 100:+.0f}%)' if old else ''
+            return f'{old:g} -> {new:g}{change}'
+        print(f"{name:<16} {cell('p95_ms'):>18} {cell('throughput_rps'):>20} {cell('queries_mean'):>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', help='SQLAlchemy URL (default: $DATABASE_URL or the app database)')
+    parser.add_argument('--generate', type=int, default=0, metavar='N', help='add N synthetic projects first')
+    parser.add_argument('--files', type=int, default=2, help='attachments per generated project')
+    parser.add_argument('--mode', choices=('client', 'server'), default='client')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed requests per read scenario')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--no-page-cache', action='store_true', help='render every page instead of serving cached copies')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='report path (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', metavar='REPORT', help='earlier report to compare against')
+    args = parser.parse_args()
+    if not args.database and not args.generate:
+        parser.error("pass --database to load test a benchmark database, or --generate to edit and delete "
+                     "only projects generated for the run")
+    if args.database:
+        os.environ['DATABASE_URL'] = args.database
+    os.environ.setdefault('LOG_LEVELS', 'WARNING,werkzeug=WARNING')
+
+    rss_before = rss_mb()
+    generated = None
+    if args.generate:
+        from generate_data import generate
+        generated = generate(args.generate, args.files, args.seed)
+
+    import app as application
+    import cache
+    from database import db_session, init_db
+    from models import Project
+    init_db()
+    application.app.config['SLOW_REQUEST_MS'] = None
+    if args.no_page_cache:
+        cache.page_cache = cache.LRUCache(maxsize=0)
+
+    rnd = random.Random(args.seed)
+    if generated is None:
+        ids = [project_id for (project_id,) in db_session.query(Project.id).order_by(Project.id)]
+    else:
+        ids = list(generated)
+    revisions = dict(db_session.query(Project.id, Project.revision))
+    db_session.remove()
+    needed = sum(args.requests for name in ('edit_post', 'delete_project') if name in args.scenarios)
+    if len(ids) < max(needed, 1):
+        parser.error(f"only {len(ids)} projects to edit and delete; use --generate to add at least {needed}")
+    rnd.shuffle(ids)
+    delete_ids = ids[:args.requests] if 'delete_project' in args.scenarios else []
+    edit_ids = ids[len(delete_ids):]
+
+    transport = (ServerTransport if args.mode == 'server' else TestClientTransport)(application.app)
+    scenarios = {}
+    try:
+        for scenario in args.scenarios:
+            if scenario in ('dashboard', 'edit_get') and args.warmup:
+                run_scenario(transport, scenario, plan(scenario, args.warmup, rnd, list(edit_ids), [], {}),
+                             args.concurrency)
+            requests = plan(scenario, args.requests, rnd, edit_ids, delete_ids, revisions)
+            scenarios[scenario] = run_scenario(transport, scenario, requests, args.concurrency)
+            print(f"{scenario:<16} {json.dumps(scenarios[scenario])}", file=sys.stderr)
+    finally:
+        transport.close()
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'config': {key: getattr(args, key) for key in ('mode', 'concurrency', 'requests', 'warmup', 'no_page_cache', 'seed')},
+        'projects': len(ids),
+        'scenarios': scenarios,
+        'rss_mb': {'before': round(rss_before, 1), 'after': round(rss_mb(), 1), 'peak': round(peak_rss_mb(), 1)},
+    }
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as out:
+        json.dump(report, out, indent=2)
+    print(f"Wrote {output}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(report, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
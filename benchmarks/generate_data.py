@@ -0,0 +1,151 @@
+"""Fill a database with synthetic projects for benchmarking.
+
+Every project gets a row in all 13 stages with every column populated and
+``--files`` attachments per project spread over the stages. Projects go in
+through :func:`bulk.import_records`, so ``project_summary``, the search index
+and the cache counters are maintained exactly as for real imports;
+attachments are small distinct blobs written to the content store with
+``stored`` rows pointing at them. Output is deterministic for a given
+``--seed``. The target is ``$DATABASE_URL`` (by default the app's own
+``instance/project_tracker.db``) unless ``--database`` says otherwise. The
+blobs go to ``--upload-folder``, by default a directory next to a SQLite
+target (``<database>-uploads``) or else a new temporary one -- never the
+app's live upload folder.
+
+    python benchmarks/generate_data.py --projects 10000 --files 3
+    python benchmarks/generate_data.py --projects 1000 --database sqlite:////tmp/bench.db
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+SYLLABLES = ('ka', 'ro', 'mi', 'zu', 'te', 'la', 'bo', 'shi', 'ne', 'gar', 'dor', 'vel', 'tan', 'pri', 'mos')
+FILE_TYPES = ('pdf', 'png', 'jpg', 'txt')
+# Attachments reuse this many distinct blobs; the store deduplicates by content.
+DISTINCT_BLOBS = 64
+BLOB_SIZE = 16 * 1024
+
+
+def word(rnd):
+    return ''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 3)))
+
+
+def sample_value(rnd, field):
+    """A valid import value (as text) for a ``bulk`` field."""
+    from parsing import safe_date, safe_float, safe_int
+    from stages import parser_for
+    parse = parser_for(field.column)
+    if field.enums:
+        return rnd.choice(field.enums)
+    if parse is safe_float:
+        return f'{rnd.uniform(10, 5000):.2f}'
+    if parse is safe_int:
+        return str(rnd.randint(0, 500))
+    if parse is safe_date:
+        return (date(2022, 1, 1) + timedelta(days=rnd.randint(0, 900))).isoformat()
+    text = ' '.join(word(rnd) for _ in range(rnd.randint(1, 3)))
+    return text[:field.length] if field.length else text
+
+
+def records(count, seed):
+    import bulk
+    rnd = random.Random(seed)
+    fields = bulk.PROJECT_FIELDS + [field for _, _, stage_fields in bulk.STAGE_FIELDS for field in stage_fields]
+    for line in range(1, count + 1):
+        yield line, {field.key: sample_value(rnd, field) for field in fields}
+
+
+def attach_files(engine, store, project_ids, per_project, seed):
+    """Add ``per_project`` stored attachments to each project; returns the number added."""
+    from sqlalchemy import select
+    from models import File, STAGES
+    import changes
+    rnd = random.Random(seed)
+    blobs = [store.save(io.BytesIO(rnd.randbytes(BLOB_SIZE))) for _ in range(DISTINCT_BLOBS)]
+    stage_ids = {}
+    with engine.connect() as conn:
+        for name, model in STAGES:
+            table = model.__table__
+            stage_ids[name] = dict(conn.execute(
+                select(table.c.project_id, table.c.id).where(table.c.project_id.in_(project_ids))
+            ).all())
+    names = [name for name, _ in STAGES]
+    now = datetime.utcnow().replace(microsecond=0)
+    rows = []
+    for project_id in project_ids:
+        for index in range(per_project):
+            stage = rnd.choice(names)
+            blob = rnd.choice(blobs)
+            file_type = rnd.choice(FILE_TYPES)
+            row = {f'{name}_id': None for name in names}
+            row.update(filename=f'{word(rnd)}_{index}.{file_type}', file_path=blob.path, upload_date=now,
+                       file_type=file_type, sha256=blob.sha256, size=blob.size, status='stored')
+            row[f'{stage}_id'] = stage_ids[stage][project_id]
+            rows.append(row)
+    for start in range(0, len(project_ids), 1000):
+        chunk = project_ids[start:start + 1000]
+        chunk_rows = rows[start * per_project:(start + len(chunk)) * per_project]
+        with engine.begin() as conn:
+            if chunk_rows:
+                conn.execute(File.__table__.insert(), chunk_rows)
+            changes.notify_before_commit(conn, chunk)
+        changes.notify_after_commit(engine, chunk)
+    return len(rows)
+
+
+def default_upload_folder(engine):
+    database = engine.url.database
+    if engine.url.get_backend_name() == 'sqlite' and database not in (None, '', ':memory:'):
+        return os.path.splitext(os.path.abspath(database))[0] + '-uploads'
+    return tempfile.mkdtemp(prefix='bench-uploads-')
+
+
+def generate(projects, files_per_project, seed=0, upload_folder=None):
+    """Add ``projects`` projects to the configured database; returns their ids."""
+    from sqlalchemy import func, select
+    from database import engine, init_db
+    from models import Project
+    from storage import ContentStore
+    import bulk
+    init_db()
+    with engine.connect() as conn:
+        before = conn.execute(select(func.coalesce(func.max(Project.id), 0))).scalar()
+    imported, rejected = bulk.import_records(records(projects, seed))
+    if rejected:
+        raise RuntimeError(f"{rejected} generated records were rejected")
+    with engine.connect() as conn:
+        project_ids = conn.execute(select(Project.id).where(Project.id > before).order_by(Project.id)).scalars().all()
+    if files_per_project:
+        store = ContentStore(upload_folder or default_upload_folder(engine))
+        attach_files(engine, store, project_ids, files_per_project, seed)
+    return project_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--projects', type=int, default=1000)
+    parser.add_argument('--files', type=int, default=2, help='attachments per project')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', help='SQLAlchemy URL (default: $DATABASE_URL or the app database)')
+    parser.add_argument('--upload-folder', help='content store root (default: <database>-uploads or a temp dir)')
+    args = parser.parse_args()
+    if args.database:
+        os.environ['DATABASE_URL'] = args.database
+
+    started = time.perf_counter()
+    project_ids = generate(args.projects, args.files, args.seed, args.upload_folder)
+    elapsed = time.perf_counter() - started
+    print(f"Added {len(project_ids)} projects with {len(project_ids) * args.files} attachments "
+          f"in {elapsed:.1f}s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
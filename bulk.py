@@ -0,0 +1,451 @@
+"""Bulk import and export of projects as CSV or JSON Lines.
+
+One record per project. Project columns keep their own names; stage columns
+are prefixed with the stage name (``design_cost``, ``tooling_num_tools``,
+``shipping_avg_cost``, ...), so the layout follows the models rather than
+the HTML form (see :mod:`stages` for that). ``id`` is written on export and ignored on import, where new
+ids are assigned. Values go through the same ``safe_*`` parsers as the form,
+but a non-blank value that does not parse rejects the row instead of being
+stored as empty. Attachments are not part of the format.
+
+Imports stream the input and write valid rows in batches: each batch is one
+transaction holding a handful of multi-row INSERTs (the project rows and one
+per stage table) with ids allocated up front, followed by the same
+bookkeeping a web commit does (summary rows, cache counters). Exports page
+through the projects by id, so neither direction holds the whole table.
+
+    python bulk.py import legacy.csv
+    python bulk.py import legacy.jsonl --dry-run
+    python bulk.py export projects.jsonl
+    python bulk.py export - --format csv > projects.csv
+"""
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+from collections import namedtuple
+from datetime import date
+from itertools import repeat
+from sqlalchemy import Enum, String, func, select
+from sqlalchemy.exc import IntegrityError
+from database import engine
+from models import Project, STAGES
+from parsing import safe_date, safe_float, safe_int
+from queries import executemany
+from stages import parser_for
+import changes
+import summary  # noqa: F401  registers the summary listener notified below
+import cache  # noqa: F401  registers the cache counter listener
+import transitions  # noqa: F401  registers the stage history listener
+import feed  # noqa: F401  registers the change feed listener
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 5000
+EXPORT_BATCH = 2000
+# Another writer may claim the ids a batch allocated; the batch is retried.
+ID_CONFLICT_RETRIES = 3
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+
+Field = namedtuple('Field', 'key column parse parse_column enums length')
+
+
+def _slow_column(parse):
+    def parse_column(raws):
+        return [parse(raw) if raw else None for raw in raws]
+    return parse_column
+
+
+def _builtin_column(convert, parse):
+    # safe_float/safe_int are exactly float()/int() on non-blank text, so a
+    # column with no blanks or bad values converts with one C-level map.
+    slow = _slow_column(parse)
+
+    def parse_column(raws):
+        try:
+            return list(map(convert, raws))
+        except (TypeError, ValueError):
+            return slow(raws)
+    return parse_column
+
+
+def _date_parsers(column):
+    """Row and column parsers returning dates in the driver's storage form.
+
+    Converting here leaves the insert path no per-value bind processing; on
+    SQLite the storage form is ISO text, so canonical input passes through.
+    """
+    dialect = engine.dialect
+    process = column.type.dialect_impl(dialect).bind_processor(dialect)
+    if process is None:
+        return safe_date, _slow_column(safe_date)
+    sample = date(2000, 1, 2)
+    iso = process(sample) == sample.isoformat()
+    to_db = date.isoformat if iso else process
+
+    def parse(value):
+        value = safe_date(value)
+        return None if value is None else to_db(value)
+    slow = _slow_column(parse)
+
+    def parse_column(raws):
+        try:
+            dates = list(map(date.fromisoformat, raws))
+        except (TypeError, ValueError):
+            return slow(raws)
+        # fromisoformat also takes forms strptime('%Y-%m-%d') would not; a
+        # round trip to the same text proves every value was plain YYYY-MM-DD.
+        if list(map(date.isoformat, dates)) != raws:
+            return slow(raws)
+        return raws if iso else list(map(to_db, dates))
+    return parse, parse_column
+
+
+def _parsers(column):
+    parse = parser_for(column)
+    if parse is safe_date:
+        return _date_parsers(column)
+    if parse is safe_float:
+        return parse, _builtin_column(float, parse)
+    if parse is safe_int:
+        return parse, _builtin_column(int, parse)
+    return parse, _slow_column(parse)
+
+
+def _fields(table, prefix=''):
+    fields = []
+    for column in table.columns:
+        if column.name in ('id', 'project_id') or not column.info.get('editable', True):
+            continue
+        enums = column.type.enums if isinstance(column.type, Enum) else None
+        length = column.type.length if isinstance(column.type, String) else None
+        fields.append(Field(prefix + column.name, column, *_parsers(column), enums, length))
+    return fields
+
+
+PROJECT_FIELDS = _fields(Project.__table__)
+STAGE_FIELDS = [(name, model.__table__, _fields(model.__table__, name + '_')) for name, model in STAGES]
+FIELD_NAMES = ['id'] + [field.key for field in PROJECT_FIELDS] + [
+    field.key for _, _, fields in STAGE_FIELDS for field in fields]
+FIELD_SET = frozenset(FIELD_NAMES)
+
+
+class RowError(ValueError):
+    def __init__(self, line, problems):
+        super().__init__(f"line {line}: {'; '.join(problems)}")
+        self.line = line
+        self.problems = problems
+
+
+def _parse_fields(record, fields, problems):
+    values = []
+    for field in fields:
+        raw = record.get(field.key)
+        if raw is None or raw == '':
+            if not field.column.nullable:
+                problems.append(f"{field.key} is required")
+            values.append(None)
+            continue
+        if not isinstance(raw, str):
+            raw = str(raw)
+        value = field.parse(raw)
+        if value is None:
+            problems.append(f"{field.key}: cannot parse {raw!r}")
+        elif field.enums is not None and value not in field.enums:
+            problems.append(f"{field.key}: {value!r} is not one of {', '.join(field.enums)}")
+        elif field.length and len(value) > field.length:
+            problems.append(f"{field.key}: longer than {field.length} characters")
+        values.append(value)
+    return values
+
+
+def parse_record(line, record):
+    """Return the row's driver-ready values as one list for the project followed
+    by one per stage in :data:`STAGE_FIELDS` order, or raise :class:`RowError`."""
+    problems = []
+    if not FIELD_SET.issuperset(record):
+        problems.append(f"unknown field(s) {', '.join(sorted(set(record) - FIELD_SET))}")
+    values = [_parse_fields(record, PROJECT_FIELDS, problems)]
+    for _, _, fields in STAGE_FIELDS:
+        values.append(_parse_fields(record, fields, problems))
+    if problems:
+        raise RowError(line, problems)
+    return values
+
+
+def _bad_indexes(field, raws, values):
+    bad = set()
+    if None in values:
+        for i, (raw, value) in enumerate(zip(raws, values)):
+            if value is None and (raw or not field.column.nullable):
+                bad.add(i)
+    if field.enums is not None or field.length:
+        present = [value for value in values if value is not None]
+        if field.enums is not None and not set(present) <= set(field.enums):
+            bad.update(i for i, value in enumerate(values) if value is not None and value not in field.enums)
+        if field.length and present and max(map(len, present)) > field.length:
+            bad.update(i for i, value in enumerate(values) if value is not None and len(value) > field.length)
+    return bad
+
+
+def parse_batch(records):
+    """Parse a list of ``(line, record)`` pairs column by column.
+
+    Returns ``(tables, errors)``: for the project and then each stage, a list
+    of per-column value lists covering the valid records, plus a
+    :class:`RowError` for every rejected one. Working a column at a time lets
+    clean columns convert with one ``map``; rows that fail a check are
+    re-parsed with :func:`parse_record` only to describe the problem.
+    """
+    dicts = [record for _, record in records]
+    bad = {i for i, record in enumerate(dicts) if not FIELD_SET.issuperset(record)}
+    tables = []
+    for fields in [PROJECT_FIELDS] + [fields for _, _, fields in STAGE_FIELDS]:
+        columns = []
+        for field in fields:
+            raws = list(map(dict.get, dicts, repeat(field.key)))
+            values = field.parse_column(raws)
+            bad |= _bad_indexes(field, raws, values)
+            columns.append(values)
+        tables.append(columns)
+    errors = []
+    if bad:
+        for i in sorted(bad):
+            try:
+                parse_record(*records[i])
+            except RowError as e:
+                errors.append(e)
+        tables = [[[value for i, value in enumerate(values) if i not in bad] for values in columns]
+                  for columns in tables]
+    return tables, errors
+
+
+def read_csv(stream):
+    reader = csv.DictReader(stream, restkey='(unnamed)')
+    unknown = sorted(set(reader.fieldnames or ()) - FIELD_SET)
+    if unknown:
+        raise ValueError(f"unknown column(s) {', '.join(unknown)}")
+    for record in reader:
+        yield reader.line_num, record
+
+
+def read_jsonl(stream):
+    for line, text in enumerate(stream, 1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            yield line, RowError(line, [f"invalid JSON: {e}"])
+            continue
+        if not isinstance(record, dict):
+            yield line, RowError(line, ["not a JSON object"])
+            continue
+        # Numbers and booleans go through the same text parsers as CSV values.
+        yield line, {key: value if value is None or isinstance(value, str) else str(value)
+                     for key, value in record.items()}
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+
+
+def _allocate_ids(conn, table, count):
+    """``count`` new ids for ``table``, in ascending order.
+
+    On PostgreSQL they come from the column's sequence, so the app's own
+    inserts, which also draw from it, never collide with imported rows.
+    Elsewhere they follow the current highest id -- or, for a SQLite
+    AUTOINCREMENT table, the highest id it ever handed out, so ids of deleted
+    rows are not reused. A concurrent writer taking the same ids fails the
+    batch, which is retried.
+    """
+    if conn.dialect.name == 'postgresql':
+        sequence = func.pg_get_serial_sequence(table.name, table.c.id.name)
+        allocated = select(func.nextval(sequence)).select_from(func.generate_series(1, count))
+        return sorted(conn.execute(allocated).scalars())
+    highest = conn.execute(select(func.max(table.c.id))).scalar() or 0
+    if conn.dialect.name == 'sqlite' and table.dialect_options['sqlite']['autoincrement']:
+        # Inserting an explicit id past the sequence moves the sequence along.
+        used = conn.exec_driver_sql('SELECT seq FROM sqlite_sequence WHERE name = ?', (table.name,)).scalar()
+        highest = max(highest, used or 0)
+    return list(range(highest + 1, highest + 1 + count))
+
+
+def _insert_batch(conn, tables, count):
+    projects = Project.__table__
+    project_ids = _allocate_ids(conn, projects, count)
+    keys = ['id'] + [field.column.name for field in PROJECT_FIELDS]
+    executemany(conn, projects, keys, list(zip(project_ids, *tables[0])))
+    for (_, table, fields), columns in zip(STAGE_FIELDS, tables[1:]):
+        # As in stages.create_parsed, only stages with a value get a row.
+        rows = [row for row in zip(project_ids, *columns) if any(value is not None for value in row[1:])]
+        if not rows:
+            continue
+        stage_ids = _allocate_ids(conn, table, len(rows))
+        keys = ['id', 'project_id'] + [field.column.name for field in fields]
+        executemany(conn, table, keys, [(stage_id,) + row for stage_id, row in zip(stage_ids, rows)])
+    return project_ids
+
+
+def _write_batch(tables, count):
+    for attempt in range(1, ID_CONFLICT_RETRIES + 1):
+        try:
+            with engine.begin() as conn:
+                project_ids = _insert_batch(conn, tables, count)
+                changes.notify_before_commit(conn, project_ids, created_ids=project_ids)
+            changes.notify_after_commit(engine, project_ids)
+            return
+        except IntegrityError:
+            if attempt == ID_CONFLICT_RETRIES:
+                raise
+            logger.warning("Id conflict with a concurrent writer, retrying batch")
+
+
+def import_records(records, batch_size=BATCH_SIZE, dry_run=False, on_error=None):
+    """Import ``(line, record)`` pairs; returns ``(imported, rejected)`` counts.
+
+    Invalid rows are passed to ``on_error(RowError)`` and skipped.
+    """
+    imported = rejected = 0
+
+    def flush(batch):
+        nonlocal imported, rejected
+        tables, errors = parse_batch(batch)
+        rejected += len(errors)
+        if on_error:
+            for error in errors:
+                on_error(error)
+        count = len(batch) - len(errors)
+        if count and not dry_run:
+            _write_batch(tables, count)
+        imported += count
+
+    batch = []
+    for line, record in records:
+        if isinstance(record, RowError):
+            rejected += 1
+            if on_error:
+                on_error(record)
+            continue
+        batch.append((line, record))
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return imported, rejected
+
+
+def _export_query():
+    projects = Project.__table__
+    source = projects
+    columns = [projects.c.id] + [field.column for field in PROJECT_FIELDS]
+    for _, table, fields in STAGE_FIELDS:
+        source = source.outerjoin(table, table.c.project_id == projects.c.id)
+        columns += [field.column.label(field.key) for field in fields]
+    return select(*columns).select_from(source).order_by(projects.c.id)
+
+
+def export_records(bind=None, batch_size=EXPORT_BATCH):
+    """Yield one dict per project, keyed by :data:`FIELD_NAMES`, in id order."""
+    bind = bind or engine
+    query = _export_query()
+    projects = Project.__table__
+    last_id = 0
+    while True:
+        with bind.connect() as conn:
+            rows = conn.execute(query.where(projects.c.id > last_id).limit(batch_size)).all()
+        for row in rows:
+            yield dict(row._mapping)
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1].id
+
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def write_csv(stream, records):
+    writer = csv.DictWriter(stream, FIELD_NAMES)
+    writer.writeheader()
+    count = 0
+    for record in records:
+        writer.writerow({key: _plain(value) for key, value in record.items()})
+        count += 1
+    return count
+
+
+def write_jsonl(stream, records):
+    count = 0
+    for record in records:
+        stream.write(json.dumps(record, default=_plain) + '\n')
+        count += 1
+    return count
+
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl}
+
+
+def _format_for(path, given):
+    if given:
+        return given
+    for suffix, name in FORMATS.items():
+        if path.lower().endswith(suffix):
+            return name
+    raise SystemExit(f"Cannot tell the format of {path!r}; pass --format csv or --format jsonl")
+
+
+def _open(path, mode):
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    return open(path, mode, newline='', encoding='utf-8')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import and export of projects.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='create projects from a CSV or JSONL file')
+    import_parser.add_argument('path', help="input file, or - for stdin")
+    import_parser.add_argument('--format', choices=sorted(READERS))
+    import_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    import_parser.add_argument('--dry-run', action='store_true', help='validate only')
+    export_parser = commands.add_parser('export', help='write every project to a CSV or JSONL file')
+    export_parser.add_argument('path', help="output file, or - for stdout")
+    export_parser.add_argument('--format', choices=sorted(WRITERS))
+    args = parser.parse_args(argv)
+
+    from database import init_db
+    init_db()
+    file_format = _format_for(args.path, args.format)
+    started = time.perf_counter()
+    if args.command == 'export':
+        with _open(args.path, 'w') as stream:
+            count = WRITERS[file_format](stream, export_records())
+        print(f"Exported {count} projects in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        return 0
+
+    def report(error):
+        print(error, file=sys.stderr)
+
+    with _open(args.path, 'r') as stream:
+        try:
+            imported, rejected = import_records(READERS[file_format](stream), batch_size=args.batch_size,
+                                                dry_run=args.dry_run, on_error=report)
+        except ValueError as e:
+            print(f"Cannot import {args.path}: {e}", file=sys.stderr)
+            return 2
+    elapsed = time.perf_counter() - started
+    verb = 'Validated' if args.dry_run else 'Imported'
+    print(f"{verb} {imported} projects in {elapsed:.1f}s ({imported / elapsed if elapsed else 0:.0f}/s), "
+          f"rejected {rejected}", file=sys.stderr)
+    return 1 if rejected else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
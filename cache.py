@@ -0,0 +1,159 @@
+"""Version-keyed caching of rendered pages and other per-project values.
+
+Every commit that touches a project bumps two counters in ``cache_versions``
+inside the same transaction: ``projects`` (anything on the dashboard may have
+changed) and ``project:<id>``; a deleted project's counter is dropped. Cache entries are keyed by the counters they
+depend on, so a write anywhere -- in any worker process -- makes the old
+entries unreachable; the in-process LRU only has to bound memory and age.
+The counters also drive ETag/Last-Modified for conditional GETs.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+from flask import request, session, make_response
+from sqlalchemy import bindparam, select, update, insert
+from database import db_session
+from models import CacheVersion, Project
+from queries import chunks
+import changes
+
+cache_versions = CacheVersion.__table__
+
+ALL_PROJECTS = 'projects'
+
+
+def project_key(project_id):
+    return f'project:{project_id}'
+
+
+class LRUCache:
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+page_cache = LRUCache()
+
+# Keys per statement when bumping many counters at once.
+BUMP_CHUNK = 500
+
+
+def bump(session, keys):
+    now = datetime.utcnow().replace(microsecond=0)
+    keys = list(keys)
+    for start in range(0, len(keys), BUMP_CHUNK):
+        chunk = keys[start:start + BUMP_CHUNK]
+        existing = set(session.execute(
+            select(cache_versions.c.key).where(cache_versions.c.key.in_(chunk))
+        ).scalars())
+        if existing:
+            session.execute(
+                update(cache_versions)
+                .where(cache_versions.c.key.in_(existing))
+                .values(version=cache_versions.c.version + 1, updated_at=now)
+            )
+        missing = [dict(key=key, version=1, updated_at=now) for key in chunk if key not in existing]
+        if missing:
+            session.execute(insert(cache_versions), missing)
+
+
+def forget(session, keys):
+    for chunk in chunks(keys):
+        session.execute(cache_versions.delete().where(cache_versions.c.key.in_(chunk)))
+
+
+_EXISTING = select(Project.id).where(Project.id.in_(bindparam('ids', expanding=True)))
+
+
+@changes.before_commit
+def _bump_project_versions(session, project_ids):
+    created = changes.created(session)
+    deleted = set()
+    for chunk in chunks(set(project_ids) - created):
+        deleted.update(set(chunk) - set(session.execute(_EXISTING, {'ids': chunk}).scalars()))
+    bump(session, [ALL_PROJECTS] + [project_key(i) for i in sorted(set(project_ids) - deleted)])
+    forget(session, [project_key(i) for i in deleted])
+
+
+def current_versions(keys):
+    """Return ``(version token, last modified)`` for ``keys`` in one query."""
+    rows = dict(
+        (key, (version, updated_at))
+        for key, version, updated_at in db_session.execute(
+            select(cache_versions.c.key, cache_versions.c.version, cache_versions.c.updated_at)
+            .where(cache_versions.c.key.in_(keys))
+        )
+    )
+    token = '.'.join(str(rows.get(key, (0, None))[0]) for key in keys)
+    modified = [updated_at for _, updated_at in rows.values()]
+    return token, max(modified) if modified else None
+
+
+def cached_page(keys_for, vary=None):
+    """Cache a view's GET responses under the version counters from ``keys_for(**view_args)``.
+
+    Serves 304 to matching conditional requests, otherwise a cached body or a
+    fresh render. Requests with pending flash messages always render, since
+    the cached page would not show them. A page that also depends on
+    something no commit changes, such as today's date, passes ``vary()``
+    returning it as a string; it becomes part of the cache key and ETag, and
+    no Last-Modified is sent since the counters' times no longer cover it.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or '_flashes' in session:
+                return view(*args, **kwargs)
+            token, last_modified = current_versions(keys_for(**kwargs))
+            if vary is not None:
+                token, last_modified = f'{token}|{vary()}', None
+            etag = hashlib.sha1(f'{request.full_path}|{token}'.encode('utf-8')).hexdigest()
+
+            cache_key = (request.full_path, token)
+            cached = page_cache.get(cache_key)
+            if cached is None and not request.if_none_match.contains(etag):
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.direct_passthrough:
+                    return response
+                cached = (response.get_data(), response.mimetype)
+                page_cache.set(cache_key, cached)
+            body, mimetype = cached or ('', None)
+            response = make_response(body)
+            if mimetype:
+                response.mimetype = mimetype
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            response.cache_control.private = True
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
@@ -0,0 +1,125 @@
+"""Track which projects a transaction touched and notify listeners on commit.
+
+ORM flushes are inspected automatically: new, changed and deleted projects,
+stage records and attachments mark their project. Bulk statements that
+bypass the ORM call :func:`mark` themselves.
+
+``before_commit`` listeners run inside the committing transaction and may
+write (derived tables, version counters); ``after_commit`` listeners run once
+the data is durable. Both receive ``(session, project_ids)``. Core writes on
+a bare connection (bulk import) call :func:`notify_before_commit` and
+:func:`notify_after_commit` themselves, and listeners then get the
+connection in place of a session.
+
+Listeners can tell new projects from changed ones with :func:`created`.
+"""
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+_before_commit = []
+_after_commit = []
+
+_TOUCHED = 'touched_projects'
+_TOUCHED_STAGES = 'touched_stages'
+_CREATED = 'created_projects'
+
+
+def before_commit(fn):
+    _before_commit.append(fn)
+    return fn
+
+
+def after_commit(fn):
+    _after_commit.append(fn)
+    return fn
+
+
+def mark(session, project_ids):
+    session.info.setdefault(_TOUCHED, set()).update(i for i in project_ids if i is not None)
+
+
+def mark_files(session, files):
+    for file in files:
+        _record(session, file)
+
+
+def created(bind):
+    """Ids of the projects the committing transaction inserted, for ``before_commit`` listeners."""
+    return bind.info.get(_CREATED, frozenset())
+
+
+def notify_before_commit(bind, project_ids, created_ids=()):
+    bind.info[_CREATED] = set(created_ids)
+    try:
+        for listener in _before_commit:
+            listener(bind, set(project_ids))
+    finally:
+        bind.info.pop(_CREATED, None)
+
+
+def notify_after_commit(bind, project_ids):
+    for listener in _after_commit:
+        listener(bind, set(project_ids))
+
+
+def _record(session, obj):
+    from models import Project, File, STAGES
+    if isinstance(obj, Project):
+        mark(session, [obj.id])
+    elif isinstance(obj, File):
+        stages = session.info.setdefault(_TOUCHED_STAGES, set())
+        for name, model in STAGES:
+            parent_id = getattr(obj, name + '_id')
+            if parent_id is not None:
+                stages.add((model, parent_id))
+    elif hasattr(obj, 'project_id'):
+        mark(session, [obj.project_id])
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect(session, flush_context):
+    from models import Project
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        _record(session, obj)
+    new_projects = [obj.id for obj in session.new if isinstance(obj, Project)]
+    if new_projects:
+        session.info.setdefault(_CREATED, set()).update(new_projects)
+
+
+def _resolve_stages(session):
+    stages = session.info.pop(_TOUCHED_STAGES, None)
+    if not stages:
+        return
+    by_model = {}
+    for model, parent_id in stages:
+        by_model.setdefault(model, set()).add(parent_id)
+    for model, ids in by_model.items():
+        mark(session, session.execute(select(model.project_id).where(model.id.in_(ids))).scalars())
+
+
+@event.listens_for(Session, 'before_commit')
+def _before_commit_listeners(session):
+    # commit() only flushes after this hook, so flush now to see everything.
+    session.flush()
+    _resolve_stages(session)
+    project_ids = session.info.get(_TOUCHED)
+    if project_ids:
+        for listener in _before_commit:
+            listener(session, set(project_ids))
+            session.flush()
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit_listeners(session):
+    session.info.pop(_CREATED, None)
+    project_ids = session.info.pop(_TOUCHED, None)
+    if project_ids:
+        for listener in _after_commit:
+            listener(session, project_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget(session):
+    session.info.pop(_TOUCHED, None)
+    session.info.pop(_TOUCHED_STAGES, None)
+    session.info.pop(_CREATED, None)
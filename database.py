@@ -1,8 +1,75 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool, StaticPool
 
-engine = create_engine('sqlite:///instance/project_tracker.db')
+DEFAULT_DATABASE_URL = 'sqlite:///instance/project_tracker.db'
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+def sqlite_pragmas():
+    return {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': _env_int('SQLITE_BUSY_TIMEOUT_MS', 5000),
+        'cache_size': -_env_int('SQLITE_CACHE_SIZE_KB', 64 * 1024),
+        'mmap_size': _env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+        'temp_store': 'MEMORY',
+    }
+
+def make_engine(url=None, pragmas=None, **options):
+    """Create an engine for ``url`` (default ``$DATABASE_URL``, else the local SQLite file).
+
+    SQLite connections get WAL journaling, ``synchronous=NORMAL``, a busy
+    timeout and larger page/mmap caches applied on connect, so concurrent
+    workers wait for the write lock instead of failing with "database is
+    locked". Any other URL gets a pre-pinged, size-limited QueuePool. Bound
+    parameters are left out of exception messages, which end up in the logs
+    and would otherwise carry customer names and amounts. Extra keyword
+    arguments go straight to ``create_engine``.
+    """
+    url = make_url(url or os.environ.get('DATABASE_URL', DEFAULT_DATABASE_URL))
+    options.setdefault('hide_parameters', True)
+    if url.get_backend_name() != 'sqlite':
+        options.setdefault('pool_size', _env_int('DB_POOL_SIZE', 5))
+        options.setdefault('max_overflow', _env_int('DB_MAX_OVERFLOW', 10))
+        options.setdefault('pool_timeout', _env_int('DB_POOL_TIMEOUT', 30))
+        options.setdefault('pool_recycle', _env_int('DB_POOL_RECYCLE', 1800))
+        options.setdefault('pool_pre_ping', True)
+        return create_engine(url, **options)
+
+    pragmas = dict(sqlite_pragmas(), **(pragmas or {}))
+    connect_args = options.setdefault('connect_args', {})
+    connect_args.setdefault('check_same_thread', False)
+    connect_args.setdefault('timeout', pragmas['busy_timeout'] / 1000)
+    if url.database in (None, '', ':memory:'):
+        # Every connection to an in-memory database is a new, empty database.
+        options.setdefault('poolclass', StaticPool)
+        pragmas.pop('journal_mode')
+    else:
+        directory = os.path.dirname(url.database)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        options.setdefault('poolclass', QueuePool)
+        options.setdefault('pool_size', _env_int('DB_POOL_SIZE', 5))
+        options.setdefault('max_overflow', _env_int('DB_MAX_OVERFLOW', 10))
+        options.setdefault('pool_timeout', _env_int('DB_POOL_TIMEOUT', 30))
+    engine = create_engine(url, **options)
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    return engine
+
+engine = make_engine()
 db_session = scoped_session(sessionmaker(autocommit=False,
                                          autoflush=False,
                                          bind=engine))
@@ -10,5 +77,5 @@ Base = declarative_base()
 Base.query = db_session.query_property()
 
 def init_db():
-    import models
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    import migrations
+    migrations.upgrade(engine)
\ No newline at end of file
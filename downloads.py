@@ -0,0 +1,131 @@
+"""Serving stored attachments: single files and whole-project zip archives.
+
+Single files are answered with the content hash as a strong ETag and the
+upload time as Last-Modified, so conditional and ``Range`` requests (resumed
+or partial downloads of large CAD/PDF files) are handled without reading
+more than the requested bytes. The body itself goes out one of three ways:
+
+* ``ATTACHMENT_ACCEL_REDIRECT`` set (e.g. ``/_attachments/``): an empty
+  response with ``X-Accel-Redirect``; nginx serves the file from an
+  ``internal`` location aliased to the upload folder.
+* ``USE_X_SENDFILE``: Flask's ``X-Sendfile`` header for Apache/lighttpd.
+* otherwise the WSGI server's file wrapper, which uses ``sendfile(2)``
+  where the server supports it.
+
+Project archives are streamed: each file is copied into the zip in
+``CHUNK_SIZE`` pieces and handed to the server as it is produced, so memory
+use does not grow with the archive.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import zipfile
+from flask import current_app, make_response, request, send_file
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+# Content-addressed, so a given file id always has the same bytes.
+MAX_AGE = 24 * 3600
+
+
+def _mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def send_attachment(file, upload_root, as_attachment=True):
+    """Response serving stored ``file`` (a ``File`` row) with ranges and validators."""
+    accel_prefix = current_app.config.get('ATTACHMENT_ACCEL_REDIRECT')
+    if accel_prefix:
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = (
+            accel_prefix.rstrip('/') + '/' + os.path.relpath(file.file_path, upload_root).replace(os.sep, '/'))
+        response.mimetype = _mimetype(file.filename)
+        response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline',
+                             filename=file.filename)
+        response.set_etag(file.sha256)
+        response.last_modified = file.upload_date
+        # nginx applies Range itself; only answer conditionals here.
+        response = response.make_conditional(request)
+    else:
+        response = send_file(os.path.abspath(file.file_path), mimetype=_mimetype(file.filename),
+                             as_attachment=as_attachment, download_name=file.filename,
+                             etag=file.sha256, last_modified=file.upload_date, conditional=True)
+        # Werkzeug only advertises ranges on a ranged response; say so up front for resumable clients.
+        response.accept_ranges = 'bytes'
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.max_age = MAX_AGE
+    return response
+
+
+def archive_entries(files_by_stage):
+    """``(name in archive, path, modified, sha256)`` for ``(stage name, [File])`` pairs.
+
+    Files sit in a folder per stage; repeated names get `` (2)``, `` (3)``...
+    """
+    entries, seen = [], set()
+    for stage_name, files in files_by_stage:
+        for file in files:
+            stem, dot, extension = file.filename.rpartition('.')
+            if not dot:
+                stem, extension = extension, ''
+            name, copy = f'{stage_name}/{file.filename}', 1
+            while name in seen:
+                copy += 1
+                name = f'{stage_name}/{stem} ({copy}){dot}{extension}'
+            seen.add(name)
+            entries.append((name, file.file_path, file.upload_date, file.sha256))
+    return entries
+
+
+def archive_etag(entries):
+    """Strong validator for an archive: it changes whenever any name or content does."""
+    digest = hashlib.sha256()
+    for name, _, _, sha256 in entries:
+        digest.update(f'{name}\0{sha256}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class _Pipe:
+    """Write-only file object whose contents are drained as the zip is written."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries, chunk_size=CHUNK_SIZE):
+    """Yield a zip archive of ``entries`` piece by piece.
+
+    Files are stored uncompressed: most attachments (images, PDFs) already
+    are, and the CPU is better spent elsewhere. A file that has vanished
+    from disk since the listing is left out rather than breaking the stream.
+    """
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, 'w', zipfile.ZIP_STORED) as archive:
+        for name, path, modified, _ in entries:
+            info = zipfile.ZipInfo(name, date_time=modified.timetuple()[:6])
+            try:
+                source = open(path, 'rb')
+            except FileNotFoundError:
+                logger.warning("Attachment %s is missing from %s; left out of the archive", name, path)
+                continue
+            with source, archive.open(info, 'w', force_zip64=True) as target:
+                for chunk in iter(lambda: source.read(chunk_size), b''):
+                    target.write(chunk)
+                    yield pipe.drain()
+            yield pipe.drain()
+    yield pipe.drain()
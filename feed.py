@@ -0,0 +1,153 @@
+"""Change feed: a sequence-numbered log of project changes, streamed as Server-Sent Events.
+
+Every commit that touches projects appends one ``change_events`` row per
+project -- ``create``, ``update`` or ``delete`` -- inside the committing
+transaction (see :mod:`changes`), so the log has exactly the changes that
+became durable.
+
+Ids are taken when the rows are inserted, just before the commit. SQLite
+runs one writer at a time, so there they are also in commit order. On
+PostgreSQL a transaction can commit after one that took a later id; a
+stream that finds a hole in the ids waits up to ``gap_wait`` seconds for it
+to fill before moving past it as a rolled-back transaction's.
+
+:func:`stream` follows the log for one client. Each event is sent as::
+
+    id: 1234
+    event: project
+    data: {"project_id": 7, "action": "update"}
+
+and a reconnecting ``EventSource`` sends the last id back as
+``Last-Event-ID``, so nothing is missed across reconnects. If that id is
+older than the retained log, or newer than any event in it (the log was
+emptied or the database replaced), the client gets an ``event: reset`` and
+should reload. Streams wake up at once for commits made in this process and
+poll for those made by other workers.
+
+An open stream occupies a server worker (or thread) for its whole
+``lifetime``, after which the browser simply reconnects, so every open
+dashboard holds one almost continuously. The dashboard only follows the
+feed when ``CHANGE_FEED_LIVE`` is set, which needs threaded or async
+workers; a handful of tabs would take every sync worker.
+"""
+import json
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import bindparam, func, select
+from database import engine
+from models import Project, ChangeEvent
+from queries import chunks
+import changes
+
+change_events = ChangeEvent.__table__
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+
+# Events sent per query while a client catches up.
+BATCH_SIZE = 500
+# Seconds a hole in the event ids is waited on (see the module docstring).
+GAP_WAIT = 5.0
+
+_EXISTING = select(Project.id).where(Project.id.in_(bindparam('ids', expanding=True)))
+_AFTER = (
+    select(change_events.c.id, change_events.c.project_id, change_events.c.action)
+    .where(change_events.c.id > bindparam('after'))
+    .order_by(change_events.c.id)
+    .limit(BATCH_SIZE)
+)
+
+# Bumped and notified after every local commit that logged events.
+_committed = threading.Condition()
+_commits = 0
+
+
+@changes.before_commit
+def _record(bind, project_ids):
+    now = datetime.utcnow().replace(microsecond=0)
+    created = changes.created(bind)
+    for chunk in chunks(project_ids):
+        existing = set(bind.execute(_EXISTING, {'ids': chunk}).scalars())
+        bind.execute(change_events.insert(), [
+            {'project_id': project_id,
+             'action': DELETE if project_id not in existing else CREATE if project_id in created else UPDATE,
+             'created_at': now}
+            for project_id in chunk
+        ])
+
+
+@changes.after_commit
+def _wake_streams(bind, project_ids):
+    global _commits
+    with _committed:
+        _commits += 1
+        _committed.notify_all()
+
+
+def latest_id(bind):
+    """The newest event's sequence number; 0 while the log is empty."""
+    return bind.execute(select(func.max(change_events.c.id))).scalar() or 0
+
+
+def events_after(conn, after):
+    return conn.execute(_AFTER, {'after': after}).all()
+
+
+def trim(max_age):
+    """Delete events older than ``max_age``; returns how many were removed."""
+    cutoff = datetime.utcnow() - max_age
+    with engine.begin() as conn:
+        return conn.execute(change_events.delete().where(change_events.c.created_at < cutoff)).rowcount
+
+
+def _message(event, data, event_id=None):
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines += [f'event: {event}', f'data: {json.dumps(data)}']
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream(last_id=None, poll=2.0, heartbeat=15.0, lifetime=25.0, retry_ms=2000, gap_wait=GAP_WAIT):
+    """SSE text for the events after ``last_id`` (default: from now on), until ``lifetime`` runs out."""
+    started = last_sent = time.monotonic()
+    gap_since = None
+    yield f'retry: {retry_ms}\n\n'
+    with engine.connect() as conn:
+        oldest = conn.execute(select(func.min(change_events.c.id))).scalar()
+        newest = latest_id(conn)
+    if last_id is None:
+        last_id = newest
+    elif last_id > newest or last_id < (oldest or 1) - 1:
+        # The events after the client's id were trimmed, or never existed
+        # in this log; it has to start over.
+        yield _message('reset', {'latest_id': newest}, newest)
+        last_id = newest
+
+    while time.monotonic() - started < lifetime:
+        seen = _commits
+        with engine.connect() as conn:
+            rows = events_after(conn, last_id)
+        sent = 0
+        for row in rows:
+            # (Starting from an empty log, 0, there is nothing to be contiguous with.)
+            if last_id and row.id != last_id + 1:
+                # Possibly an id taken by a transaction that has not committed yet.
+                gap_since = gap_since or time.monotonic()
+                if time.monotonic() - gap_since < gap_wait:
+                    break
+            gap_since = None
+            yield _message('project', {'project_id': row.project_id, 'action': row.action}, row.id)
+            last_id = row.id
+            sent += 1
+        if sent:
+            last_sent = time.monotonic()
+            if sent == BATCH_SIZE:
+                continue
+        elif time.monotonic() - last_sent >= heartbeat:
+            # A comment line keeps proxies from closing an idle connection.
+            yield ': keepalive\n\n'
+            last_sent = time.monotonic()
+        with _committed:
+            if _commits == seen:
+                _committed.wait(poll)
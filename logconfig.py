@@ -0,0 +1,142 @@
+"""Application logging: JSON lines written off the request thread.
+
+:func:`configure` puts a :class:`logging.handlers.QueueHandler` on the root
+logger, so a log call only copies the record onto a queue; a
+:class:`~logging.handlers.QueueListener` thread formats and writes it. On the
+way:
+
+* ``levels`` sets a level per logger name (``''`` is the root), e.g.
+  ``{'': 'INFO', 'metrics.slow': 'WARNING', 'sqlalchemy.engine': 'WARNING'}``;
+  ``$LOG_LEVELS`` (``"INFO,uploads=DEBUG"``) overrides it.
+* DEBUG records are sampled: only the first and then every
+  ``debug_sample_every``-th record of each call site gets through.
+* Structured fields passed as ``extra={'fields': {...}}`` are written as
+  JSON, with the values of ``redact`` keys (at any depth) replaced by
+  ``[redacted]``. Customer data belongs in fields, never in the message.
+"""
+import atexit
+import copy
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+DEFAULT_LEVELS = {'': 'INFO'}
+DEFAULT_REDACT = frozenset(('password', 'secret', 'token', 'authorization', 'cookie', 'email', 'phone'))
+REDACTED = '[redacted]'
+
+_listener = []
+
+
+def parse_levels(value):
+    """``"INFO,uploads=DEBUG"`` as ``{'': 'INFO', 'uploads': 'DEBUG'}``."""
+    levels = {}
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        name, _, level = entry.rpartition('=')
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def redact(value, keys):
+    if isinstance(value, dict):
+        return {key: REDACTED if str(key).lower() in keys else redact(item, keys) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item, keys) for item in value]
+    return value
+
+
+class DebugSampler(logging.Filter):
+    """Pass every ``every``-th DEBUG record per call site; other levels always pass."""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self._counters = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.every <= 1:
+            return True
+        site = (record.pathname, record.lineno)
+        counter = self._counters.get(site)
+        if counter is None:
+            counter = self._counters.setdefault(site, itertools.count())
+        return next(counter) % self.every == 0
+
+
+class JSONFormatter(logging.Formatter):
+    def __init__(self, redact_keys=DEFAULT_REDACT):
+        super().__init__()
+        self.redact_keys = frozenset(key.lower() for key in redact_keys)
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry['fields'] = redact(fields, self.redact_keys)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only merge the arguments here; formatting (and tracebacks) happen on the listener thread.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def configure(levels=None, debug_sample_every=100, redact_keys=DEFAULT_REDACT, stream=None):
+    """Route all logging through a background writer; safe to call again to reconfigure."""
+    shutdown()
+    levels = dict(DEFAULT_LEVELS, **(levels or {}))
+    levels.update(parse_levels(os.environ.get('LOG_LEVELS', '')))
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JSONFormatter(redact_keys))
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(DebugSampler(debug_sample_every))
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    for name, level in levels.items():
+        logging.getLogger(name or None).setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    _listener.append((handler, listener))
+
+
+def shutdown():
+    """Flush and stop the writer thread."""
+    while _listener:
+        _, listener = _listener.pop()
+        listener.stop()
+
+
+def _after_fork():
+    # The writer thread stays behind in the parent; a forked worker needs its
+    # own, on a fresh queue in case the parent was mid-put when it forked.
+    if _listener:
+        handler, inherited = _listener.pop()
+        handler.queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(handler.queue, *inherited.handlers)
+        listener.start()
+        _listener.append((handler, listener))
+
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(shutdown)
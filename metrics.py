@@ -0,0 +1,220 @@
+"""Per-request performance instrumentation.
+
+Every request records how many SQL statements it ran and how long they took
+(from engine events), how long templates took to render and how many bytes
+were uploaded. The figures go out three ways:
+
+* a ``Server-Timing`` header on the response, so browser dev tools show the
+  split between database, templates and everything else;
+* ``/metrics``, Prometheus text-format totals and latency histograms per
+  endpoint for this process, for scrapers that send ``METRICS_TOKEN`` as a
+  bearer token (without a token configured the route is a 404; behind a
+  local proxy every client looks like loopback, so addresses prove nothing);
+* the ``metrics.slow`` logger, which gets a warning with the slowest
+  statements for any request over ``SLOW_REQUEST_MS``.
+
+Statements run outside a request (background tasks, CLI tools) are not
+counted.
+"""
+import hmac
+import logging
+import threading
+import time
+from flask import Response, abort, current_app, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+
+slow_logger = logging.getLogger(__name__ + '.slow')
+
+# Upper bounds in seconds of the request latency histogram.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Statements shown in a slow-request log entry.
+SLOW_STATEMENTS = 5
+# Statements kept per request; a runaway loop should not hold thousands.
+MAX_STATEMENTS = 200
+# Long statements (the summary refresh joins every stage) are cut to this in the log.
+STATEMENT_LOG_CHARS = 400
+
+
+class RequestStats:
+    __slots__ = ('started', 'queries', 'sql_seconds', 'template_seconds', 'upload_bytes', 'statements')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.upload_bytes = 0
+        self.statements = []
+
+
+def current():
+    """Stats of the request being handled, or None outside one."""
+    if has_request_context():
+        return g.get('_request_stats')
+    return None
+
+
+class Registry:
+    """Process-wide totals per ``(endpoint, method, status)``."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, labels, duration, stats):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = {
+                    'count': 0, 'seconds': 0.0, 'buckets': [0] * len(self.buckets),
+                    'queries': 0, 'sql_seconds': 0.0, 'template_seconds': 0.0, 'upload_bytes': 0,
+                }
+            series['count'] += 1
+            series['seconds'] += duration
+            for index, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    series['buckets'][index] += 1
+            series['queries'] += stats.queries
+            series['sql_seconds'] += stats.sql_seconds
+            series['template_seconds'] += stats.template_seconds
+            series['upload_bytes'] += stats.upload_bytes
+
+    def render(self):
+        """The totals in Prometheus text exposition format."""
+        with self._lock:
+            series = sorted((labels, dict(values, buckets=list(values['buckets'])))
+                            for labels, values in self._series.items())
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples)
+
+        def label_text(labels, **extra):
+            endpoint, method, status = labels
+            pairs = dict(endpoint=endpoint, method=method, status=str(status), **extra)
+            return ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"'))
+                            for key, value in pairs.items())
+
+        histogram = []
+        for labels, values in series:
+            for bound, count in zip(self.buckets, values['buckets']):
+                histogram.append(f'http_request_duration_seconds_bucket{{{label_text(labels, le=repr(bound))}}} {count}')
+            histogram.append(f'http_request_duration_seconds_bucket{{{label_text(labels, le="+Inf")}}} {values["count"]}')
+            histogram.append(f'http_request_duration_seconds_sum{{{label_text(labels)}}} {values["seconds"]!r}')
+            histogram.append(f'http_request_duration_seconds_count{{{label_text(labels)}}} {values["count"]}')
+        family('http_request_duration_seconds', 'histogram', 'Time spent handling requests.', histogram)
+        for name, key, help_text in (
+            ('http_request_db_queries_total', 'queries', 'SQL statements executed by requests.'),
+            ('http_request_db_seconds_total', 'sql_seconds', 'Time requests spent executing SQL.'),
+            ('http_request_template_seconds_total', 'template_seconds', 'Time requests spent rendering templates.'),
+            ('http_request_upload_bytes_total', 'upload_bytes', 'Bytes uploaded in multipart request bodies and upload chunks.'),
+        ):
+            family(name, 'counter', help_text,
+                   [f'{name}{{{label_text(labels)}}} {values[key]!r}' for labels, values in series])
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+registry = Registry()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current() is not None and context is not None:
+        # Kept on the statement's own context: a failed statement then leaves nothing behind.
+        context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current()
+    started = getattr(context, '_metrics_started', None)
+    if stats is None or started is None:
+        return
+    elapsed = time.perf_counter() - started
+    stats.queries += 1
+    stats.sql_seconds += elapsed
+    if len(stats.statements) < MAX_STATEMENTS:
+        stats.statements.append((elapsed, statement))
+
+
+def instrument_engine(engine):
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+class TimedTemplate(Template):
+    """Jinja template that adds its render time to the current request's stats."""
+
+    def render(self, *args, **kwargs):
+        stats = current()
+        if stats is None:
+            return super().render(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            stats.template_seconds += time.perf_counter() - started
+
+
+def _start():
+    stats = g._request_stats = RequestStats()
+    if request.mimetype in ('multipart/form-data', 'application/offset+octet-stream'):
+        stats.upload_bytes = request.content_length or 0
+
+
+def server_timing(stats, total):
+    other = max(total - stats.sql_seconds - stats.template_seconds, 0.0)
+    return ', '.join((
+        f'db;dur={stats.sql_seconds * 1000:.1f};desc="{stats.queries} queries"',
+        f'tpl;dur={stats.template_seconds * 1000:.1f}',
+        f'app;dur={other * 1000:.1f}',
+        f'total;dur={total * 1000:.1f}',
+    ))
+
+
+def _finish(response):
+    stats = current()
+    if stats is None:
+        return response
+    # Streamed bodies (zip downloads) are still being produced; this covers the work up to the first byte.
+    duration = time.perf_counter() - stats.started
+    response.headers['Server-Timing'] = server_timing(stats, duration)
+    labels = (request.endpoint or 'unmatched', request.method, response.status_code)
+    registry.observe(labels, duration, stats)
+    threshold = current_app.config['SLOW_REQUEST_MS']
+    if threshold is not None and duration * 1000 >= threshold:
+        slowest = sorted(stats.statements, key=lambda entry: entry[0], reverse=True)[:SLOW_STATEMENTS]
+        # Query values (search terms, creator names) would get past the log's redaction; only names are logged.
+        args = ','.join(sorted(set(request.args)))
+        slow_logger.warning(
+            "Slow request %s %s%s -> %s in %.1f ms (%d queries, %.1f ms SQL, %.1f ms templates)%s",
+            request.method, request.path, f' [args: {args}]' if args else '', response.status_code, duration * 1000,
+            stats.queries, stats.sql_seconds * 1000, stats.template_seconds * 1000,
+            ''.join(f'\n  {elapsed * 1000:.1f} ms: {" ".join(statement.split())[:STATEMENT_LOG_CHARS]}' for elapsed, statement in slowest),
+        )
+    return response
+
+
+def metrics_endpoint():
+    token = current_app.config['METRICS_TOKEN']
+    sent = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(sent.encode(), f'Bearer {token}'.encode()):
+        abort(404)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app, engine):
+    """Instrument ``app`` and ``engine`` and add the ``/metrics`` route."""
+    app.config.setdefault('SLOW_REQUEST_MS', 500)
+    app.config.setdefault('METRICS_TOKEN', None)
+    instrument_engine(engine)
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(_start)
+    app.after_request(_finish)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
@@ -0,0 +1,332 @@
+"""Schema migrations for databases created by an older version of the models.
+
+``Base.metadata.create_all`` only creates tables that do not exist yet, so
+indexes, constraints and columns added to existing tables are applied here.
+Each migration runs once; the highest applied number is kept in the
+``schema_version`` table. A step may return a callable, run once its
+transaction has committed (e.g. to delete files it made obsolete). Run
+``python migrations.py`` to upgrade the configured database by hand, or let
+``init_db`` do it on startup.
+
+A database already stamped with :data:`LATEST_VERSION` is left alone after
+one version lookup -- no reflection, no ``create_all`` -- so every schema
+change, new tables included, must come with a migration.
+"""
+import logging
+import os
+from sqlalchemy import MetaData, Table, Column, Integer, func, inspect, select
+from sqlalchemy.schema import CreateTable
+from database import Base, engine
+
+logger = logging.getLogger(__name__)
+
+schema_version = Table(
+    'schema_version', Base.metadata,
+    Column('version', Integer, nullable=False),
+)
+
+
+class MigrationError(Exception):
+    pass
+
+
+def _create_tables(conn, *names):
+    for name in names:
+        Base.metadata.tables[name].create(bind=conn, checkfirst=True)
+
+
+def _add_columns(conn, table_name, *names):
+    """Add the named model columns to an existing table.
+
+    Columns the table already has are skipped: ``create_all`` builds a table
+    missing from an old database at its current shape.
+    """
+    table = Base.metadata.tables[table_name]
+    existing = {column['name'] for column in inspect(conn).get_columns(table_name)}
+    ddl_compiler = conn.dialect.ddl_compiler(conn.dialect, None)
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        if not column.nullable and column.server_default is None:
+            raise MigrationError(f"Cannot add NOT NULL column {table_name}.{name} without a server default")
+        logger.info("Adding column %s.%s", table_name, name)
+        conn.exec_driver_sql(f'ALTER TABLE {table_name} ADD COLUMN {ddl_compiler.get_column_specification(column)}')
+
+
+def _create_indexes(conn, table_name, *names):
+    indexes = {index.name: index for index in Base.metadata.tables[table_name].indexes}
+    existing = {ix['name'] for ix in inspect(conn).get_indexes(table_name)}
+    for name in names:
+        if name not in existing:
+            logger.info("Creating index %s", name)
+            indexes[name].create(bind=conn)
+
+
+def _drop_indexes(conn, *names):
+    for name in names:
+        logger.info("Dropping index %s", name)
+        conn.exec_driver_sql(f'DROP INDEX IF EXISTS {name}')
+
+
+def _check_one_stage_per_project(conn):
+    from models import STAGES
+    problems = []
+    for name, model in STAGES:
+        table = model.__table__
+        duplicates = conn.execute(
+            select(table.c.project_id)
+            .where(table.c.project_id.isnot(None))
+            .group_by(table.c.project_id)
+            .having(func.count() > 1)
+            .limit(10)
+        ).scalars().all()
+        if duplicates:
+            problems.append(f"{table.name} (project ids {', '.join(map(str, duplicates))})")
+    if problems:
+        raise MigrationError(
+            "Cannot add unique project_id indexes; these stage tables have more than "
+            "one row for the same project: " + '; '.join(problems)
+        )
+
+
+def _add_foreign_key_indexes(conn):
+    from models import STAGES, File
+    _check_one_stage_per_project(conn)
+    for name, model in STAGES:
+        _create_indexes(conn, model.__tablename__, f'ix_{model.__tablename__}_project_id')
+    _create_indexes(conn, 'files', *(f'ix_files_{c.name}' for c in File.__table__.c if c.foreign_keys))
+    # Declared before there was a migration path.
+    _create_indexes(conn, 'projects', 'ix_projects_current_stage')
+
+
+def _add_file_hashes(conn):
+    _add_columns(conn, 'files', 'sha256', 'size')
+    _create_indexes(conn, 'files', 'ix_files_sha256')
+
+
+def _add_file_status(conn):
+    _add_columns(conn, 'files', 'status')
+    _create_indexes(conn, 'files', 'ix_files_status')
+
+
+def _adopt_legacy_attachments(conn):
+    """Move attachments saved before content addressing into the store, filling in sha256 and size.
+
+    Legacy rows point at ``<upload folder>/<filename>``, so the store root is
+    the file's own directory. The originals are removed after commit.
+    """
+    from models import File
+    from storage import ContentStore
+    from uploads import STORED
+    files = File.__table__
+    by_path = {}
+    for file_id, path in conn.execute(
+        select(files.c.id, files.c.file_path).where(files.c.status == STORED, files.c.sha256.is_(None))
+    ):
+        by_path.setdefault(path, []).append(file_id)
+    adopted = []
+    for path, file_ids in by_path.items():
+        if not os.path.isfile(path):
+            logger.warning("Attachment file %s is missing; %s row(s) left unhashed", path, len(file_ids))
+            continue
+        stored = ContentStore(os.path.dirname(path) or '.').adopt(path)
+        for start in range(0, len(file_ids), 500):
+            conn.execute(
+                files.update().where(files.c.id.in_(file_ids[start:start + 500]))
+                .values(file_path=stored.path, sha256=stored.sha256, size=stored.size)
+            )
+        if os.path.abspath(stored.path) != os.path.abspath(path):
+            adopted.append(path)
+    logger.info("Moved %s legacy attachments into the content store", len(adopted))
+
+    def remove_originals():
+        for path in adopted:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning("Could not remove %s: %s", path, e)
+    return remove_originals
+
+
+def _backfill_project_summary(conn):
+    import summary
+    logger.info("Backfilled %s project summary rows", summary.rebuild(conn))
+
+
+def _add_project_revision(conn):
+    _add_columns(conn, 'projects', 'revision')
+
+
+def _add_follow_up_queue(conn):
+    _add_columns(conn, 'project_summary', 'awaiting_response_since')
+    _create_indexes(conn, 'project_summary', 'ix_project_summary_awaiting_response')
+    _backfill_project_summary(conn)
+
+
+def _build_search_index(conn):
+    import search
+    logger.info("Indexed %s projects for search", search.rebuild(conn))
+
+
+def _backfill_stage_transitions(conn):
+    import transitions
+    logger.info("Derived stage history for %s projects", transitions.backfill(conn))
+
+
+def _create_chunked_upload_tables(conn):
+    _create_tables(conn, 'chunked_uploads', 'upload_chunks')
+
+
+def _create_change_events(conn):
+    _create_tables(conn, 'change_events')
+
+
+def _add_file_claim_time(conn):
+    _add_columns(conn, 'files', 'claimed_at')
+
+
+def _add_chunked_upload_checksum(conn):
+    _add_columns(conn, 'chunked_uploads', 'sha256')
+
+
+def _drop_projects_sort_indexes(conn):
+    # The dashboard reads project_summary since migration 4; these only slowed writes.
+    _drop_indexes(conn, 'ix_projects_project_name', 'ix_projects_creator_name',
+                  'ix_projects_current_stage_project_name')
+
+
+def _never_reuse_project_ids(conn):
+    """Rebuild ``projects`` with AUTOINCREMENT on SQLite.
+
+    The sequence starts past every id in use, including those of deleted
+    projects still named by stage history and change events. Other databases
+    never reuse serial ids.
+    """
+    if conn.dialect.name != 'sqlite':
+        return
+    projects = Base.metadata.tables['projects']
+    rebuilt = projects.to_metadata(MetaData(), name='projects_rebuilt')
+    rebuilt.indexes.clear()
+    names = ', '.join(column.name for column in projects.c)
+    conn.execute(CreateTable(rebuilt))
+    conn.exec_driver_sql(f'INSERT INTO projects_rebuilt ({names}) SELECT {names} FROM projects')
+    conn.exec_driver_sql('DROP TABLE projects')
+    conn.exec_driver_sql('ALTER TABLE projects_rebuilt RENAME TO projects')
+    for index in projects.indexes:
+        index.create(bind=conn)
+    highest = max(
+        conn.execute(select(func.max(table.c.project_id))).scalar() or 0
+        for table in (Base.metadata.tables['stage_transitions'], Base.metadata.tables['change_events'])
+    )
+    conn.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'projects'")
+    conn.exec_driver_sql(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'projects', max(coalesce(max(id), 0), ?) FROM projects",
+        (highest,),
+    )
+
+
+def _add_chunk_claim_time(conn):
+    _add_columns(conn, 'upload_chunks', 'claimed_at')
+
+
+
+def _move_upload_folder(conn, old=os.path.join('static', 'uploads'), new=os.path.join('instance', 'uploads')):
+    """Move attachments from ``static/uploads``, which Flask served to anyone, to ``instance/uploads``.
+
+    Files move before the rows pointing at them are rewritten. Moving again
+    is harmless, so if the transaction fails the whole step just reruns on
+    the next start.
+    """
+    from models import ChunkedUpload, File
+    moved = 0
+    for directory, _, names in os.walk(old, topdown=False):
+        target = os.path.join(new, os.path.relpath(directory, old))
+        os.makedirs(target, exist_ok=True)
+        for name in names:
+            # Content-addressed names: a file already at the target has the same bytes.
+            os.replace(os.path.join(directory, name), os.path.join(target, name))
+            moved += 1
+        try:
+            os.rmdir(directory)
+        except OSError as e:
+            logger.warning("Could not remove %s: %s", directory, e)
+    logger.info("Moved %s files from %s to %s", moved, old, new)
+    for column in (File.__table__.c.file_path, ChunkedUpload.__table__.c.spool_path):
+        conn.execute(
+            column.table.update().where(column.startswith(old + os.sep, autoescape=True))
+            .values({column: new + os.sep + func.substr(column, len(old) + 2)})
+        )
+
+
+# (version, description, step). Append only; never renumber.
+MIGRATIONS = [
+    (1, 'index stage project_id (unique) and file parent keys', _add_foreign_key_indexes),
+    (2, 'content hash and size on files', _add_file_hashes),
+    (3, 'upload status on files', _add_file_status),
+    (4, 'project_summary backfill', _backfill_project_summary),
+    (5, 'edit revision on projects', _add_project_revision),
+    (6, 'full-text search index', _build_search_index),
+    (7, 'stage transition history', _backfill_stage_transitions),
+    (8, 'follow-up queue on project_summary', _add_follow_up_queue),
+    (9, 'chunked upload tables', _create_chunked_upload_tables),
+    (10, 'change feed event log', _create_change_events),
+    (11, 'hash attachments saved before content addressing', _adopt_legacy_attachments),
+    (12, 'upload claim time on files', _add_file_claim_time),
+    (13, 'whole-file checksum on chunked uploads', _add_chunked_upload_checksum),
+    (14, 'drop unused projects sort indexes', _drop_projects_sort_indexes),
+    (15, 'never reuse project ids', _never_reuse_project_ids),
+    (16, 'claim time on upload chunks', _add_chunk_claim_time),
+    (17, 'attachments out of static/', _move_upload_folder),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    return conn.execute(select(func.max(schema_version.c.version))).scalar()
+
+
+def _set_version(conn, version):
+    conn.execute(schema_version.delete())
+    conn.execute(schema_version.insert().values(version=version))
+
+
+def stamped_version(bind):
+    """The recorded schema version, or None if the database was never stamped."""
+    with bind.connect() as conn:
+        if not inspect(conn).has_table(schema_version.name):
+            return None
+        return get_version(conn)
+
+
+def upgrade(bind=None):
+    bind = bind or engine
+    import models  # noqa: F401  register every table on Base.metadata
+    import search  # noqa: F401  creates its FTS5 table alongside create_all
+    if stamped_version(bind) == LATEST_VERSION:
+        return LATEST_VERSION
+    with bind.begin() as conn:
+        existing_schema = inspect(conn).has_table('projects')
+        Base.metadata.create_all(bind=conn)
+        version = get_version(conn)
+        if version is None:
+            # A fresh database already has everything create_all knows about.
+            version = 0 if existing_schema else LATEST_VERSION
+            _set_version(conn, version)
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info("Applying migration %s: %s", number, description)
+        with bind.begin() as conn:
+            after_commit = step(conn)
+            _set_version(conn, number)
+        if after_commit is not None:
+            after_commit()
+        version = number
+    return version
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(f"Database schema at version {upgrade()}")
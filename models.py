@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Date, Enum, Float, ForeignKey, DateTime, Text
+from sqlalchemy import Column, Integer, String, Date, Enum, Float, ForeignKey, DateTime, Index, Boolean, false, BigInteger
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -13,25 +13,37 @@ class Project(Base):
     last_contact_date = Column(Date)
     last_response_date = Column(Date)
     primary_communication_method = Column(String(50))
+    # Bumped by every edit; an edit carrying an older value is rejected.
+    revision = Column(Integer, nullable=False, server_default='0', info={'editable': False})
 
-    communication = relationship("Communication", back_populates="project")
-    design = relationship("Design", back_populates="project")
-    modeling = relationship("Modeling", back_populates="project")
-    prototype = relationship("Prototype", back_populates="project")
-    product_pictures = relationship("ProductPictures", back_populates="project")
-    contract = relationship("Contract", back_populates="project")
-    tooling = relationship("Tooling", back_populates="project")
-    launch = relationship("Launch", back_populates="project")
-    production = relationship("Production", back_populates="project")
-    packaging = relationship("Packaging", back_populates="project")
-    customer_service = relationship("CustomerService", back_populates="project")
-    freight = relationship("Freight", back_populates="project")
-    shipping = relationship("Shipping", back_populates="project")
+    communication = relationship("Communication", back_populates="project", uselist=False)
+    design = relationship("Design", back_populates="project", uselist=False)
+    modeling = relationship("Modeling", back_populates="project", uselist=False)
+    prototype = relationship("Prototype", back_populates="project", uselist=False)
+    product_pictures = relationship("ProductPictures", back_populates="project", uselist=False)
+    contract = relationship("Contract", back_populates="project", uselist=False)
+    tooling = relationship("Tooling", back_populates="project", uselist=False)
+    launch = relationship("Launch", back_populates="project", uselist=False)
+    production = relationship("Production", back_populates="project", uselist=False)
+    packaging = relationship("Packaging", back_populates="project", uselist=False)
+    customer_service = relationship("CustomerService", back_populates="project", uselist=False)
+    freight = relationship("Freight", back_populates="project", uselist=False)
+    shipping = relationship("Shipping", back_populates="project", uselist=False)
+
+    # The dashboard sorts and filters project_summary; this one backs the
+    # set-based deletes and stage filters that still go to projects.
+    # AUTOINCREMENT: a deleted project's id, still keying its stage history
+    # and change events, must not be handed to a new project.
+    __table_args__ = (
+        Index('ix_projects_current_stage', 'current_stage', 'id'),
+        {'sqlite_autoincrement': True},
+    )
 
 class Communication(Base):
     __tablename__ = 'communication'
+    __form_prefix__ = ''
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     num_phone_calls = Column(Integer)
     num_messages_client = Column(Integer)
     num_messages_us = Column(Integer)
@@ -47,7 +59,7 @@ class Communication(Base):
 class Design(Base):
     __tablename__ = 'design'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     start_date = Column(Date)
     end_date = Column(Date)
     cost = Column(Float)
@@ -58,7 +70,7 @@ class Design(Base):
 class Modeling(Base):
     __tablename__ = 'modeling'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     start_date = Column(Date)
     end_date = Column(Date)
     cost = Column(Float)
@@ -69,11 +81,11 @@ class Modeling(Base):
 class Prototype(Base):
     __tablename__ = 'prototype'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     start_date = Column(Date)
     end_date = Column(Date)
     cost = Column(Float)
-    num_exploded_pieces = Column(Integer)
+    num_exploded_pieces = Column(Integer, info={'form_field': 'num_exploded_pieces'})
     shipped_date = Column(Date)
     dimensions_height = Column(Float)
     dimensions_length = Column(Float)
@@ -85,7 +97,7 @@ class Prototype(Base):
 class ProductPictures(Base):
     __tablename__ = 'product_pictures'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     start_date = Column(Date)
     end_date = Column(Date)
     cost = Column(Float)
@@ -95,7 +107,7 @@ class ProductPictures(Base):
 class Contract(Base):
     __tablename__ = 'contract'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     sent_date = Column(Date)
     signed_date = Column(Date)
     files = relationship("File", back_populates="contract")
@@ -104,7 +116,7 @@ class Contract(Base):
 class Tooling(Base):
     __tablename__ = 'tooling'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     num_tools = Column(Integer)
     cost = Column(Float)
     start_date = Column(Date)
@@ -115,7 +127,7 @@ class Tooling(Base):
 class Production(Base):
     __tablename__ = 'production'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     start_date = Column(Date)
     end_date = Column(Date)
     cost = Column(Float)
@@ -125,20 +137,20 @@ class Production(Base):
 class Launch(Base):
     __tablename__ = 'launch'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     start_date = Column(Date)
     end_date = Column(Date)
-    units_sold = Column(Integer)
-    retail_price = Column(Float)
-    cash_collected = Column(Float)
-    commission_paid = Column(Float)
+    units_sold = Column(Integer, info={'form_field': 'units_sold'})
+    retail_price = Column(Float, info={'form_field': 'retail_price'})
+    cash_collected = Column(Float, info={'form_field': 'cash_collected'})
+    commission_paid = Column(Float, info={'form_field': 'commission_paid'})
     files = relationship("File", back_populates="launch", cascade="all, delete-orphan")
     project = relationship("Project", back_populates="launch")
 
 class Packaging(Base):
     __tablename__ = 'packaging'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     start_date = Column(Date)
     end_date = Column(Date)
     cost = Column(Float)
@@ -149,8 +161,8 @@ class Packaging(Base):
 class Freight(Base):
     __tablename__ = 'freight'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
-    freight_type = Column(String(50))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
+    freight_type = Column(String(50), info={'form_field': 'freight_type'})
     cost = Column(Float)
     size = Column(String(50))
     weight = Column(Float)
@@ -161,8 +173,9 @@ class Freight(Base):
 
 class CustomerService(Base):
     __tablename__ = 'customer_service'
+    __form_prefix__ = ''
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     num_breakages = Column(Integer)
     num_refunds = Column(Integer)
     num_customer_service_messages = Column(Integer)
@@ -172,7 +185,7 @@ class CustomerService(Base):
 class Shipping(Base):
     __tablename__ = 'shipping'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'))
+    project_id = Column(Integer, ForeignKey('projects.id'), index=True, unique=True)
     start_date = Column(Date)
     end_date = Column(Date)
     avg_price = Column(Float)
@@ -190,20 +203,26 @@ class File(Base):
     file_path = Column(String(255), nullable=False)
     upload_date = Column(DateTime, nullable=False)
     file_type = Column(String(50))
+    sha256 = Column(String(64), index=True)
+    size = Column(Integer)
+    # 'pending' until the background queue has moved the upload into the store.
+    status = Column(String(20), nullable=False, default='stored', server_default='stored', index=True)
+    # When a worker claimed the upload for processing; an old claim means that worker died.
+    claimed_at = Column(DateTime)
     
-    communication_id = Column(Integer, ForeignKey('communication.id'))
-    design_id = Column(Integer, ForeignKey('design.id'))
-    modeling_id = Column(Integer, ForeignKey('modeling.id'))
-    prototype_id = Column(Integer, ForeignKey('prototype.id'))
-    product_pictures_id = Column(Integer, ForeignKey('product_pictures.id'))
-    contract_id = Column(Integer, ForeignKey('contract.id'))
-    tooling_id = Column(Integer, ForeignKey('tooling.id'))
-    launch_id = Column(Integer, ForeignKey('launch.id'))
-    production_id = Column(Integer, ForeignKey('production.id'))
-    packaging_id = Column(Integer, ForeignKey('packaging.id'))
-    customer_service_id = Column(Integer, ForeignKey('customer_service.id'))
-    freight_id = Column(Integer, ForeignKey('freight.id'))
-    shipping_id = Column(Integer, ForeignKey('shipping.id'))
+    communication_id = Column(Integer, ForeignKey('communication.id'), index=True)
+    design_id = Column(Integer, ForeignKey('design.id'), index=True)
+    modeling_id = Column(Integer, ForeignKey('modeling.id'), index=True)
+    prototype_id = Column(Integer, ForeignKey('prototype.id'), index=True)
+    product_pictures_id = Column(Integer, ForeignKey('product_pictures.id'), index=True)
+    contract_id = Column(Integer, ForeignKey('contract.id'), index=True)
+    tooling_id = Column(Integer, ForeignKey('tooling.id'), index=True)
+    launch_id = Column(Integer, ForeignKey('launch.id'), index=True)
+    production_id = Column(Integer, ForeignKey('production.id'), index=True)
+    packaging_id = Column(Integer, ForeignKey('packaging.id'), index=True)
+    customer_service_id = Column(Integer, ForeignKey('customer_service.id'), index=True)
+    freight_id = Column(Integer, ForeignKey('freight.id'), index=True)
+    shipping_id = Column(Integer, ForeignKey('shipping.id'), index=True)
 
     communication = relationship("Communication", back_populates="files")
     design = relationship("Design", back_populates="files")
@@ -217,4 +236,123 @@ class File(Base):
     packaging = relationship("Packaging", back_populates="files")
     customer_service = relationship("CustomerService", back_populates="files")
     freight = relationship("Freight", back_populates="files")
-    shipping = relationship("Shipping", back_populates="files")
\ No newline at end of file
+    shipping = relationship("Shipping", back_populates="files")
+
+class ChunkedUpload(Base):
+    """A resumable upload of one attachment, sent in chunks (see ``routes/attachments.py``).
+
+    Chunks are written in place into ``spool_path``, preallocated to
+    ``length`` bytes. ``sha256`` is the whole file's digest as declared by
+    the client, checked before the upload is finalized. ``file_id`` is set
+    when the upload is finalized into a ``File`` row, which then owns the
+    spooled file.
+    """
+    __tablename__ = 'chunked_uploads'
+    id = Column(String(32), primary_key=True)
+    project_id = Column(Integer, nullable=False)
+    stage = Column(String(50), nullable=False)
+    filename = Column(String(255), nullable=False)
+    length = Column(BigInteger, nullable=False)
+    spool_path = Column(String(255), nullable=False)
+    sha256 = Column(String(64))
+    created_at = Column(DateTime, nullable=False, index=True)
+    file_id = Column(Integer)
+
+class UploadChunk(Base):
+    """A chunk of a ``ChunkedUpload`` that was written and matched its checksum."""
+    __tablename__ = 'upload_chunks'
+    upload_id = Column(String(32), ForeignKey('chunked_uploads.id'), primary_key=True)
+    start = Column(BigInteger, primary_key=True, autoincrement=False)
+    length = Column(BigInteger, nullable=False)
+    sha256 = Column(String(64), nullable=False)
+    # Set while the chunk is being written, None once its bytes are verified.
+    claimed_at = Column(DateTime)
+
+class ProjectSummary(Base):
+    """Denormalized per-project figures, kept current by ``summary.py``."""
+    __tablename__ = 'project_summary'
+    project_id = Column(Integer, primary_key=True, autoincrement=False)
+    project_name = Column(String(255), nullable=False)
+    creator_name = Column(String(255), nullable=False)
+    current_stage = Column(String(10), nullable=False)
+    last_contact_date = Column(Date)
+    last_response_date = Column(Date)
+    # When the client started waiting on a reply from us; None when nobody is waiting.
+    awaiting_response_since = Column(Date)
+    total_spend = Column(Float, nullable=False)
+    units_sold = Column(Integer, nullable=False)
+    revenue = Column(Float, nullable=False)
+    commission = Column(Float, nullable=False)
+    shipping_cost = Column(Float, nullable=False)
+    gross_margin = Column(Float, nullable=False)
+    attachment_count = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_project_summary_project_name', 'project_name', 'project_id'),
+        Index('ix_project_summary_creator_name', 'creator_name', 'project_name', 'project_id'),
+        Index('ix_project_summary_current_stage', 'current_stage', 'project_id'),
+        Index('ix_project_summary_current_stage_project_name', 'current_stage', 'project_name', 'project_id'),
+        # The follow-up queue, longest wait first.
+        Index('ix_project_summary_awaiting_response', 'awaiting_response_since', 'project_id'),
+    )
+
+class StageTransition(Base):
+    """Append-only history of ``Project.current_stage``, kept by ``transitions.py``.
+
+    ``project_id`` is deliberately not a foreign key: history outlives the
+    project. ``derived`` rows were reconstructed from stage dates rather than
+    observed as they happened.
+    """
+    __tablename__ = 'stage_transitions'
+    id = Column(Integer, primary_key=True)
+    project_id = Column(Integer, nullable=False)
+    from_stage = Column(String(10))
+    to_stage = Column(String(10), nullable=False)
+    changed_at = Column(DateTime, nullable=False)
+    derived = Column(Boolean, nullable=False, server_default=false())
+
+    __table_args__ = (
+        # A project's history in order, and its latest stage.
+        Index('ix_stage_transitions_project', 'project_id', 'changed_at', 'id'),
+        # Funnel and per-stage queries.
+        Index('ix_stage_transitions_to_stage', 'to_stage', 'project_id'),
+    )
+
+class ChangeEvent(Base):
+    """Sequence-numbered log of project creates, updates and deletes, kept by ``feed.py``.
+
+    ``id`` is the event's sequence number; AUTOINCREMENT keeps it from being
+    reused after old events are trimmed.
+    """
+    __tablename__ = 'change_events'
+    id = Column(Integer, primary_key=True)
+    project_id = Column(Integer, nullable=False)
+    action = Column(String(10), nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+class CacheVersion(Base):
+    __tablename__ = 'cache_versions'
+    key = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+# Project relationship name for every stage, in form order. Each stage's
+# parent key on ``File`` is ``<name>_id``.
+STAGES = [
+    ('communication', Communication),
+    ('design', Design),
+    ('modeling', Modeling),
+    ('prototype', Prototype),
+    ('product_pictures', ProductPictures),
+    ('contract', Contract),
+    ('tooling', Tooling),
+    ('production', Production),
+    ('packaging', Packaging),
+    ('launch', Launch),
+    ('customer_service', CustomerService),
+    ('freight', Freight),
+    ('shipping', Shipping),
+]
\ No newline at end of file
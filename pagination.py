@@ -0,0 +1,116 @@
+import base64
+import json
+from datetime import date, datetime
+from flask import current_app, request
+from sqlalchemy import Date, DateTime, tuple_
+from parsing import safe_int
+
+
+def _cursor_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Cannot put {type(value).__name__} in a cursor")
+
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(',', ':'), default=_cursor_value).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def requested_limit():
+    """The request's ``limit`` argument: ``DASHBOARD_PAGE_SIZE`` if missing, capped at ``DASHBOARD_MAX_PAGE_SIZE``."""
+    limit = safe_int(request.args.get('limit')) or current_app.config['DASHBOARD_PAGE_SIZE']
+    return max(1, min(limit, current_app.config['DASHBOARD_MAX_PAGE_SIZE']))
+
+
+class InvalidCursor(ValueError):
+    """A cursor that was not produced for this listing."""
+
+
+def _from_cursor(columns, values):
+    """Cursor values back as the column types, or None if they do not fit."""
+    if values is None or len(values) != len(columns):
+        return None
+    converted = []
+    for column, value in zip(columns, values):
+        # Only scalars are ever encoded; anything else would be bound into the comparison.
+        if not isinstance(value, (str, int, float, type(None))):
+            return None
+        if value is not None and isinstance(column.type, (Date, DateTime)):
+            if not isinstance(value, str):
+                return None
+            try:
+                parse = datetime.fromisoformat if isinstance(column.type, DateTime) else date.fromisoformat
+                value = parse(value)
+            except ValueError:
+                return None
+        converted.append(value)
+    return converted
+
+
+class Page:
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def keyset_page(query, columns, limit, after=None, before=None, descending=False, strict=False):
+    """Return one page of ``query`` ordered by ``columns`` using seek pagination.
+
+    ``columns`` must end with a unique column (normally the primary key) so the
+    ordering is total. ``after``/``before`` are cursors produced by a previous
+    page; the seek predicate lets the database jump straight to the page via an
+    index on the same columns instead of scanning past an OFFSET. A cursor
+    that does not fit ``columns`` is ignored, or with ``strict`` raises
+    :class:`InvalidCursor`.
+    """
+    key = tuple_(*columns)
+    after_values = _from_cursor(columns, decode_cursor(after))
+    before_values = _from_cursor(columns, decode_cursor(before))
+    if strict:
+        for name, cursor, values in (('after', after, after_values), ('before', before, before_values)):
+            if cursor and values is None:
+                raise InvalidCursor(f"Invalid {name} cursor")
+
+    # Walking backwards means flipping both the comparison and the order,
+    # then reversing the fetched rows back into display order.
+    backwards = before_values is not None and after_values is None
+    reverse_order = descending != backwards
+    if after_values is not None:
+        bound = tuple_(*after_values)
+        query = query.filter(key < bound if descending else key > bound)
+    elif backwards:
+        bound = tuple_(*before_values)
+        query = query.filter(key > bound if descending else key < bound)
+
+    order = [c.desc() if reverse_order else c.asc() for c in columns]
+    rows = query.order_by(*order).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    def cursor_for(row):
+        return encode_cursor(getattr(row, c.key) for c in columns)
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if backwards:
+            next_cursor = cursor_for(rows[-1])
+            prev_cursor = cursor_for(rows[0]) if has_more else None
+        else:
+            next_cursor = cursor_for(rows[-1]) if has_more else None
+            prev_cursor = cursor_for(rows[0]) if after_values is not None else None
+    return Page(rows, next_cursor, prev_cursor)
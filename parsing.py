@@ -0,0 +1,34 @@
+"""Lenient parsing of submitted values, shared by the web forms and bulk import.
+
+Blank or malformed input becomes ``None`` rather than an error, matching
+what an empty form field means.
+"""
+from datetime import date, datetime
+
+
+def safe_date(date_string):
+    if date_string:
+        try:
+            if len(date_string) == 10 and date_string[4] == '-' and date_string[7] == '-':
+                # Zero-padded input (the usual case) skips strptime's much slower parser.
+                return date.fromisoformat(date_string)
+            return datetime.strptime(date_string, '%Y-%m-%d').date()
+        except ValueError:
+            return None
+    return None
+
+def safe_float(float_string):
+    if float_string:
+        try:
+            return float(float_string)
+        except ValueError:
+            return None
+    return None
+
+def safe_int(int_string):
+    if int_string:
+        try:
+            return int(int_string)
+        except ValueError:
+            return None
+    return None
@@ -0,0 +1,99 @@
+from sqlalchemy import or_, select
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from database import db_session
+import changes
+from models import Project, File, STAGES
+
+# Ids bound per statement, keeping IN lists well under SQLite's bound-parameter limit.
+CHUNK_SIZE = 500
+
+
+def chunks(ids, size=CHUNK_SIZE):
+    """``ids`` deduplicated and sorted, in lists of at most ``size``."""
+    ids = sorted(set(ids))
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def insert_from(table, query):
+    """``INSERT INTO table ... SELECT`` filling the columns ``query``'s labels name."""
+    return table.insert().from_select([c.name for c in query.selected_columns], query)
+
+
+def executemany(bind, table, keys, rows):
+    """Multi-row INSERT of ``rows`` (tuples ordered like ``keys``).
+
+    Goes straight to the driver's executemany: SQLAlchemy's per-row parameter
+    handling costs more than SQLite's insert itself at bulk volumes, so the
+    values must already be ones the driver takes. ``bind`` may be a session,
+    whose connection is used.
+    """
+    conn = bind if hasattr(bind, 'exec_driver_sql') else bind.connection()
+    compiled = table.insert().compile(dialect=conn.dialect, column_keys=keys)
+    if not compiled.positional:
+        rows = [dict(zip(keys, row)) for row in rows]
+    elif list(compiled.positiontup) != keys:
+        order = [keys.index(name) for name in compiled.positiontup]
+        rows = [tuple(row[i] for i in order) for row in rows]
+    conn.exec_driver_sql(str(compiled), rows)
+
+
+def load_project_aggregate(project_id, stage_names=None):
+    """Load a project with all of its stage records and their files.
+
+    The project and its 13 one-to-one stages come back in a single joined
+    SELECT and every attachment in a second one, so the whole aggregate costs
+    two queries no matter how many stages or files it has. The ``files``
+    collections are populated in place so later access never lazy-loads.
+    ``stage_names`` limits the stages (and files) loaded; others lazy-load
+    if touched.
+    """
+    names = [name for name, _ in STAGES if stage_names is None or name in stage_names]
+    options = [joinedload(getattr(Project, name)) for name in names]
+    project = Project.query.options(*options).filter(Project.id == project_id).one_or_none()
+    if project is None:
+        return None
+
+    stages = [(name, getattr(project, name)) for name in names]
+    stages = [(name, stage) for name, stage in stages if stage is not None]
+    files_by_stage = {name: [] for name, _ in stages}
+    if stages:
+        clauses = [getattr(File, name + '_id') == stage.id for name, stage in stages]
+        for file in File.query.filter(or_(*clauses)).order_by(File.id):
+            for name, stage in stages:
+                if getattr(file, name + '_id') == stage.id:
+                    files_by_stage[name].append(file)
+    for name, stage in stages:
+        set_committed_value(stage, 'files', files_by_stage[name])
+    return project
+
+
+def delete_projects(project_ids):
+    """Delete projects with their stage records and attachment rows.
+
+    ``project_ids`` is a list of ids or a SELECT of ids. The work is a fixed
+    set of ``DELETE ... WHERE ... IN (...)`` statements -- one for files, one
+    per stage table and one for projects -- per :data:`CHUNK_SIZE` listed ids.
+    A SELECT stays a subquery in those statements, so it takes one set
+    however many projects it matches; its ids are only fetched to report
+    them to :mod:`changes`.
+    Returns the number of projects deleted and the attachment paths, which
+    the caller should remove from disk only after committing.
+    """
+    if isinstance(project_ids, (list, tuple, set)):
+        changes.mark(db_session, project_ids)
+        selections = chunks(project_ids)
+    else:
+        changes.mark(db_session, db_session.execute(project_ids).scalars())
+        selections = [project_ids]
+    deleted, paths = 0, []
+    for selection in selections:
+        stage_ids = {name: select(model.id).where(model.project_id.in_(selection)) for name, model in STAGES}
+        file_filter = or_(*[getattr(File, name + '_id').in_(ids) for name, ids in stage_ids.items()])
+        paths += [path for (path,) in db_session.query(File.file_path).filter(file_filter)]
+        db_session.query(File).filter(file_filter).delete(synchronize_session=False)
+        for name, model in STAGES:
+            db_session.query(model).filter(model.project_id.in_(selection)).delete(synchronize_session=False)
+        deleted += db_session.query(Project).filter(Project.id.in_(selection)).delete(synchronize_session=False)
+    return deleted, paths
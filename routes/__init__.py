@@ -0,0 +1,59 @@
+"""Versioned JSON API, one blueprint per resource.
+
+Every blueprint here lives under :data:`API_PREFIX` and answers errors with
+``{"error": message}`` (plus ``problems`` for validation failures) instead
+of the HTML pages the rest of the app renders.
+"""
+from datetime import date, datetime
+from flask import jsonify, request
+from werkzeug.exceptions import HTTPException, BadRequest
+from pagination import InvalidCursor
+from stages import ValidationError, StaleEditError
+
+API_PREFIX = '/api/v1'
+
+
+def to_json(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def json_body():
+    """The request's JSON object, or a 400."""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise BadRequest('Expected a JSON object body')
+    return body
+
+
+def error(status, message, **extra):
+    return jsonify(dict(error=message, **extra)), status
+
+
+def error_for(e):
+    """``(status, payload)`` for the exceptions the API reports, else None."""
+    if isinstance(e, HTTPException):
+        return e.code, {'error': e.description}
+    if isinstance(e, ValidationError):
+        return 422, {'error': 'Validation failed', 'problems': e.problems}
+    if isinstance(e, StaleEditError):
+        return 409, {'error': str(e)}
+    if isinstance(e, InvalidCursor):
+        return 400, {'error': str(e)}
+    return None
+
+
+def json_errors(blueprint):
+    # The app's own 400 handler is matched by status code, ahead of any
+    # class-based handler, so 400 is registered here explicitly.
+    @blueprint.errorhandler(400)
+    @blueprint.errorhandler(HTTPException)
+    @blueprint.errorhandler(ValidationError)
+    @blueprint.errorhandler(StaleEditError)
+    @blueprint.errorhandler(InvalidCursor)
+    def api_error(e):
+        status, payload = error_for(e)
+        return jsonify(payload), status
+
+    return blueprint
@@ -0,0 +1,392 @@
+"""Attachment endpoints of the JSON API.
+
+Uploads are multipart (``files`` field, repeatable) and handled like form
+uploads: spooled during the request, recorded as ``pending`` and moved into
+the content store on the background queue, so the response is ``202``.
+
+Large files can instead be sent in chunks, resumably and in parallel, in the
+manner of tus:
+
+1. ``POST .../stages/<stage>/uploads`` with ``{"filename", "length",
+   "sha256"}`` (the whole file's hex digest) reserves the file and returns
+   the upload's ``url``;
+2. ``PATCH <url>`` sends one chunk as ``application/offset+octet-stream``
+   with ``Upload-Offset`` and ``Upload-Checksum: sha256 <base64 digest>``
+   headers -- chunks may arrive in any order, concurrently, and be resent;
+3. ``GET <url>`` lists the ``missing`` byte ranges, for resuming;
+4. ``POST <url>/complete`` checks the whole file against its ``sha256`` and
+   turns it into a ``pending`` File row (``202``), like a multipart upload.
+   Repeating it is harmless.
+
+Each chunk is streamed straight to its place in the preallocated spool file,
+so neither the chunk nor the file is ever held in memory. Its range is
+claimed before a byte is written: a chunk that overlaps bytes already
+received, or being received by another request, is refused (``409``) unless
+it is an exact resend of a received one, so a bad resend can never overwrite
+verified bytes. On a whole-file mismatch the chunks whose bytes no longer
+match their checksums are dropped and listed as ``missing`` again. A chunk
+arriving for an upload that expired meanwhile gets ``410``.
+"""
+import base64
+import binascii
+import re
+import secrets
+import time
+from datetime import datetime
+from flask import Blueprint, current_app, jsonify, request, url_for, abort
+from sqlalchemy import or_, select
+from database import db_session
+from models import Project, File, ChunkedUpload, UploadChunk, STAGES
+from storage import StoredFile, remove_unreferenced
+from uploads import (STORED, allowed_file, spool_uploads, discard_spooled, remove_spooled, queue_uploads,
+                     missing_ranges)
+import stages
+import tasks
+from routes import API_PREFIX, error, json_body, json_errors, to_json
+
+bp = json_errors(Blueprint('api_attachments', __name__, url_prefix=API_PREFIX))
+
+STAGE_NAMES = [name for name, _ in STAGES]
+FILE_FIELDS = ('id', 'filename', 'file_type', 'size', 'sha256', 'status', 'upload_date')
+CHUNK_MIMETYPE = 'application/offset+octet-stream'
+SHA256_HEX = re.compile(r'[0-9a-f]{64}')
+
+
+def file_document(file):
+    document = {field: to_json(getattr(file, field)) for field in FILE_FIELDS}
+    document['stage'] = next((name for name in STAGE_NAMES if getattr(file, name + '_id') is not None), None)
+    document['url'] = url_for('api_attachments.get_attachment', file_id=file.id)
+    document['download_url'] = url_for('file_download', file_id=file.id) if file.status == STORED else None
+    return document
+
+
+def _stage_or_404(name):
+    for stage in stages.STAGES:
+        if stage.name == name:
+            return stage
+    abort(404, description=f"Unknown stage {name!r}")
+
+
+def _stage_record(project, stage):
+    record = getattr(project, stage.name)
+    if record is None:
+        record = stage.model()
+        setattr(project, stage.name, record)
+    return record
+
+
+@bp.route('/projects/<int:project_id>/attachments')
+def list_attachments(project_id):
+    names = request.args.getlist('stage') or STAGE_NAMES
+    unknown = set(names) - set(STAGE_NAMES)
+    if unknown:
+        abort(400, description=f"Unknown stage {', '.join(sorted(unknown))}")
+    if db_session.get(Project, project_id) is None:
+        abort(404, description="Project not found")
+    clauses = [
+        getattr(File, name + '_id').in_(select(model.id).where(model.project_id == project_id))
+        for name, model in STAGES if name in names
+    ]
+    files = File.query.filter(or_(*clauses)).order_by(File.id)
+    return jsonify({'items': [file_document(file) for file in files]})
+
+
+@bp.route('/projects/<int:project_id>/stages/<stage_name>/attachments', methods=['POST'])
+def upload_attachments(project_id, stage_name):
+    stage = _stage_or_404(stage_name)
+    project = db_session.get(Project, project_id)
+    if project is None:
+        abort(404, description="Project not found")
+    spooled = spool_uploads(request.files, current_app.extensions['content_store'], allowed_file, {'files'})
+    uploads = spooled.get('files', [])
+    if not uploads:
+        abort(400, description="Send one or more allowed files in the 'files' field")
+    try:
+        files = stages.build_files(uploads)
+        _stage_record(project, stage).files.extend(files)
+        db_session.flush()
+        file_ids = [file.id for file in files]
+        documents = [file_document(file) for file in files]
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        discard_spooled({'files': uploads})
+        raise
+    queue_uploads(current_app.extensions['content_store'], file_ids)
+    return jsonify({'items': documents}), 202
+
+
+@bp.route('/attachments/<int:file_id>')
+def get_attachment(file_id):
+    file = db_session.get(File, file_id)
+    if file is None:
+        abort(404, description="Attachment not found")
+    return jsonify(file_document(file))
+
+
+@bp.route('/attachments/<int:file_id>', methods=['DELETE'])
+def delete_attachment(file_id):
+    file = db_session.get(File, file_id)
+    if file is None:
+        abort(404, description="Attachment not found")
+    path = file.file_path
+    db_session.delete(file)
+    db_session.commit()
+    tasks.submit(remove_unreferenced, [path], time.time())
+    return '', 204
+
+
+def _chunks(upload_id):
+    """The chunks received and verified so far; claimed ones still being written are missing."""
+    return db_session.query(UploadChunk.start, UploadChunk.length).filter(
+        UploadChunk.upload_id == upload_id, UploadChunk.claimed_at.is_(None)).all()
+
+
+def upload_document(upload, chunks=None):
+    document = {
+        'id': upload.id,
+        'project_id': upload.project_id,
+        'stage': upload.stage,
+        'filename': upload.filename,
+        'length': upload.length,
+        'sha256': upload.sha256,
+        'created_at': to_json(upload.created_at),
+        'url': url_for('api_attachments.get_upload', upload_id=upload.id),
+        'file': None,
+    }
+    if upload.file_id is None:
+        chunks = _chunks(upload.id) if chunks is None else chunks
+        document['missing'] = missing_ranges(chunks, upload.length)
+    else:
+        document['missing'] = []
+        file = db_session.get(File, upload.file_id)
+        document['file'] = file_document(file) if file is not None else None
+    return document
+
+
+def _upload_or_404(upload_id):
+    upload = db_session.get(ChunkedUpload, upload_id)
+    if upload is None:
+        abort(404, description="Upload not found")
+    return upload
+
+
+def _checksum():
+    """The hex SHA-256 from an ``Upload-Checksum: sha256 <base64>`` header, or a 400."""
+    algorithm, _, value = request.headers.get('Upload-Checksum', '').partition(' ')
+    if algorithm.lower() != 'sha256':
+        abort(400, description="Send the chunk's checksum as 'Upload-Checksum: sha256 <base64 digest>'")
+    try:
+        digest = base64.b64decode(value.strip(), validate=True)
+    except (binascii.Error, ValueError):
+        digest = b''
+    if len(digest) != 32:
+        abort(400, description="Malformed Upload-Checksum digest")
+    return digest.hex()
+
+
+@bp.route('/projects/<int:project_id>/stages/<stage_name>/uploads', methods=['POST'])
+def create_upload(project_id, stage_name):
+    stage = _stage_or_404(stage_name)
+    if db_session.get(Project, project_id) is None:
+        abort(404, description="Project not found")
+    body = json_body()
+    filename, length, sha256 = body.get('filename'), body.get('length'), body.get('sha256')
+    if not isinstance(filename, str) or not allowed_file(filename):
+        abort(400, description="'filename' must name a file of an allowed type")
+    if not isinstance(length, int) or isinstance(length, bool) or length < 0:
+        abort(400, description="'length' must be the file size in bytes")
+    if not isinstance(sha256, str) or not SHA256_HEX.fullmatch(sha256.lower()):
+        abort(400, description="'sha256' must be the file's SHA-256 as 64 hex digits")
+    if length > current_app.config['CHUNKED_UPLOAD_MAX_BYTES']:
+        abort(413, description=f"Uploads are limited to {current_app.config['CHUNKED_UPLOAD_MAX_BYTES']} bytes")
+    spool_path = current_app.extensions['content_store'].allocate(length)
+    upload = ChunkedUpload(id=secrets.token_hex(16), project_id=project_id, stage=stage.name, filename=filename,
+                           length=length, sha256=sha256.lower(), spool_path=spool_path,
+                           created_at=datetime.utcnow())
+    try:
+        db_session.add(upload)
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        remove_spooled([spool_path])
+        raise
+    response = jsonify(upload_document(upload, []))
+    response.status_code = 201
+    response.headers['Location'] = response.json['url']
+    return response
+
+
+@bp.route('/uploads/<upload_id>')
+def get_upload(upload_id):
+    return jsonify(upload_document(_upload_or_404(upload_id)))
+
+
+@bp.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    upload = _upload_or_404(upload_id)
+    if upload.file_id is not None:
+        return error(409, "Upload already completed")
+    if request.mimetype != CHUNK_MIMETYPE:
+        abort(415, description=f"Send chunks as {CHUNK_MIMETYPE}")
+    start = request.headers.get('Upload-Offset', type=int)
+    length = request.content_length
+    if length is None:
+        abort(411, description="Chunks need a Content-Length")
+    if start is None or start < 0 or start + length > upload.length:
+        abort(400, description=f"Upload-Offset plus the chunk length must lie within the {upload.length} byte file")
+    expected = _checksum()
+    claimed_at = datetime.utcnow()
+    try:
+        # A no-op write on the upload's row first: it holds that row (on SQLite,
+        # the database) until commit, so two requests cannot both find a range free.
+        if not ChunkedUpload.query.filter(ChunkedUpload.id == upload_id).update(
+                {ChunkedUpload.id: ChunkedUpload.id}, synchronize_session=False):
+            abort(404, description="Upload not found")
+        # Claims whose writer died free their range again.
+        UploadChunk.query.filter(
+            UploadChunk.upload_id == upload_id,
+            UploadChunk.claimed_at < claimed_at - current_app.config['CHUNK_CLAIM_TIMEOUT'],
+        ).delete(synchronize_session=False)
+        received = db_session.query(
+            UploadChunk.start, UploadChunk.length, UploadChunk.sha256, UploadChunk.claimed_at
+        ).filter(UploadChunk.upload_id == upload_id, UploadChunk.start < start + length,
+                 UploadChunk.start + UploadChunk.length > start).all()
+        if not received:
+            db_session.add(UploadChunk(upload_id=upload_id, start=start, length=length, sha256=expected,
+                                       claimed_at=claimed_at))
+        spool_path = upload.spool_path
+        # Commits the claim, and releases the connection while the body streams in.
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    if received:
+        if [tuple(chunk) for chunk in received] == [(start, length, expected, None)]:
+            # A resend of a chunk already received: nothing to write.
+            return jsonify(upload_document(upload))
+        return error(409, "Chunk overlaps bytes already received or being received",
+                     missing=missing_ranges(_chunks(upload_id), upload.length))
+
+    try:
+        digest, written = current_app.extensions['content_store'].write_at(spool_path, start, request.stream, length)
+    except Exception as e:
+        _release_claim(upload_id, start, claimed_at)
+        if isinstance(e, FileNotFoundError) and db_session.get(ChunkedUpload, upload_id) is None:
+            # Expired, and its spool file removed, before the chunk arrived.
+            abort(410, description="Upload expired")
+        raise
+    if written != length or digest != expected:
+        # Only this claim's bytes were written; they stay missing until a resend matches.
+        _release_claim(upload_id, start, claimed_at)
+        if written != length:
+            abort(400, description=f"Chunk ended after {written} of {length} bytes")
+        return error(460, "Checksum mismatch")
+    try:
+        verified = UploadChunk.query.filter(
+            UploadChunk.upload_id == upload_id, UploadChunk.start == start, UploadChunk.claimed_at == claimed_at,
+        ).update({UploadChunk.claimed_at: None}, synchronize_session=False)
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    upload = db_session.get(ChunkedUpload, upload_id)
+    if upload is None:
+        abort(410, description="Upload expired")
+    if not verified:
+        # Held so long that the claim was taken for abandoned and the range handed out again.
+        return error(409, "Chunk took too long; send it again",
+                     missing=missing_ranges(_chunks(upload_id), upload.length))
+    return jsonify(upload_document(upload))
+
+
+def _release_claim(upload_id, start, claimed_at):
+    try:
+        UploadChunk.query.filter(
+            UploadChunk.upload_id == upload_id, UploadChunk.start == start, UploadChunk.claimed_at == claimed_at,
+        ).delete(synchronize_session=False)
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+
+
+def _verify(upload):
+    """Whether the spooled file matches the upload's ``sha256``; if not, drop the chunks that are to blame.
+
+    Those are the chunks whose bytes no longer match their own checksums --
+    or, when all of them do, every chunk, since the file is then simply not
+    the one the digest was declared for.
+    """
+    store = current_app.extensions['content_store']
+    upload_id, spool_path, expected = upload.id, upload.spool_path, upload.sha256
+    chunks = db_session.query(UploadChunk.start, UploadChunk.length, UploadChunk.sha256).filter(
+        UploadChunk.upload_id == upload_id, UploadChunk.claimed_at.is_(None)).all()
+    # Release the connection while the file is read.
+    db_session.rollback()
+    if store.digest(spool_path) == expected:
+        return True
+    damaged = [start for start, length, sha256 in chunks if store.digest(spool_path, start, length) != sha256]
+    query = UploadChunk.query.filter(UploadChunk.upload_id == upload_id, UploadChunk.claimed_at.is_(None))
+    if damaged:
+        query = query.filter(UploadChunk.start.in_(damaged))
+    try:
+        query.delete(synchronize_session=False)
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    return False
+
+
+@bp.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    upload = _upload_or_404(upload_id)
+    if upload.file_id is not None:
+        return jsonify(upload_document(upload))
+    chunks = _chunks(upload_id)
+    missing = missing_ranges(chunks, upload.length)
+    if missing:
+        return error(409, "Upload is incomplete", missing=missing)
+    if upload.sha256 is None:
+        return error(409, "Upload has no whole-file checksum; start a new upload")
+    if not _verify(upload):
+        return error(460, "Checksum mismatch", missing=missing_ranges(_chunks(upload_id), upload.length))
+    project = db_session.get(Project, upload.project_id)
+    if project is None:
+        abort(404, description="Project not found")
+    stage = _stage_or_404(upload.stage)
+    try:
+        # _verify has just matched the whole file against upload.sha256.
+        spooled = StoredFile(upload.sha256, upload.length, upload.spool_path)
+        file, = stages.build_files([(upload.filename, spooled)])
+        _stage_record(project, stage).files.append(file)
+        db_session.flush()
+        # Only one finalize may claim the upload; a concurrent one finds it taken.
+        claimed = (ChunkedUpload.query.filter(ChunkedUpload.id == upload_id, ChunkedUpload.file_id.is_(None))
+                   .update({ChunkedUpload.file_id: file.id}, synchronize_session=False))
+        if not claimed:
+            db_session.rollback()
+            return jsonify(upload_document(_upload_or_404(upload_id)))
+        UploadChunk.query.filter_by(upload_id=upload_id).delete(synchronize_session=False)
+        file_id = file.id
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    queue_uploads(current_app.extensions['content_store'], [file_id])
+    db_session.expire(upload)
+    return jsonify(upload_document(upload)), 202
+
+
+@bp.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    upload = _upload_or_404(upload_id)
+    if upload.file_id is not None:
+        return error(409, "Upload already completed; delete its attachment instead")
+    spool_path = upload.spool_path
+    UploadChunk.query.filter_by(upload_id=upload_id).delete(synchronize_session=False)
+    db_session.delete(upload)
+    db_session.commit()
+    remove_spooled([spool_path])
+    return '', 204
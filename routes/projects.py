@@ -0,0 +1,298 @@
+"""Project endpoints of the JSON API.
+
+A project document has the ``Project`` columns at the top level, each stage
+as an object under its name (``null`` when the stage has no row) and the
+stage's attachments under ``files``::
+
+    {"id": 1, "revision": 3, "project_name": "...", ...,
+     "design": {"id": 7, "cost": 120.0, "artist": "...", "files": [...]}, ...}
+
+``GET`` takes ``fields`` -- a comma-separated list of project columns,
+stage names and ``stage.column`` entries -- to return (and load) only those;
+``id`` and ``revision`` are always included.
+Writes take the same shape; updates must carry the ``revision`` they were
+made against and get ``409`` if the project has moved on since.
+"""
+import time
+from datetime import date, timedelta
+from flask import Blueprint, current_app, jsonify, request, url_for, abort
+from database import db_session
+from models import Project, ProjectSummary
+from pagination import keyset_page, requested_limit
+from parsing import safe_int
+from queries import load_project_aggregate, delete_projects
+from storage import remove_unreferenced
+from cache import cached_page, project_key, ALL_PROJECTS
+import stages
+import summary
+import tasks
+import transitions
+from routes import API_PREFIX, error, error_for, json_body, json_errors, to_json
+from routes.attachments import file_document
+
+bp = json_errors(Blueprint('api_projects', __name__, url_prefix=API_PREFIX + '/projects'))
+
+PROJECT_ATTRS = [field.attr for field in stages.PROJECT_FIELDS]
+STAGE_ATTRS = {stage.name: ['id'] + [field.attr for field in stage.fields] for stage in stages.STAGES}
+LIST_FIELDS = ('project_id', 'project_name', 'creator_name', 'current_stage', 'last_contact_date',
+               'last_response_date', 'total_spend', 'revenue', 'gross_margin', 'attachment_count')
+
+
+def parse_fieldset(value):
+    """``fields`` as ``(project columns, {stage name: columns})``; None selects everything."""
+    if not value:
+        return None
+    project, selected = [], {}
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        name, _, column = entry.partition('.')
+        if name in STAGE_ATTRS and not column:
+            selected[name] = STAGE_ATTRS[name] + ['files']
+        elif name in STAGE_ATTRS and (column in STAGE_ATTRS[name] or column == 'files'):
+            columns = selected.setdefault(name, ['id'])
+            if column not in columns:
+                columns.append(column)
+        elif name in PROJECT_ATTRS and not column:
+            project.append(name)
+        elif name in ('id', 'revision') and not column:
+            continue
+        else:
+            abort(400, description=f"Unknown field {entry!r}")
+    return project, selected
+
+
+def project_document(project, fieldset=None):
+    project_attrs, selected = fieldset or (PROJECT_ATTRS, {name: attrs + ['files'] for name, attrs in STAGE_ATTRS.items()})
+    document = {'id': project.id, 'revision': project.revision}
+    document.update((attr, to_json(getattr(project, attr))) for attr in project_attrs)
+    for name, attrs in selected.items():
+        record = getattr(project, name)
+        if record is None:
+            document[name] = None
+            continue
+        document[name] = {
+            attr: [file_document(file) for file in record.files] if attr == 'files' else to_json(getattr(record, attr))
+            for attr in attrs
+        }
+    return document
+
+
+def _project_or_404(project_id, stage_names=None):
+    project = load_project_aggregate(project_id, stage_names)
+    if project is None:
+        abort(404, description="Project not found")
+    return project
+
+
+@bp.route('')
+@cached_page(lambda: [ALL_PROJECTS])
+def list_projects():
+    query = ProjectSummary.query
+    stage = request.args.get('stage')
+    if stage:
+        if stage not in Project.current_stage.type.enums:
+            abort(400, description=f"Unknown stage {stage!r}")
+        query = query.filter(ProjectSummary.current_stage == stage)
+    creator = request.args.get('creator', '').strip()
+    if creator:
+        query = query.filter(ProjectSummary.creator_name == creator)
+    sort = request.args.get('sort', 'id')
+    columns = summary.SORTS.get(sort.lstrip('-'))
+    if columns is None:
+        abort(400, description=f"Unknown sort {sort!r}; use one of {', '.join(summary.SORTS)}")
+    page = keyset_page(query, columns, requested_limit(), after=request.args.get('after'),
+                       before=request.args.get('before'), descending=sort.startswith('-'), strict=True)
+    return jsonify({
+        'items': [{field: to_json(getattr(row, field)) for field in LIST_FIELDS} for row in page.items],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+    })
+
+
+@bp.route('/follow-ups')
+@cached_page(lambda: [ALL_PROJECTS], vary=lambda: date.today().isoformat())
+def follow_ups():
+    """Projects whose client is waiting on a reply, longest wait first.
+
+    Served from the ``awaiting_response_since`` index on ``project_summary``,
+    so a page costs the same however many projects there are. ``breached=1``
+    keeps only waits longer than ``FOLLOW_UP_SLA_DAYS``.
+    """
+    sla_days = current_app.config['FOLLOW_UP_SLA_DAYS']
+    today = date.today()
+    query = ProjectSummary.query.filter(ProjectSummary.awaiting_response_since.isnot(None))
+    if request.args.get('breached') in ('1', 'true'):
+        query = query.filter(ProjectSummary.awaiting_response_since < today - timedelta(days=sla_days))
+    page = keyset_page(query, (ProjectSummary.awaiting_response_since, ProjectSummary.project_id), requested_limit(),
+                       after=request.args.get('after'), before=request.args.get('before'), strict=True)
+    items = []
+    for row in page.items:
+        waiting_days = (today - row.awaiting_response_since).days
+        items.append({
+            'project_id': row.project_id,
+            'project_name': row.project_name,
+            'creator_name': row.creator_name,
+            'current_stage': row.current_stage,
+            'last_contact_date': to_json(row.last_contact_date),
+            'last_response_date': to_json(row.last_response_date),
+            'awaiting_response_since': to_json(row.awaiting_response_since),
+            'waiting_days': waiting_days,
+            'sla_breached': waiting_days > sla_days,
+        })
+    return jsonify({'items': items, 'sla_days': sla_days,
+                    'next_cursor': page.next_cursor, 'prev_cursor': page.prev_cursor})
+
+
+@bp.route('/<int:project_id>')
+@cached_page(lambda project_id: [project_key(project_id)])
+def get_project(project_id):
+    fieldset = parse_fieldset(request.args.get('fields'))
+    project = _project_or_404(project_id, None if fieldset is None else set(fieldset[1]))
+    return jsonify(project_document(project, fieldset))
+
+
+@bp.route('/<int:project_id>/transitions')
+@cached_page(lambda project_id: [project_key(project_id)])
+def project_transitions(project_id):
+    """The project's stage history, oldest first; kept after the project is deleted."""
+    rows = transitions.history(project_id)
+    if not rows:
+        abort(404)
+    return jsonify({'items': [{key: to_json(value) for key, value in row._mapping.items() if key != 'project_id'}
+                              for row in rows]})
+
+
+def _create(document):
+    project, _ = stages.create_parsed(db_session, *stages.parse_document(document), {})
+    db_session.flush()
+    return project.id
+
+
+def _revision(value):
+    if isinstance(value, bool):
+        return None
+    return value if isinstance(value, int) else safe_int(value if isinstance(value, str) else None)
+
+
+def _update(project_id, document):
+    """Apply ``document`` to a project; returns ``(project, changed)``."""
+    project_values, stage_values = stages.parse_document(document, partial=True)
+    project = _project_or_404(project_id, [name for name, values in stage_values.items() if values])
+    changed, _ = stages.update_parsed(db_session, project, project_values, stage_values, {},
+                               _revision(document.get('revision')))
+    return project, changed
+
+
+@bp.route('', methods=['POST'])
+def create_project():
+    try:
+        project_id = _create(json_body())
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    response = jsonify(project_document(_project_or_404(project_id)))
+    response.status_code = 201
+    response.headers['Location'] = url_for('api_projects.get_project', project_id=project_id)
+    return response
+
+
+@bp.route('/<int:project_id>', methods=['PATCH'])
+def update_project(project_id):
+    try:
+        _update(project_id, json_body())
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    return jsonify(project_document(_project_or_404(project_id)))
+
+
+@bp.route('/<int:project_id>/stages/<stage_name>', methods=['PATCH'])
+def update_stage(project_id, stage_name):
+    if stage_name not in STAGE_ATTRS:
+        abort(404, description=f"Unknown stage {stage_name!r}")
+    body = json_body()
+    revision = body.pop('revision', None)
+    try:
+        _update(project_id, {stage_name: body, 'revision': revision})
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    fieldset = ([], {stage_name: STAGE_ATTRS[stage_name] + ['files']})
+    return jsonify(project_document(_project_or_404(project_id, [stage_name]), fieldset))
+
+
+@bp.route('/<int:project_id>', methods=['DELETE'])
+def delete_project(project_id):
+    try:
+        deleted, paths = delete_projects([project_id])
+        if not deleted:
+            abort(404, description="Project not found")
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    tasks.submit(remove_unreferenced, paths, time.time())
+    return '', 204
+
+
+def _run_operation(operation):
+    if not isinstance(operation, dict):
+        raise stages.ValidationError(['expected an object'])
+    op = operation.get('op')
+    if op == 'create':
+        return {'op': op, 'id': _create(operation.get('data')), 'revision': 0}
+    project_id = operation.get('id')
+    if not isinstance(project_id, int) or isinstance(project_id, bool):
+        raise stages.ValidationError(['id must be an integer'])
+    if op == 'update':
+        data = operation.get('data')
+        if not isinstance(data, dict):
+            raise stages.ValidationError(['data must be an object'])
+        project, changed = _update(project_id, dict(data, revision=operation.get('revision')))
+        return {'op': op, 'id': project_id, 'revision': project.revision, 'changed': changed}
+    if op == 'delete':
+        deleted, paths = delete_projects([project_id])
+        if not deleted:
+            abort(404, description=f"Project {project_id} not found")
+        return {'op': op, 'id': project_id, 'paths': paths}
+    raise stages.ValidationError([f"op must be create, update or delete, not {op!r}"])
+
+
+@bp.route('/batch', methods=['POST'])
+def batch():
+    """Run ``{"operations": [...]}`` in one transaction: all of them or none.
+
+    Each operation is ``{"op": "create", "data": {...}}``,
+    ``{"op": "update", "id": 1, "revision": 3, "data": {...}}`` or
+    ``{"op": "delete", "id": 1}``. The first failure rolls everything back
+    and is reported with its ``index``.
+    """
+    operations = json_body().get('operations')
+    limit = current_app.config['API_BATCH_MAX_OPERATIONS']
+    if not isinstance(operations, list) or not operations:
+        abort(400, description="operations must be a non-empty list")
+    if len(operations) > limit:
+        abort(400, description=f"At most {limit} operations per batch")
+    results, paths = [], []
+    for index, operation in enumerate(operations):
+        try:
+            result = _run_operation(operation)
+        except Exception as e:
+            db_session.rollback()
+            failure = error_for(e)
+            if failure is None:
+                raise
+            status, payload = failure
+            return error(status, payload.pop('error'), index=index, **payload)
+        paths.extend(result.pop('paths', []))
+        results.append(result)
+    try:
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    if paths:
+        tasks.submit(remove_unreferenced, paths, time.time())
+    return jsonify({'results': results})
@@ -0,0 +1,213 @@
+"""Full-text search over projects with SQLite FTS5.
+
+``project_search`` holds one document per project (``rowid`` = project id)
+with the project and creator names, the stage ``artist`` columns, the
+freight type and the names of the project's attachments. Like
+``project_summary`` it is rewritten for the projects a transaction touched
+before that transaction commits (see :mod:`changes`), so results never lag
+behind the data. Results are ordered by FTS5's ``rank`` (bm25, with the
+project name weighted highest) and paged with keyset cursors.
+
+Scoring costs about a microsecond per matching document, so a query
+matching more than :data:`RANK_LIMIT` projects (a file extension, a
+two-letter prefix) is not scored at all: it is listed newest first straight
+off the index, which FTS5 can stop reading after one page.
+
+Other databases, and SQLite builds without FTS5, simply have no search:
+:func:`available` is false and the index is never written.
+
+Run ``python search.py rebuild`` to rebuild the index from scratch.
+"""
+import argparse
+import logging
+import sys
+from sqlalchemy import DDL, bindparam, column, event, func, literal, select, table, text
+from database import Base, db_session, engine
+from models import Project, ProjectSummary, File, Freight, STAGES
+from pagination import keyset_page
+from uploads import FAILED
+from queries import chunks, insert_from
+import changes
+
+# Above this many matches, results are listed newest first instead of ranked.
+RANK_LIMIT = 5000
+
+DOCUMENT_COLUMNS = ('project_name', 'creator_name', 'artists', 'freight_type', 'filenames')
+# bm25 weights, in DOCUMENT_COLUMNS order.
+WEIGHTS = (10.0, 5.0, 2.0, 2.0, 1.0)
+
+project_search = table('project_search', column('rowid'), column('rank'), *map(column, DOCUMENT_COLUMNS))
+
+_CREATE = DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS project_search USING fts5("
+    + ', '.join(DOCUMENT_COLUMNS)
+    + ", tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+_SET_RANK = DDL(
+    "INSERT INTO project_search (project_search, rank) VALUES ('rank', 'bm25(%s)')"
+    % ', '.join(map(str, WEIGHTS))
+)
+
+_fts5 = []
+
+
+def available():
+    """Whether the configured database can hold the search index."""
+    if not _fts5:
+        supported = engine.dialect.name == 'sqlite'
+        if supported:
+            with engine.connect() as conn:
+                supported = 'ENABLE_FTS5' in conn.exec_driver_sql('PRAGMA compile_options').scalars().all()
+        _fts5.append(supported)
+    return _fts5[0]
+
+
+def _create(target, bind, **kw):
+    if available():
+        bind.execute(_CREATE)
+        bind.execute(_SET_RANK)
+
+
+# create_all knows nothing about virtual tables; add ours alongside it.
+event.listen(Base.metadata, 'after_create', _create)
+
+
+def _joined(parts):
+    expression = func.coalesce(parts[0], '')
+    for part in parts[1:]:
+        expression = expression + literal(' ') + func.coalesce(part, '')
+    return expression
+
+
+def document_select(where=None):
+    """SELECT producing ``project_search`` rows for the projects matching ``where``."""
+    projects = Project.__table__
+    files = File.__table__
+    source = projects
+    filenames = []
+    for name, model in STAGES:
+        stage = model.__table__
+        source = source.outerjoin(stage, stage.c.project_id == projects.c.id)
+        filenames.append(
+            select(func.group_concat(files.c.filename, ' '))
+            .where(files.c[name + '_id'] == stage.c.id, files.c.status != FAILED)
+            .scalar_subquery()
+        )
+    artists = [model.__table__.c.artist for _, model in STAGES if 'artist' in model.__table__.c]
+    query = select(
+        projects.c.id.label('rowid'),
+        projects.c.project_name,
+        projects.c.creator_name,
+        _joined(artists).label('artists'),
+        Freight.__table__.c.freight_type,
+        _joined(filenames).label('filenames'),
+    ).select_from(source)
+    if where is not None:
+        query = query.where(where)
+    return query
+
+
+# Built once: the document SELECT joins every stage table and is costly to construct.
+_DELETE_DOCUMENTS = project_search.delete().where(project_search.c.rowid.in_(bindparam('ids', expanding=True)))
+_INSERT_DOCUMENTS = insert_from(
+    project_search, document_select(Project.__table__.c.id.in_(bindparam('ids', expanding=True))))
+
+
+def refresh(bind, project_ids):
+    """Rewrite the search documents of ``project_ids``; deleted projects drop out."""
+    if not available():
+        return
+    for chunk in chunks(project_ids):
+        bind.execute(_DELETE_DOCUMENTS, {'ids': chunk})
+        bind.execute(_INSERT_DOCUMENTS, {'ids': chunk})
+
+
+@changes.before_commit
+def _reindex_touched(session, project_ids):
+    refresh(session, project_ids)
+
+
+def rebuild(bind):
+    """Replace every search document; returns the number of projects indexed."""
+    if not available():
+        return 0
+    _create(None, bind)
+    bind.execute(project_search.delete())
+    bind.execute(insert_from(project_search, document_select()))
+    bind.exec_driver_sql("INSERT INTO project_search (project_search) VALUES ('optimize')")
+    return bind.execute(select(func.count()).select_from(Project.__table__)).scalar()
+
+
+def match_expression(terms):
+    """Turn free text into an FTS5 query: every word must match, the last as a prefix.
+
+    Words are quoted, so FTS5 operators and punctuation in user input are
+    searched for literally instead of raising a syntax error. Returns None
+    when there is nothing to search for.
+    """
+    words = [word.replace('"', '""') for word in terms.split()]
+    words = [word for word in words if word.strip('"')]
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def search(terms, limit, after=None, before=None):
+    """One page of projects matching ``terms``, or None if there is nothing to search for.
+
+    Items carry the dashboard's ``project_summary`` columns plus ``rank``.
+    ``page.ranked`` is false when the query matched more than
+    :data:`RANK_LIMIT` projects and the page is in newest-first order.
+    """
+    expression = match_expression(terms)
+    if expression is None:
+        return None
+    match = text('project_search MATCH :expression').bindparams(expression=expression)
+    matches = db_session.execute(
+        select(func.count()).select_from(select(project_search.c.rowid).where(match).limit(RANK_LIMIT + 1).subquery())
+    ).scalar()
+    ranked = matches <= RANK_LIMIT
+    query = (
+        db_session.query(
+            project_search.c.rowid,
+            project_search.c.rank,
+            ProjectSummary.project_id,
+            ProjectSummary.project_name,
+            ProjectSummary.creator_name,
+            ProjectSummary.current_stage,
+            ProjectSummary.total_spend,
+            ProjectSummary.last_contact_date,
+            ProjectSummary.attachment_count,
+        )
+        .select_from(project_search)
+        .join(ProjectSummary, ProjectSummary.project_id == project_search.c.rowid)
+        .filter(match)
+    )
+    if ranked:
+        page = keyset_page(query, (project_search.c.rank, project_search.c.rowid), limit, after=after, before=before)
+    else:
+        page = keyset_page(query, (project_search.c.rowid,), limit, after=after, before=before, descending=True)
+    page.ranked = ranked
+    return page
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('rebuild', help='reindex every project')
+    args = parser.parse_args(argv)
+
+    from database import init_db
+    init_db()
+    if not available():
+        print("This database has no FTS5 support")
+        return 1
+    with engine.begin() as conn:
+        if args.command == 'rebuild':
+            print(f"Indexed {rebuild(conn)} projects")
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,319 @@
+"""Form handling for a project and its stages, driven by the model columns.
+
+Every editable column of ``Project`` and of each model in ``models.STAGES``
+becomes a :class:`Field` with its form key and parser worked out once at
+import. Form keys are ``<stage>_<column>`` unless the model sets
+``__form_prefix__`` or the column carries ``info={'form_field': ...}``;
+columns marked ``info={'editable': False}`` are left out. Uploads for a
+stage arrive as ``<stage>_files``. Creating and editing a project are then
+the same loop over :data:`STAGES` instead of one hand-written block per
+stage.
+
+Edits are diffed against the loaded aggregate and only changed columns are
+written. Each edit carries the project's ``revision``; an edit made against
+an older revision raises :class:`StaleEditError` rather than overwriting
+someone else's changes.
+"""
+import re
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import Date, Enum, Float, Integer, String, update
+from sqlalchemy.orm.attributes import set_committed_value
+from werkzeug.utils import secure_filename
+from models import Project, File, STAGES as STAGE_MODELS
+from parsing import safe_date, safe_float, safe_int
+from uploads import PENDING
+import changes
+
+Field = namedtuple('Field', 'key attr parse required enums length')
+Stage = namedtuple('Stage', 'name model fields files_key')
+
+
+_PROBLEM_FIELD = re.compile(r'([\w.]+)(?::| is required)')
+
+
+class ValidationError(ValueError):
+    def __init__(self, problems):
+        super().__init__('; '.join(problems))
+        self.problems = problems
+
+    @property
+    def fields(self):
+        """The keys the problems are about, without the submitted values the problems quote."""
+        return sorted({match.group(1) for match in map(_PROBLEM_FIELD.match, self.problems) if match})
+
+
+class StaleEditError(Exception):
+    """The project was edited by someone else after this edit's revision."""
+
+
+def _text(value):
+    return value or None
+
+
+def parser_for(column):
+    """The ``safe_*`` parser matching a column's type; text passes through, blank as None."""
+    if isinstance(column.type, Date):
+        return safe_date
+    if isinstance(column.type, Float):
+        return safe_float
+    if isinstance(column.type, Integer):
+        return safe_int
+    return _text
+
+
+def _fields(model, prefix):
+    fields = []
+    for column in model.__table__.columns:
+        if column.primary_key or column.foreign_keys or not column.info.get('editable', True):
+            continue
+        fields.append(Field(
+            key=column.info.get('form_field', prefix + column.name),
+            attr=column.key,
+            parse=parser_for(column),
+            required=not column.nullable,
+            enums=column.type.enums if isinstance(column.type, Enum) else None,
+            length=column.type.length if isinstance(column.type, String) else None,
+        ))
+    return tuple(fields)
+
+
+PROJECT_FIELDS = _fields(Project, '')
+STAGES = tuple(
+    Stage(name, model, _fields(model, getattr(model, '__form_prefix__', name + '_')), name + '_files')
+    for name, model in STAGE_MODELS
+)
+# The upload fields the project form's attachments arrive in.
+FILES_KEYS = frozenset(stage.files_key for stage in STAGES)
+
+
+def _parse(form, fields, partial, problems):
+    values = {}
+    for key, attr, parse, required, enums, length in fields:
+        raw = form.get(key)
+        if raw is None and partial:
+            continue
+        value = parse(raw) if raw else None
+        if value is None:
+            if raw:
+                problems.append(f"{key}: cannot parse {raw!r}")
+            elif required:
+                problems.append(f"{key} is required")
+        elif enums is not None and value not in enums:
+            problems.append(f"{key}: {value!r} is not one of {', '.join(enums)}")
+        elif length and len(value) > length:
+            problems.append(f"{key}: longer than {length} characters")
+        values[attr] = value
+    return values
+
+
+def parse_form(form, partial=False):
+    """Parse a submitted form into ``(project values, {stage name: values})``.
+
+    With ``partial`` only the keys present in ``form`` are returned, so an
+    edit leaves fields the client did not send untouched. Raises
+    :class:`ValidationError` listing every problem.
+    """
+    problems = []
+    project = _parse(form, PROJECT_FIELDS, partial, problems)
+    stages = {stage.name: _parse(form, stage.fields, partial, problems) for stage in STAGES}
+    if problems:
+        raise ValidationError(problems)
+    return project, stages
+
+
+def _json_fields(fields, prefix=''):
+    return tuple(field._replace(key=prefix + field.attr) for field in fields)
+
+
+PROJECT_JSON_FIELDS = _json_fields(PROJECT_FIELDS)
+STAGE_JSON_FIELDS = {stage.name: _json_fields(stage.fields, stage.name + '.') for stage in STAGES}
+# Present in documents the API returns, so a fetched document can be sent back.
+READ_ONLY_KEYS = frozenset(('id', 'revision', 'files'))
+
+
+def _flatten(document, prefix, problems, known):
+    """JSON scalars as the strings the form parsers take; null becomes blank."""
+    flat = {}
+    for key, value in document.items():
+        if key in READ_ONLY_KEYS:
+            continue
+        if prefix + key not in known:
+            problems.append(f"{prefix}{key}: unknown field")
+        elif value is None:
+            flat[prefix + key] = ''
+        elif isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            problems.append(f"{prefix}{key}: expected a string or number")
+        else:
+            flat[prefix + key] = value if isinstance(value, str) else repr(value)
+    return flat
+
+
+def parse_document(document, partial=False):
+    """Parse a JSON object into ``(project values, {stage name: values})``.
+
+    Project columns are top-level keys; each stage is an object under its
+    name, e.g. ``{"project_name": ..., "design": {"artist": ...}}``. ``null``
+    clears a value. Field names are reported as ``design.artist``. With
+    ``partial`` absent keys and absent stages are left out.
+    """
+    if not isinstance(document, dict):
+        raise ValidationError(['expected a JSON object'])
+    problems = []
+    known = {field.key for field in PROJECT_JSON_FIELDS}
+    stage_documents = {}
+    for name in STAGE_JSON_FIELDS:
+        stage_document = document.get(name)
+        if stage_document is None:
+            continue
+        if not isinstance(stage_document, dict):
+            problems.append(f"{name}: expected an object")
+            continue
+        stage_documents[name] = stage_document
+    flat = _flatten({k: v for k, v in document.items() if k not in STAGE_JSON_FIELDS}, '', problems, known)
+    for name, stage_document in stage_documents.items():
+        flat.update(_flatten(stage_document, name + '.', problems, {f.key for f in STAGE_JSON_FIELDS[name]}))
+    project = _parse(flat, PROJECT_JSON_FIELDS, partial, problems)
+    stages = {name: _parse(flat, fields, partial, problems) for name, fields in STAGE_JSON_FIELDS.items()}
+    if problems:
+        raise ValidationError(problems)
+    return project, stages
+
+
+def apply(obj, values):
+    for attr, value in values.items():
+        setattr(obj, attr, value)
+
+
+def build_files(spooled_files, **parent):
+    """Pending File rows for ``(filename, StoredFile)`` spooled uploads, keyed to a stage by ``parent``.
+
+    ``parent`` is the stage foreign key, e.g. ``design_id=...``.
+    """
+    now = datetime.now()
+    return [
+        File(
+            filename=secure_filename(original_filename),
+            file_path=spooled.path,
+            sha256=spooled.sha256,
+            size=spooled.size,
+            status=PENDING,
+            upload_date=now,
+            file_type=original_filename.rsplit('.', 1)[1].lower(),
+            **parent,
+        )
+        for original_filename, spooled in spooled_files
+    ]
+
+
+def create_project(session, form, spooled):
+    """Add the project described by a submitted form; returns ``(project, new files)``."""
+    return create_parsed(session, *parse_form(form), spooled)
+
+
+def create_parsed(session, project_values, stage_values, spooled):
+    """Add a project from parsed values with its uploads; returns ``(project, new files)``.
+
+    Only stages with a value or an upload get a row. Stage rows are plain
+    INSERTs after the project is flushed: a new project has nothing for the
+    unit of work to reconcile, and its thirteen one-to-one relationships
+    cost more to sort than the rows cost to write.
+    """
+    project = Project(**project_values)
+    session.add(project)
+    session.flush()
+    files = []
+    for stage in STAGES:
+        values = _with_data(stage_values.get(stage.name, {}))
+        if not values and stage.files_key not in spooled:
+            continue
+        result = session.execute(stage.model.__table__.insert(), dict(values, project_id=project.id))
+        if stage.files_key in spooled:
+            files.extend(build_files(spooled[stage.files_key],
+                                     **{stage.name + '_id': result.inserted_primary_key[0]}))
+    session.add_all(files)
+    return project, files
+
+
+def _with_data(values):
+    return {attr: value for attr, value in values.items() if value is not None}
+
+
+def _changed(obj, values):
+    return {attr: value for attr, value in values.items() if getattr(obj, attr) != value}
+
+
+def diff(project, project_values, stage_values, spooled):
+    """What parsed edit values change on a loaded project aggregate.
+
+    Returns ``(project changes, {stage name: changes})`` holding only the
+    columns whose value differs. A stage without a row appears only if there
+    is a value or an upload for it; stages with neither are not looked at,
+    so they need not be loaded.
+    """
+    stage_changes = {}
+    for stage in STAGES:
+        values = stage_values.get(stage.name)
+        if not values and stage.files_key not in spooled:
+            continue
+        record = getattr(project, stage.name)
+        values = _with_data(values or {}) if record is None else _changed(record, values or {})
+        if values or stage.files_key in spooled:
+            stage_changes[stage.name] = values
+    return _changed(project, project_values), stage_changes
+
+
+def claim_revision(session, project, revision, values=None):
+    """Move ``project`` past ``revision``, writing ``values`` in the same UPDATE.
+
+    Raises :class:`StaleEditError` when the stored revision is no longer
+    ``revision``.
+    """
+    values = dict(values or {})
+    claimed = session.execute(
+        update(Project)
+        .where(Project.id == project.id, Project.revision == revision)
+        .values(revision=Project.revision + 1, **values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        raise StaleEditError(f"Project {project.id} has changed since revision {revision}")
+    values['revision'] = revision + 1
+    for attr, value in values.items():
+        set_committed_value(project, attr, value)
+    changes.mark(session, [project.id])
+
+
+def update_project(session, project, form, spooled, revision):
+    """Apply an edit form to a loaded project aggregate; see :func:`update_parsed`."""
+    return update_parsed(session, project, *parse_form(form, partial=True), spooled, revision)
+
+
+def update_parsed(session, project, project_values, stage_values, spooled, revision):
+    """Apply parsed edit values to a loaded project aggregate made at ``revision``.
+
+    Only changed columns are written, and only stages with changes or new
+    uploads are touched; an edit that changes nothing writes nothing.
+    Returns ``(changed, new files)``.
+    """
+    if revision is None:
+        raise ValidationError(['revision is required'])
+    project_changes, stage_changes = diff(project, project_values, stage_values, spooled)
+    if not project_changes and not stage_changes:
+        return False, []
+    claim_revision(session, project, revision, project_changes)
+    files = []
+    for stage in STAGES:
+        if stage.name not in stage_changes:
+            continue
+        record = getattr(project, stage.name)
+        if record is None:
+            record = stage.model()
+            setattr(project, stage.name, record)
+        apply(record, stage_changes[stage.name])
+        if stage.files_key in spooled:
+            # Untouched collections are never loaded.
+            new_files = build_files(spooled[stage.files_key])
+            record.files.extend(new_files)
+            files.extend(new_files)
+    return True, files
@@ -0,0 +1,205 @@
+"""Content-addressed storage for uploaded attachments.
+
+Uploads are streamed to a temporary file in fixed-size chunks, hashed as
+they are written, then moved to ``<root>/<h0h1>/<h2h3>/<sha256>``. Identical content is stored once
+no matter how many ``File`` rows point at it.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class StoredFile:
+    def __init__(self, sha256, size, path):
+        self.sha256 = sha256
+        self.size = size
+        self.path = path
+
+
+class ContentStore:
+    def __init__(self, root, chunk_size=CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def _temp_file(self):
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        return tempfile.mkstemp(dir=tmp_dir)
+
+    def spool(self, stream):
+        """Copy ``stream`` to a temporary file inside the store, hashing it on the way.
+
+        Returns a :class:`StoredFile` for the temporary file, whose digest and
+        size can go straight to :meth:`save_spooled`.
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        fd, tmp_path = self._temp_file()
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return StoredFile(hasher.hexdigest(), size, tmp_path)
+
+    def allocate(self, size):
+        """A temporary file of ``size`` bytes for :meth:`write_at`; returns its path.
+
+        Once filled it is handed to :meth:`save_spooled` like a spooled upload.
+        """
+        fd, tmp_path = self._temp_file()
+        try:
+            os.ftruncate(fd, size)
+        except BaseException:
+            os.close(fd)
+            os.remove(tmp_path)
+            raise
+        os.close(fd)
+        return tmp_path
+
+    def write_at(self, tmp_path, offset, stream, length):
+        """Copy ``length`` bytes of ``stream`` into ``tmp_path`` at ``offset``.
+
+        Positional writes on a private descriptor, so several chunks of one
+        file can be written at once. Returns ``(sha256 hex digest, bytes
+        written)``; fewer bytes than ``length`` means the stream ended early.
+        """
+        hasher = hashlib.sha256()
+        written = 0
+        fd = os.open(tmp_path, os.O_WRONLY)
+        try:
+            while written < length:
+                chunk = stream.read(min(self.chunk_size, length - written))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                view, position = memoryview(chunk), offset + written
+                while view:
+                    count = os.pwrite(fd, view, position)
+                    view, position = view[count:], position + count
+                written += len(chunk)
+        finally:
+            os.close(fd)
+        return hasher.hexdigest(), written
+
+    def digest(self, path, start=0, length=None):
+        """Hex SHA-256 of ``length`` bytes of ``path`` from ``start`` (default: to the end)."""
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as source:
+            source.seek(start)
+            remaining = length
+            while remaining is None or remaining > 0:
+                chunk = source.read(self.chunk_size if remaining is None else min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+        return hasher.hexdigest()
+
+    def save(self, stream):
+        spooled = self.spool(stream)
+        return self.save_spooled(spooled.path, spooled.sha256, spooled.size)
+
+    def save_spooled(self, tmp_path, sha256=None, size=None):
+        """Move a temporary file into the store.
+
+        ``sha256`` is the file's digest when the caller already has it (from
+        :meth:`spool`, or a verified chunked upload); otherwise the file is
+        read once to hash it. If the temporary file is gone but content with
+        that digest and size is already stored, an earlier attempt got as far
+        as moving it in (and its worker died before recording so); that copy
+        is returned.
+        """
+        if sha256 is not None and not os.path.exists(tmp_path):
+            final_path = self.path_for(sha256)
+            try:
+                stored_size = os.path.getsize(final_path)
+            except FileNotFoundError:
+                stored_size = None
+            if stored_size is not None and (size is None or stored_size == size):
+                return StoredFile(sha256, stored_size, final_path)
+        if sha256 is None:
+            hasher = hashlib.sha256()
+            size = 0
+            with open(tmp_path, 'rb') as source:
+                for chunk in iter(lambda: source.read(self.chunk_size), b''):
+                    hasher.update(chunk)
+                    size += len(chunk)
+            sha256 = hasher.hexdigest()
+        elif size is None:
+            size = os.path.getsize(tmp_path)
+        return self._commit(tmp_path, sha256, size)
+
+    def adopt(self, path):
+        """Hash a file kept outside the store and add it to the store.
+
+        The file is hard-linked in where possible and copied otherwise; the
+        original is left in place for the caller to remove once nothing
+        refers to it.
+        """
+        fd, tmp_path = self._temp_file()
+        os.close(fd)
+        os.remove(tmp_path)
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        return self.save_spooled(tmp_path)
+
+    def _commit(self, tmp_path, digest, size):
+        final_path = self.path_for(digest)
+        if os.path.exists(final_path):
+            # Already stored: drop the new copy and refresh the mtime so a
+            # concurrent cleanup of the old references leaves it alone.
+            os.remove(tmp_path)
+            os.utime(final_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+        return StoredFile(digest, size, final_path)
+
+
+def remove_unreferenced(paths, released_at=None):
+    """Delete stored files that no ``File`` row points at any more.
+
+    Runs on the background queue after the rows were deleted; files touched
+    since ``released_at`` were re-used by a new upload and are kept.
+    """
+    from database import db_session
+    from models import File
+
+    released_at = released_at or time.time()
+    paths = set(paths)
+    try:
+        if paths:
+            referenced = {path for (path,) in db_session.query(File.file_path).filter(File.file_path.in_(paths))}
+            paths -= referenced
+    finally:
+        db_session.remove()
+    for path in paths:
+        try:
+            if os.path.getmtime(path) > released_at:
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Could not remove %s: %s", path, e)
@@ -0,0 +1,226 @@
+"""The ``project_summary`` table: one denormalized row per project.
+
+Dashboard and analytics columns that would otherwise join all thirteen stage
+tables and ``files`` -- spend, revenue, margin, attachment count, contact
+dates -- are precomputed here. Rows for the projects a transaction touched
+are recomputed inside that transaction (see :mod:`changes`), so the table is
+never behind the data it summarizes.
+
+Run ``python summary.py rebuild`` to backfill it from scratch and
+``python summary.py check`` to compare it with the source tables.
+"""
+import argparse
+import logging
+import math
+import sys
+from datetime import datetime
+from sqlalchemy import and_, case, func, literal, null, or_, select
+from database import engine
+from models import Project, ProjectSummary, File, Launch, Shipping, STAGES
+from analytics import COST_STAGES, money
+from uploads import FAILED
+from queries import chunks, insert_from
+import changes
+
+project_summary = ProjectSummary.__table__
+
+CHECK_BATCH = 5000
+# Consecutive ids refreshed with one range statement rather than an IN list.
+MIN_RANGE = 50
+
+# Sort keys for project listings. Each ends with the primary key so the
+# ordering is total, and each matches one of the composite indexes on ``project_summary``.
+SORTS = {
+    'id': (ProjectSummary.project_id,),
+    'name': (ProjectSummary.project_name, ProjectSummary.project_id),
+    'creator': (ProjectSummary.creator_name, ProjectSummary.project_name, ProjectSummary.project_id),
+}
+
+COMPARED = ('project_name', 'creator_name', 'current_stage', 'last_contact_date', 'last_response_date',
+            'awaiting_response_since', 'total_spend', 'units_sold', 'revenue', 'commission', 'shipping_cost', 'gross_margin',
+            'attachment_count')
+
+
+def awaiting_response_since(projects):
+    """The date a client has been waiting on us since, or NULL.
+
+    That is the latest contact when nothing was sent after it -- a reply on
+    the same day counts as answered. Cancelled projects are never waiting.
+    """
+    contact = func.coalesce(projects.c.last_contact_date, projects.c.first_contact_date)
+    response = func.coalesce(projects.c.last_response_date, projects.c.first_response_date)
+    return case(
+        (projects.c.current_stage == 'CANCELLED', null()),
+        (and_(contact.isnot(None), or_(response.is_(None), contact > response)), contact),
+        else_=null(),
+    )
+
+
+def summary_select(where=None):
+    """SELECT producing ``project_summary`` rows for the projects matching ``where``."""
+    projects = Project.__table__
+    files = File.__table__
+    source = projects
+    spend = literal(0.0)
+    attachments = literal(0)
+    for name, model in STAGES:
+        stage = model.__table__
+        source = source.outerjoin(stage, stage.c.project_id == projects.c.id)
+        if (name, model) in COST_STAGES:
+            spend = spend + money(stage.c.cost)
+        attachments = attachments + (
+            select(func.count(files.c.id))
+            .where(files.c[name + '_id'] == stage.c.id, files.c.status != FAILED)
+            .scalar_subquery()
+        )
+    launch, shipping = Launch.__table__, Shipping.__table__
+    revenue = money(launch.c.cash_collected)
+    commission = money(launch.c.commission_paid)
+    units_sold = func.coalesce(launch.c.units_sold, 0)
+    shipping_cost = money(shipping.c.avg_cost) * units_sold
+    query = select(
+        projects.c.id.label('project_id'),
+        projects.c.project_name,
+        projects.c.creator_name,
+        projects.c.current_stage,
+        projects.c.last_contact_date,
+        projects.c.last_response_date,
+        awaiting_response_since(projects).label('awaiting_response_since'),
+        spend.label('total_spend'),
+        units_sold.label('units_sold'),
+        revenue.label('revenue'),
+        commission.label('commission'),
+        shipping_cost.label('shipping_cost'),
+        (revenue - spend - commission - shipping_cost).label('gross_margin'),
+        attachments.label('attachment_count'),
+        literal(datetime.utcnow().replace(microsecond=0), type_=project_summary.c.updated_at.type).label('updated_at'),
+    ).select_from(source)
+    if where is not None:
+        query = query.where(where)
+    return query
+
+
+def refresh(bind, project_ids):
+    """Recompute the summary rows of ``project_ids``; rows of deleted projects are dropped.
+
+    Long runs of consecutive ids (a bulk import) are refreshed by id range,
+    which SQLite plans as one index range scan instead of repeated probes.
+    """
+    scattered = []
+    for run in _consecutive_runs(sorted(set(project_ids))):
+        if len(run) >= MIN_RANGE:
+            refresh_range(bind, run[0], run[-1])
+        else:
+            scattered.extend(run)
+    for chunk in chunks(scattered):
+        bind.execute(project_summary.delete().where(project_summary.c.project_id.in_(chunk)))
+        bind.execute(insert_from(project_summary, summary_select(Project.__table__.c.id.in_(chunk))))
+
+
+def _consecutive_runs(ids):
+    run = []
+    for project_id in ids:
+        if run and project_id != run[-1] + 1:
+            yield run
+            run = []
+        run.append(project_id)
+    if run:
+        yield run
+
+
+def refresh_range(bind, low, high):
+    """Recompute the summary rows of every project id in ``[low, high]``."""
+    bind.execute(project_summary.delete().where(project_summary.c.project_id.between(low, high)))
+    bind.execute(insert_from(project_summary, summary_select(Project.__table__.c.id.between(low, high))))
+
+
+@changes.before_commit
+def _refresh_touched(session, project_ids):
+    refresh(session, project_ids)
+
+
+def rebuild(bind):
+    """Replace every summary row; returns the number of rows written."""
+    bind.execute(project_summary.delete())
+    bind.execute(insert_from(project_summary, summary_select()))
+    return bind.execute(select(func.count()).select_from(project_summary)).scalar()
+
+
+def _same(expected, stored):
+    for column in COMPARED:
+        a, b = expected[column], stored[column]
+        if isinstance(a, float) or isinstance(b, float):
+            if a is None or b is None or not math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6):
+                return False
+        elif a != b:
+            return False
+    return True
+
+
+def check(bind):
+    """Compare the summary with the source tables.
+
+    Returns ``(missing, stale, orphaned)`` project id lists. Works through
+    id ranges so neither side is held in memory at once.
+    """
+    missing, stale, orphaned = [], [], []
+    highest = max(
+        bind.execute(select(func.max(Project.id))).scalar() or 0,
+        bind.execute(select(func.max(project_summary.c.project_id))).scalar() or 0,
+    )
+    projects = Project.__table__
+    for low in range(0, highest + 1, CHECK_BATCH):
+        high = low + CHECK_BATCH
+        expected = {
+            row.project_id: row._mapping
+            for row in bind.execute(summary_select(and_(projects.c.id >= low, projects.c.id < high)))
+        }
+        stored = {
+            row.project_id: row._mapping
+            for row in bind.execute(
+                select(project_summary)
+                .where(project_summary.c.project_id >= low, project_summary.c.project_id < high)
+            )
+        }
+        for project_id, row in expected.items():
+            if project_id not in stored:
+                missing.append(project_id)
+            elif not _same(row, stored[project_id]):
+                stale.append(project_id)
+        orphaned.extend(sorted(set(stored) - set(expected)))
+    return missing, stale, orphaned
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('rebuild', help='recompute every summary row')
+    check_parser = commands.add_parser('check', help='report rows that disagree with the source tables')
+    check_parser.add_argument('--repair', action='store_true', help='recompute the rows that disagree')
+    args = parser.parse_args(argv)
+
+    from database import init_db
+    init_db()
+    with engine.begin() as conn:
+        if args.command == 'rebuild':
+            print(f"Rebuilt {rebuild(conn)} summary rows")
+            return 0
+        missing, stale, orphaned = check(conn)
+        for label, ids in (('missing', missing), ('stale', stale), ('orphaned', orphaned)):
+            if ids:
+                shown = ', '.join(map(str, ids[:20])) + (' ...' if len(ids) > 20 else '')
+                print(f"{len(ids)} {label}: {shown}")
+        bad = missing + stale + orphaned
+        if not bad:
+            print("Summary is consistent")
+            return 0
+        if args.repair:
+            refresh(conn, bad)
+            print(f"Repaired {len(bad)} rows")
+            return 0
+        return 1
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
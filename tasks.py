@@ -0,0 +1,66 @@
+"""Small in-process background queue for work that should not block a request."""
+import atexit
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def _new_executor():
+    return ThreadPoolExecutor(max_workers=int(os.environ.get('BACKGROUND_WORKERS', 2)),
+                              thread_name_prefix='background')
+
+
+_executor = _new_executor()
+
+
+def _after_fork():
+    # Worker threads do not survive fork; a forked worker starts its own pool.
+    global _executor
+    _executor = _new_executor()
+
+
+def _shutdown():
+    _executor.shutdown(wait=True)
+
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(_shutdown)
+
+
+def _log_failure(future):
+    exc = future.exception()
+    if exc is not None:
+        logger.error("Background task failed: %s", exc, exc_info=exc)
+
+
+def submit(fn, *args, **kwargs):
+    future = _executor.submit(fn, *args, **kwargs)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def every(interval, fn, *args, **kwargs):
+    """Submit ``fn`` now and again every ``interval`` seconds for the life of the process.
+
+    Timer threads do not survive fork either, so call this in each worker.
+    Returns an event that stops the repetition when set.
+    """
+    stopped = threading.Event()
+
+    def run():
+        if stopped.is_set():
+            return
+        try:
+            submit(fn, *args, **kwargs)
+        except RuntimeError:
+            # The queue has shut down with the process.
+            return
+        timer = threading.Timer(interval, run)
+        timer.daemon = True
+        timer.start()
+
+    run()
+    return stopped
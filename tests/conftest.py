@@ -0,0 +1,83 @@
+"""Shared fixtures: the app against a throwaway SQLite database.
+
+The engine is built when :mod:`database` is imported, so the database URL
+and upload folder are pointed at a temporary directory before anything from
+the app is imported.
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+_TMP = tempfile.mkdtemp(prefix='project-tracker-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_TMP, 'test.db')}"
+os.environ.setdefault('LOG_LEVELS', 'WARNING')
+
+
+@pytest.fixture(scope='session')
+def app():
+    import app as application
+    application.app.config['TESTING'] = True
+    application.content_store.root = application.app.config['UPLOAD_FOLDER'] = os.path.join(_TMP, 'uploads')
+    application.create_app(warm=False)
+    return application.app
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    # The first request of a process runs the worker start-up; keep it out of the tests.
+    client.get('/project/0/edit')
+    return client
+
+
+@pytest.fixture
+def db_session(app):
+    from database import db_session
+    yield db_session
+    db_session.remove()
+
+
+@pytest.fixture
+def count_statements(app):
+    """``with count_statements() as statements:`` collects the SQL run inside the block."""
+    from database import engine
+
+    @contextmanager
+    def counting():
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+    return counting
+
+
+@pytest.fixture
+def make_project(db_session):
+    """Create a project through the API's parser; stage values go under the stage name."""
+    import stages
+
+    def make(**document):
+        document.setdefault('project_name', 'Test project')
+        document.setdefault('creator_name', 'Test creator')
+        document.setdefault('current_stage', 'DESIGN')
+        project, _ = stages.create_parsed(db_session, *stages.parse_document(document), {})
+        db_session.commit()
+        project_id = project.id
+        db_session.remove()
+        return project_id
+
+    return make
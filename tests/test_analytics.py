@@ -0,0 +1,51 @@
+import pytest
+
+import analytics
+from models import ProjectSummary
+
+FIGURES = dict(design={'cost': 100.0, 'start_date': '2024-01-01', 'end_date': '2024-01-11'},
+               modeling={'cost': 50.0},
+               launch={'units_sold': 10, 'cash_collected': 1000.0, 'commission_paid': 80.0},
+               shipping={'avg_cost': 2.5})
+
+
+def test_project_rollup(db_session, make_project):
+    project_id = make_project(**FIGURES)
+    empty_id = make_project()
+    rows = {row.project_id: row for row in analytics.project_rollup_query().filter(
+        ProjectSummary.project_id.in_([project_id, empty_id]))}
+    row = rows[project_id]
+    assert (row.spend, row.revenue, row.shipping) == (150.0, 1000.0, 25.0)
+    assert row.gross_margin == 1000.0 - 150.0 - 80.0 - 25.0
+    # Nothing recorded counts as zero.
+    assert (rows[empty_id].spend, rows[empty_id].revenue, rows[empty_id].gross_margin) == (0.0, 0.0, 0.0)
+
+
+def test_portfolio_totals_and_durations_add_up(db_session, make_project):
+    totals, durations = analytics.portfolio_totals(), analytics.stage_duration_stats()
+    make_project(**FIGURES)
+    after, durations_after = analytics.portfolio_totals(), analytics.stage_duration_stats()
+
+    assert after['projects'] - totals['projects'] == 1
+    for key, added in (('spend', 150.0), ('revenue', 1000.0), ('commission', 80.0), ('shipping', 25.0),
+                       ('gross_margin', 745.0), ('units_sold', 10)):
+        assert after[key] - totals[key] == pytest.approx(added)
+    assert after['spend_by_stage']['design'] - totals['spend_by_stage']['design'] == pytest.approx(100.0)
+    assert after['gross_margin_pct'] == pytest.approx(after['gross_margin'] / after['revenue'])
+    count = durations['design']['count'] if durations['design'] else 0
+    assert durations_after['design']['count'] == count + 1
+
+
+def test_histogram_percentiles_are_nearest_rank():
+    # 1 day x3, 5 days x6, 30 days x1.
+    stats = analytics.histogram_stats([(1, 3), (5, 6), (30, 1)], (0.3, 0.5, 0.95))
+    assert stats == {'count': 10, 'mean': 6.3, 'p30': 1, 'p50': 5, 'p95': 30}
+
+
+def test_analytics_report(client, make_project):
+    make_project(**FIGURES)
+    response = client.get('/analytics.json')
+    assert response.status_code == 200
+    report = response.get_json()
+    assert {'portfolio', 'stage_durations', 'funnel', 'time_in_stage', 'projects'} <= set(report)
+    assert report['portfolio']['projects'] >= 1
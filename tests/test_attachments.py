@@ -0,0 +1,144 @@
+import base64
+import hashlib
+import os
+
+import pytest
+
+CONTENT = os.urandom(3 * 1024)
+CHUNKS = [(0, CONTENT[:1024]), (1024, CONTENT[1024:2048]), (2048, CONTENT[2048:])]
+
+
+@pytest.fixture
+def start_upload(client, make_project):
+    project_id = make_project()
+
+    def start(sha256=hashlib.sha256(CONTENT).hexdigest()):
+        response = client.post(f'/api/v1/projects/{project_id}/stages/prototype/uploads',
+                               json={'filename': 'model.pdf', 'length': len(CONTENT), 'sha256': sha256})
+        assert response.status_code == 201
+        return response.get_json()['url']
+
+    return start
+
+
+def send(client, url, start, data):
+    digest = base64.b64encode(hashlib.sha256(data).digest()).decode()
+    return client.patch(url, data=data, headers={'Content-Type': 'application/offset+octet-stream',
+                                                 'Upload-Offset': str(start), 'Upload-Checksum': f'sha256 {digest}'})
+
+
+def spool_path(url):
+    from database import db_session
+    from models import ChunkedUpload
+    try:
+        return db_session.get(ChunkedUpload, url.rsplit('/', 1)[1]).spool_path
+    finally:
+        db_session.remove()
+
+
+def test_whole_file_checksum_is_required(client, make_project):
+    project_id = make_project()
+    response = client.post(f'/api/v1/projects/{project_id}/stages/prototype/uploads',
+                           json={'filename': 'model.pdf', 'length': 10})
+    assert response.status_code == 400
+
+
+def test_resend_cannot_overwrite_received_bytes(client, start_upload):
+    url = start_upload()
+    for start, data in CHUNKS:
+        assert send(client, url, start, data).status_code == 200
+    assert send(client, url, 1024, CHUNKS[1][1]).status_code == 200
+    assert send(client, url, 1024, b'x' * 1024).status_code == 409
+    assert send(client, url, 512, CONTENT[512:1536]).status_code == 409
+
+    assert client.post(url + '/complete').status_code == 202
+
+
+def test_complete_drops_chunks_damaged_on_disk(client, start_upload):
+    url = start_upload()
+    for start, data in CHUNKS:
+        send(client, url, start, data)
+    with open(spool_path(url), 'r+b') as spool:
+        spool.seek(1500)
+        spool.write(b'\0')
+
+    response = client.post(url + '/complete')
+    assert response.status_code == 460
+    assert response.get_json()['missing'] == [[1024, 2048]]
+    assert send(client, url, 1024, CHUNKS[1][1]).status_code == 200
+    assert client.post(url + '/complete').status_code == 202
+
+
+def test_complete_rejects_file_not_matching_declared_checksum(client, start_upload):
+    url = start_upload(hashlib.sha256(b'something else').hexdigest())
+    for start, data in CHUNKS:
+        send(client, url, start, data)
+
+    response = client.post(url + '/complete')
+    assert response.status_code == 460
+    assert response.get_json()['missing'] == [[0, len(CONTENT)]]
+
+
+def test_parts_other_than_files_are_not_spooled(app, client, make_project):
+    from io import BytesIO
+    project_id = make_project(prototype={'cost': 1.0})
+    spool = os.path.join(app.config['UPLOAD_FOLDER'], 'tmp')
+    before = set(os.listdir(spool)) if os.path.isdir(spool) else set()
+    response = client.post(f'/api/v1/projects/{project_id}/stages/prototype/attachments',
+                           data={'notes': (BytesIO(b'not an attachment'), 'notes.txt')})
+    assert response.status_code == 400
+    assert (set(os.listdir(spool)) if os.path.isdir(spool) else set()) == before
+
+
+def _claim(url, start, length, claimed_at):
+    from database import engine
+    from models import UploadChunk
+    with engine.begin() as conn:
+        conn.execute(UploadChunk.__table__.insert().values(
+            upload_id=url.rsplit('/', 1)[1], start=start, length=length, sha256='0' * 64, claimed_at=claimed_at))
+
+
+def test_chunk_overlapping_one_being_written_is_refused(client, start_upload):
+    from datetime import datetime, timedelta
+    url = start_upload()
+    _claim(url, 0, 1024, datetime.utcnow())
+    assert send(client, url, 512, CONTENT[512:1536]).status_code == 409
+    assert send(client, url, 0, CHUNKS[0][1]).status_code == 409
+    for start, data in CHUNKS[1:]:
+        assert send(client, url, start, data).status_code == 200
+    # The claimed range is still missing until its writer is done.
+    assert client.get(url).get_json()['missing'] == [[0, 1024]]
+    assert client.post(url + '/complete').status_code == 409
+
+    url = start_upload()
+    _claim(url, 0, 1024, datetime.utcnow() - timedelta(hours=1))
+    # An abandoned claim frees its range again.
+    assert send(client, url, 0, CHUNKS[0][1]).status_code == 200
+
+
+@pytest.mark.parametrize('when', ['before', 'after'])
+def test_chunk_for_upload_expired_while_writing_is_gone(app, client, start_upload, monkeypatch, when):
+    from database import db_session, engine
+    from models import ChunkedUpload, UploadChunk
+    url = start_upload()
+    upload_id, path = url.rsplit('/', 1)[1], spool_path(url)
+    store = app.extensions['content_store']
+    write_at = store.write_at
+
+    def expire():
+        with engine.begin() as conn:
+            conn.execute(UploadChunk.__table__.delete().where(UploadChunk.upload_id == upload_id))
+            conn.execute(ChunkedUpload.__table__.delete().where(ChunkedUpload.id == upload_id))
+        os.remove(path)
+
+    def expiring_write_at(*args):
+        if when == 'before':
+            expire()
+        result = write_at(*args)
+        if when == 'after':
+            expire()
+        return result
+
+    monkeypatch.setattr(store, 'write_at', expiring_write_at)
+    assert send(client, url, 0, CHUNKS[0][1]).status_code == 410
+    assert db_session.query(UploadChunk).filter(UploadChunk.upload_id == upload_id).count() == 0
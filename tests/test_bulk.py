@@ -0,0 +1,18 @@
+from sqlalchemy import func, select
+
+import bulk
+from models import Project, Design, Modeling
+
+
+def test_import_skips_empty_stages(app, db_session):
+    records = [(2, {'project_name': 'Imported', 'creator_name': 'Bulk', 'current_stage': 'DESIGN',
+                    'design_artist': 'Ana'}),
+               (3, {'project_name': 'Bare', 'creator_name': 'Bulk', 'current_stage': 'CONCEPT'})]
+    assert bulk.import_records(records) == (2, 0)
+
+    imported, bare = db_session.execute(
+        select(Project.id).where(Project.creator_name == 'Bulk').order_by(Project.id)).scalars()
+    assert db_session.query(Design.project_id, Design.artist).filter(Design.project_id.in_([imported, bare])).all() \
+        == [(imported, 'Ana')]
+    assert db_session.scalar(
+        select(func.count()).select_from(Modeling).where(Modeling.project_id.in_([imported, bare]))) == 0
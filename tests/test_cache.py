@@ -0,0 +1,35 @@
+from datetime import date
+
+import routes.projects
+
+
+class FakeDate(date):
+    current = date(2026, 3, 2)
+
+    @classmethod
+    def today(cls):
+        return cls.current
+
+
+def test_follow_ups_are_recomputed_each_day(client, make_project, monkeypatch):
+    monkeypatch.setattr(routes.projects, 'date', FakeDate)
+    project_id = make_project(first_contact_date='2026-03-01')
+
+    def waiting_days():
+        items = client.get('/api/v1/projects/follow-ups').get_json()['items']
+        return {item['project_id']: item['waiting_days'] for item in items}[project_id]
+
+    first = client.get('/api/v1/projects/follow-ups')
+    assert waiting_days() == 1
+    monkeypatch.setattr(FakeDate, 'current', date(2026, 3, 5))
+    assert waiting_days() == 4
+    assert client.get('/api/v1/projects/follow-ups', headers={'If-None-Match': first.headers['ETag']}).status_code == 200
+
+
+def test_deleted_project_drops_its_version_counter(client, db_session, make_project):
+    from cache import cache_versions, project_key
+    project_id = make_project()
+    keys = cache_versions.c.key
+    assert db_session.execute(cache_versions.select().where(keys == project_key(project_id))).first()
+    assert client.post(f'/project/{project_id}/delete').status_code == 200
+    assert db_session.execute(cache_versions.select().where(keys == project_key(project_id))).first() is None
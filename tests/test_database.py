@@ -0,0 +1,36 @@
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from database import make_engine
+
+
+def _pragma(engine, name):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(f'PRAGMA {name}').scalar()
+
+
+def test_file_database_gets_wal_and_a_connection_pool(tmp_path, monkeypatch):
+    monkeypatch.setenv('SQLITE_BUSY_TIMEOUT_MS', '1234')
+    monkeypatch.setenv('DB_POOL_SIZE', '3')
+    engine = make_engine(f"sqlite:///{tmp_path / 'nested' / 'app.db'}", pragmas={'cache_size': -1000})
+    try:
+        # The database's directory is created on demand.
+        assert (tmp_path / 'nested').is_dir()
+        assert isinstance(engine.pool, QueuePool) and engine.pool.size() == 3
+        assert _pragma(engine, 'journal_mode') == 'wal'
+        assert _pragma(engine, 'synchronous') == 1  # NORMAL
+        assert _pragma(engine, 'busy_timeout') == 1234
+        assert _pragma(engine, 'cache_size') == -1000
+        assert _pragma(engine, 'temp_store') == 2  # MEMORY
+    finally:
+        engine.dispose()
+
+
+def test_memory_database_is_shared_across_connections():
+    engine = make_engine('sqlite://')
+    assert isinstance(engine.pool, StaticPool)
+    with engine.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE t (x INTEGER)')
+        conn.exec_driver_sql('INSERT INTO t VALUES (1)')
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql('SELECT x FROM t').scalar() == 1
+    assert _pragma(engine, 'synchronous') == 1
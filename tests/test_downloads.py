@@ -0,0 +1,81 @@
+import io
+import os
+import zipfile
+from datetime import datetime
+
+import pytest
+
+from models import File, Prototype
+
+
+@pytest.fixture
+def attach(app, db_session):
+    """``attach(project_id, filename, content)`` stores a prototype attachment; returns its File id."""
+    store = app.extensions['content_store']
+
+    def add(project_id, filename, content):
+        stored = store.save(io.BytesIO(content))
+        stage = db_session.query(Prototype).filter(Prototype.project_id == project_id).one()
+        file = File(filename=filename, file_path=stored.path, upload_date=datetime(2024, 5, 1, 12, 0),
+                    file_type=filename.rpartition('.')[2], sha256=stored.sha256, size=stored.size,
+                    status='stored', prototype_id=stage.id)
+        db_session.add(file)
+        db_session.commit()
+        file_id = file.id
+        db_session.remove()
+        return file_id
+
+    return add
+
+
+def test_download_answers_ranges_and_conditionals(client, make_project, attach):
+    content = os.urandom(4096)
+    file_id = attach(make_project(prototype={'cost': 1.0}), 'part.pdf', content)
+    url = f'/files/{file_id}/download'
+
+    response = client.get(url)
+    assert response.status_code == 200 and response.data == content
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    etag = response.headers['ETag']
+
+    response = client.get(url, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.data == content[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(content)}'
+
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    # A resumed download whose file changed since gets the whole new body.
+    response = client.get(url, headers={'Range': 'bytes=100-', 'If-Range': '"stale"'})
+    assert response.status_code == 200 and response.data == content
+
+
+def test_download_through_nginx_sends_only_headers(app, client, make_project, attach):
+    file_id = attach(make_project(prototype={'cost': 1.0}), 'part.pdf', b'behind nginx')
+    app.config['ATTACHMENT_ACCEL_REDIRECT'] = '/_attachments/'
+    try:
+        response = client.get(f'/files/{file_id}/download')
+    finally:
+        app.config['ATTACHMENT_ACCEL_REDIRECT'] = None
+    assert response.data == b''
+    accel = response.headers['X-Accel-Redirect']
+    assert accel.startswith('/_attachments/') and '..' not in accel
+
+
+def test_project_zip_streams_every_stored_attachment(app, client, make_project, attach):
+    project_id = make_project(prototype={'cost': 1.0})
+    attach(project_id, 'drawing.pdf', b'first drawing')
+    attach(project_id, 'drawing.pdf', b'second drawing')
+    gone = attach(project_id, 'gone.png', b'removed from disk')
+    from database import db_session
+    os.remove(db_session.get(File, gone).file_path)
+    db_session.remove()
+    url = f'/project/{project_id}/attachments.zip'
+
+    response = client.get(url)
+    assert response.status_code == 200 and response.mimetype == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert {name: archive.read(name) for name in archive.namelist()} == {
+            'prototype/drawing.pdf': b'first drawing',
+            'prototype/drawing (2).pdf': b'second drawing',
+        }
+    assert client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code == 304
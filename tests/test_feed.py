@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import pytest
+
+import feed
+from database import engine
+
+
+@pytest.fixture
+def events(app):
+    """``events(*ids)`` writes change events with exactly those ids."""
+    def write(*ids):
+        with engine.begin() as conn:
+            conn.execute(feed.change_events.insert(), [
+                {'id': event_id, 'project_id': 1, 'action': feed.UPDATE, 'created_at': datetime.utcnow()}
+                for event_id in ids])
+
+    with engine.begin() as conn:
+        conn.execute(feed.change_events.delete())
+    return write
+
+
+def sent_ids(last_id, **options):
+    options = dict(dict(poll=0.01, lifetime=0.2), **options)
+    return [int(line[4:]) for message in feed.stream(last_id, **options)
+            for line in message.splitlines() if line.startswith('id: ')]
+
+
+def test_id_newer_than_an_emptied_log_is_reset(events):
+    assert 'event: reset' in ''.join(feed.stream(500, lifetime=0))
+
+
+def test_id_older_than_the_log_is_reset(events):
+    events(10, 11)
+    assert 'event: reset' in ''.join(feed.stream(5, lifetime=0))
+    assert 'event: reset' not in ''.join(feed.stream(9, lifetime=0))
+
+
+def test_hole_in_ids_is_waited_on(events):
+    events(10, 11, 13)
+    assert sent_ids(10, gap_wait=60) == [11]
+    assert sent_ids(10, gap_wait=0) == [11, 13]
+
+
+def test_live_feed_is_off_by_default(client):
+    assert client.get('/events').status_code == 404
+    assert 'data-events-url' not in client.get('/').get_data(as_text=True)
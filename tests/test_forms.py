@@ -0,0 +1,106 @@
+from html.parser import HTMLParser
+import os
+
+import pytest
+
+from models import Prototype
+
+
+class FormValues(HTMLParser):
+    """The values a browser would submit for the page's form, files left out."""
+
+    def __init__(self):
+        super().__init__()
+        self.values, self._select, self._textarea = {}, None, None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'input' and attrs.get('name') and attrs.get('type') not in ('file', 'submit'):
+            if attrs.get('type') != 'checkbox' or 'checked' in attrs:
+                self.values[attrs['name']] = attrs.get('value') or ''
+        elif tag == 'select':
+            self._select = attrs.get('name')
+        elif tag == 'option' and self._select and ('selected' in attrs or self._select not in self.values):
+            self.values[self._select] = attrs.get('value', '')
+        elif tag == 'textarea':
+            self._textarea = attrs.get('name')
+            self.values[self._textarea] = ''
+
+    def handle_endtag(self, tag):
+        if tag == 'select':
+            self._select = None
+        elif tag == 'textarea':
+            self._textarea = None
+
+    def handle_data(self, data):
+        if self._textarea:
+            self.values[self._textarea] += data
+
+
+def test_saving_edit_form_unchanged_keeps_values(client, db_session, make_project):
+    project_id = make_project(current_stage='PROTOTYPE', prototype={'num_exploded_pieces': 7, 'cost': 120.5})
+    form = FormValues()
+    form.feed(client.get(f'/project/{project_id}/edit').get_data(as_text=True))
+
+    assert form.values['num_exploded_pieces'] == '7'
+    response = client.post(f'/project/{project_id}/edit', data=form.values, follow_redirects=True)
+    assert 'No changes to save.' in response.get_data(as_text=True)
+
+    prototype = db_session.query(Prototype).filter_by(project_id=project_id).one()
+    assert (prototype.num_exploded_pieces, prototype.cost) == (7, 120.5)
+
+
+def test_invalid_edit_logs_field_names_not_values(client, make_project, caplog):
+    project_id = make_project()
+    form = FormValues()
+    form.feed(client.get(f'/project/{project_id}/edit').get_data(as_text=True))
+    form.values['design_cost'] = 'call 555-0199'
+
+    response = client.post(f'/project/{project_id}/edit', data=form.values)
+
+    assert 'design_cost: cannot parse' in response.get_data(as_text=True)
+    records = [record for record in caplog.records if record.name == 'app']
+    assert [record.fields['invalid_fields'] for record in records] == [['design_cost']]
+    assert not any('555-0199' in record.getMessage() or record.exc_info for record in records)
+
+
+def test_uploads_outside_stage_fields_are_not_spooled(app, client, make_project):
+    from io import BytesIO
+    project_id = make_project()
+    form = FormValues()
+    form.feed(client.get(f'/project/{project_id}/edit').get_data(as_text=True))
+    spool = os.path.join(app.config['UPLOAD_FOLDER'], 'tmp')
+    before = set(os.listdir(spool)) if os.path.isdir(spool) else set()
+
+    form.values['creator_logo'] = (BytesIO(b'logo'), 'logo.png')
+    assert client.post(f'/project/{project_id}/edit', data=form.values).status_code == 302
+
+    after = set(os.listdir(spool)) if os.path.isdir(spool) else set()
+    assert after == before
+
+
+def test_stale_edit_of_a_deleted_project_is_not_found(client, make_project, monkeypatch):
+    import app as application
+    import stages
+    project_id = make_project()
+    form = FormValues()
+    form.feed(client.get(f'/project/{project_id}/edit').get_data(as_text=True))
+
+    def stale_and_gone(*args):
+        client.post(f'/project/{project_id}/delete')
+        raise stages.StaleEditError()
+
+    monkeypatch.setattr(application.stages, 'update_project', stale_and_gone)
+    assert client.post(f'/project/{project_id}/edit', data=form.values).status_code == 404
+
+
+def test_database_errors_leave_out_submitted_values(make_project):
+    from sqlalchemy.exc import IntegrityError
+    from database import engine
+    from models import Project
+    project_id = make_project()
+    with pytest.raises(IntegrityError) as failure:
+        with engine.begin() as conn:
+            conn.execute(Project.__table__.insert(), {'id': project_id, 'project_name': 'Secret Launch',
+                                                      'creator_name': 'Jane Roe', 'current_stage': 'DESIGN'})
+    assert 'Jane Roe' not in str(failure.value)
@@ -0,0 +1,53 @@
+import pytest
+
+
+@pytest.fixture
+def metrics_token(app):
+    app.config['METRICS_TOKEN'] = 'scrape-secret'
+    yield 'scrape-secret'
+    app.config['METRICS_TOKEN'] = None
+
+
+def test_metrics_need_the_token_even_from_loopback(client, metrics_token):
+    loopback = {'REMOTE_ADDR': '127.0.0.1'}
+    assert client.get('/metrics', environ_base=loopback).status_code == 404
+    assert client.get('/metrics', environ_base=loopback,
+                      headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    response = client.get('/metrics', headers={'Authorization': f'Bearer {metrics_token}'})
+    assert response.status_code == 200
+    assert 'http_request_duration_seconds' in response.get_data(as_text=True)
+
+
+def test_slow_request_log_leaves_out_query_values(app, client, caplog):
+    app.config['SLOW_REQUEST_MS'] = 0
+    try:
+        with caplog.at_level('WARNING', logger='metrics.slow'):
+            client.get('/?creator=Jane+Doe&stage=DESIGN')
+    finally:
+        app.config['SLOW_REQUEST_MS'] = 500
+    message, = [record.getMessage() for record in caplog.records if record.name == 'metrics.slow']
+    assert message.startswith('Slow request GET / [args: creator,stage] -> 200')
+    assert 'Jane' not in message
+
+
+def test_failed_statement_does_not_skew_later_timings(app):
+    import copy
+    import time
+    from flask import g
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+    import metrics
+    from database import engine
+    with app.test_request_context('/'):
+        stats = g._request_stats = metrics.RequestStats()
+        with engine.connect() as conn:
+            info = {key: copy.copy(value) for key, value in conn.info.items()}
+            with pytest.raises(OperationalError):
+                conn.execute(text('SELECT * FROM no_such_table'))
+            # Nothing from the failed statement is left on the (pooled) connection.
+            assert conn.info == info
+            time.sleep(0.2)
+            conn.execute(text('SELECT 1'))
+    assert stats.queries == 1
+    (elapsed, statement), = stats.statements
+    assert statement == 'SELECT 1' and elapsed < 0.2
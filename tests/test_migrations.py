@@ -0,0 +1,116 @@
+import hashlib
+import os
+from datetime import datetime
+
+import migrations
+from database import engine
+from models import File
+
+
+def test_legacy_attachments_are_hashed_into_the_store(app, db_session, tmp_path):
+    legacy = tmp_path / 'uploads'
+    legacy.mkdir()
+    content = b'legacy attachment'
+    for name in ('a.png', 'b.png'):
+        (legacy / name).write_bytes(content)
+    rows = [File(filename=name, file_path=str(legacy / name), upload_date=datetime.now(), file_type='png',
+                 status='stored') for name in ('a.png', 'b.png', 'gone.png')]
+    db_session.add_all(rows)
+    db_session.commit()
+    ids = [row.id for row in rows]
+    db_session.remove()
+
+    with engine.begin() as conn:
+        remove_originals = migrations._adopt_legacy_attachments(conn)
+    remove_originals()
+
+    a, b, gone = (db_session.get(File, file_id) for file_id in ids)
+    digest = hashlib.sha256(content).hexdigest()
+    assert (a.sha256, a.size) == (b.sha256, b.size) == (digest, len(content))
+    # Identical legacy files end up as one stored copy.
+    assert a.file_path == b.file_path == os.path.join(str(legacy), digest[:2], digest[2:4], digest)
+    assert open(a.file_path, 'rb').read() == content
+    assert not (legacy / 'a.png').exists() and not (legacy / 'b.png').exists()
+    # A row whose file is missing is left as it was.
+    assert gone.sha256 is None and gone.file_path == str(legacy / 'gone.png')
+
+
+def test_each_migration_applies_only_its_own_schema_change(app, tmp_path):
+    from sqlalchemy import inspect
+    from database import make_engine
+    old = make_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    migrations.upgrade(old)
+    # Roll the schema back to version 9: no change feed, no claim time, no whole-file checksum.
+    with old.begin() as conn:
+        conn.exec_driver_sql('DROP TABLE change_events')
+        conn.exec_driver_sql('ALTER TABLE files DROP COLUMN claimed_at')
+        conn.exec_driver_sql('ALTER TABLE chunked_uploads DROP COLUMN sha256')
+        # Migration 3's index, gone by hand; a later migration must not bring it back.
+        conn.exec_driver_sql('DROP INDEX ix_files_status')
+        migrations._set_version(conn, 9)
+
+    assert migrations.upgrade(old) == migrations.LATEST_VERSION
+
+    inspector = inspect(old)
+    assert inspector.has_table('change_events')
+    assert 'claimed_at' in {column['name'] for column in inspector.get_columns('files')}
+    assert 'sha256' in {column['name'] for column in inspector.get_columns('chunked_uploads')}
+    assert 'ix_files_status' not in {ix['name'] for ix in inspector.get_indexes('files')}
+    old.dispose()
+
+
+def test_project_ids_are_not_reused_after_the_upgrade(app, tmp_path):
+    from database import make_engine
+    old = make_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    migrations.upgrade(old)
+    with old.begin() as conn:
+        # A projects table from before AUTOINCREMENT, and history left by deleted project 50.
+        conn.exec_driver_sql('DROP TABLE projects')
+        conn.exec_driver_sql(
+            'CREATE TABLE projects (id INTEGER PRIMARY KEY, creator_name VARCHAR(255) NOT NULL, '
+            'project_name VARCHAR(255) NOT NULL, current_stage VARCHAR(10) NOT NULL, first_contact_date DATE, '
+            'first_response_date DATE, last_contact_date DATE, last_response_date DATE, '
+            "primary_communication_method VARCHAR(50), revision INTEGER DEFAULT '0' NOT NULL)"
+        )
+        conn.exec_driver_sql("INSERT INTO projects (id, creator_name, project_name, current_stage) "
+                             "VALUES (3, 'C', 'Kept', 'DESIGN')")
+        conn.exec_driver_sql("INSERT INTO stage_transitions (project_id, to_stage, changed_at, derived) "
+                             "VALUES (50, 'DESIGN', '2024-01-01 00:00:00', 0)")
+        migrations._set_version(conn, 14)
+
+    migrations.upgrade(old)
+
+    with old.begin() as conn:
+        assert conn.exec_driver_sql('SELECT project_name FROM projects WHERE id = 3').scalar() == 'Kept'
+        new_id = conn.exec_driver_sql("INSERT INTO projects (creator_name, project_name, current_stage) "
+                                      "VALUES ('C', 'New', 'CONCEPT')").lastrowid
+        indexes = {row[0] for row in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                                          "AND tbl_name = 'projects'")}
+    assert new_id == 51
+    assert 'ix_projects_current_stage' in indexes
+    old.dispose()
+
+
+def test_attachments_move_out_of_the_static_folder(app, db_session, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    old = os.path.join('static', 'uploads', 'ab', 'cd')
+    os.makedirs(old)
+    with open(os.path.join(old, 'abcd01'), 'wb') as stored:
+        stored.write(b'stored attachment')
+    row = File(filename='a.pdf', file_path=os.path.join(old, 'abcd01'), upload_date=datetime.now(),
+               file_type='pdf', status='stored')
+    elsewhere = File(filename='b.pdf', file_path='/srv/static/uploads/b.pdf', upload_date=datetime.now(),
+                     file_type='pdf', status='stored')
+    db_session.add_all([row, elsewhere])
+    db_session.commit()
+    ids = [row.id, elsewhere.id]
+    db_session.remove()
+
+    with engine.begin() as conn:
+        migrations._move_upload_folder(conn)
+
+    moved, untouched = (db_session.get(File, file_id) for file_id in ids)
+    assert moved.file_path == os.path.join('instance', 'uploads', 'ab', 'cd', 'abcd01')
+    assert open(moved.file_path, 'rb').read() == b'stored attachment'
+    assert not os.path.exists(os.path.join('static', 'uploads'))
+    assert untouched.file_path == '/srv/static/uploads/b.pdf'
@@ -0,0 +1,15 @@
+from pagination import encode_cursor
+
+CRAFTED = encode_cursor([{'a': 1}])
+
+
+def test_crafted_cursor_is_ignored_on_the_dashboard(client):
+    assert client.get(f'/?after={CRAFTED}').status_code == 200
+    assert client.get(f'/?sort=name&before={encode_cursor(["x", [1]])}').status_code == 200
+
+
+def test_crafted_cursor_is_rejected_by_the_api(client):
+    response = client.get(f'/api/v1/projects?after={CRAFTED}')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'Invalid after cursor'}
+    assert client.get(f'/api/v1/projects?before={encode_cursor([1])}').status_code == 200
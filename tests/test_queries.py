@@ -0,0 +1,56 @@
+from queries import load_project_aggregate
+
+
+def test_aggregate_loads_in_two_statements(db_session, make_project, count_statements):
+    project_id = make_project(design={'artist': 'A'}, modeling={'cost': 12.5}, launch={'units_sold': 3})
+    with count_statements() as statements:
+        project = load_project_aggregate(project_id)
+        # Touching every stage and its files must not lazy-load anything.
+        for stage in ('design', 'modeling', 'launch'):
+            assert getattr(project, stage).files == []
+        assert project.prototype is None
+    assert len(statements) == 2
+
+
+def _page_cache_reads(statements):
+    return [statement for statement in statements if 'FROM cache_versions' in statement]
+
+
+def test_edit_page_runs_two_statements(client, make_project, count_statements):
+    project_id = make_project(design={'artist': 'A'}, prototype={'num_exploded_pieces': 7})
+    with count_statements() as statements:
+        response = client.get(f'/project/{project_id}/edit')
+    assert response.status_code == 200
+    # Besides the page cache's version lookup, rendering costs the two aggregate queries.
+    assert len(_page_cache_reads(statements)) == 1
+    assert len(statements) - 1 == 2, statements
+
+    with count_statements() as statements:
+        assert client.get(f'/project/{project_id}/edit').status_code == 200
+    assert statements == _page_cache_reads(statements) and len(statements) == 1
+
+
+def test_deleting_by_stage_binds_no_ids(client, db_session):
+    from models import Project
+    # More projects than SQLite takes bound parameters in one statement.
+    db_session.execute(Project.__table__.insert(), [
+        {'project_name': f'Cancelled {i}', 'creator_name': 'C', 'current_stage': 'CANCELLED'} for i in range(33000)
+    ])
+    db_session.commit()
+    response = client.post('/projects/delete', json={'stage': 'CANCELLED'})
+    assert response.status_code == 200, response.get_json()
+    assert response.get_json()['deleted'] == 33000
+    assert db_session.query(Project).filter(Project.current_stage == 'CANCELLED').count() == 0
+
+
+def test_deleting_listed_ids_goes_in_chunks(db_session, make_project):
+    from queries import CHUNK_SIZE, delete_projects
+    project_ids = [make_project(design={'artist': 'A'}) for _ in range(3)]
+    listed = project_ids + list(range(10 ** 6, 10 ** 6 + 2 * CHUNK_SIZE))
+    deleted, paths = delete_projects(listed)
+    db_session.commit()
+    assert (deleted, paths) == (3, [])
+
+
+def test_bulk_delete_rejects_boolean_ids(client):
+    assert client.post('/projects/delete', json={'ids': [True]}).status_code == 400
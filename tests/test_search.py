@@ -0,0 +1,50 @@
+import pytest
+
+import search
+from models import Project
+
+pytestmark = pytest.mark.skipif(not search.available(), reason="SQLite without FTS5")
+
+
+def _found(terms, limit=10):
+    return [item.project_id for item in search.search(terms, limit).items]
+
+
+def test_project_name_outranks_other_columns(db_session, make_project):
+    by_artist = make_project(project_name='Lamp', design={'artist': 'Zephyrquill'})
+    by_name = make_project(project_name='Zephyrquill lamp')
+    assert _found('zephyrquill') == [by_name, by_artist]
+    # The last word matches as a prefix, every word must match.
+    assert _found('zephyrq') == [by_name, by_artist]
+    assert _found('zephyrquill lamp') == [by_name, by_artist]
+    assert _found('zephyrquill vase') == []
+
+
+def test_user_input_is_searched_for_literally(db_session):
+    assert search.match_expression('  ') is None
+    assert search.match_expression('say "hi" OR') == '"say" """hi""" "OR"*'
+    for terms in ('AND', 'a OR (b', '"', 'NEAR(x y)', 'col:val', '*'):
+        search.search(terms, 10)
+
+
+def test_broad_queries_are_listed_newest_first(db_session, make_project, monkeypatch):
+    project_ids = [make_project(project_name=f'Quorvex {n}') for n in range(3)]
+    page = search.search('quorvex', 10)
+    assert page.ranked
+    monkeypatch.setattr(search, 'RANK_LIMIT', 2)
+    page = search.search('quorvex', 10)
+    assert not page.ranked
+    assert [item.project_id for item in page.items] == project_ids[::-1]
+
+
+def test_index_follows_edits_and_deletes(client, db_session, make_project):
+    project_id = make_project(project_name='Brindlewick')
+    project = db_session.get(Project, project_id)
+    project.project_name = 'Mossgrove'
+    db_session.commit()
+    db_session.remove()
+    assert _found('brindlewick') == []
+    assert _found('mossgrove') == [project_id]
+
+    assert client.post('/projects/delete', json={'ids': [project_id]}).status_code == 200
+    assert _found('mossgrove') == []
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+FRESH_START = r'''
+import json, os, sys
+sys.path.insert(0, {root!r})
+import app, migrations
+from database import engine
+application = app.create_app()
+# Nothing is left open for a forked worker to inherit.
+pooled = engine.pool.checkedin()
+upgrades = []
+migrations.upgrade = lambda *args: upgrades.append(args)
+app.create_app()
+with engine.connect() as conn:
+    version = migrations.get_version(conn)
+print(json.dumps({{'same_app': application is app.app, 'version': version, 'upgrades_on_repeat': len(upgrades),
+                  'pooled': pooled}}))
+'''
+
+
+def test_create_app_upgrades_a_new_database_once(tmp_path):
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path / 'fresh.db'}", LOG_LEVELS='WARNING')
+    result = subprocess.run([sys.executable, '-c', FRESH_START.format(root=ROOT)], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    import migrations
+    assert json.loads(result.stdout.splitlines()[-1]) == {
+        'same_app': True, 'version': migrations.LATEST_VERSION, 'upgrades_on_repeat': 0, 'pooled': 0}
+
+
+def test_worker_start_up_runs_once_per_process(app, monkeypatch):
+    import app as application
+    calls = []
+    monkeypatch.setattr(application, 'resume_pending_uploads', lambda *args: calls.append('resume'))
+    monkeypatch.setattr(application.tasks, 'every', lambda interval, fn, *args: calls.append(fn.__name__))
+    # As if this process were a worker forked from the one that ran start-up.
+    monkeypatch.setitem(application._started, 'worker', -1)
+    client = app.test_client()
+    client.get('/project/0/edit')
+    client.get('/project/0/edit')
+    assert calls == ['resume', 'expire_chunked_uploads', 'trim']
+    assert application._started['worker'] == os.getpid()
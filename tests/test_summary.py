@@ -0,0 +1,35 @@
+import summary
+from database import engine
+from models import ProjectSummary
+
+
+def test_check_reports_and_rebuild_repairs_drift(db_session, make_project):
+    kept, dropped = make_project(design={'cost': 100.0}), make_project(launch={'units_sold': 4})
+    orphan = 10 ** 7
+    with engine.begin() as conn:
+        table = ProjectSummary.__table__
+        conn.execute(table.update().where(table.c.project_id == kept).values(total_spend=1.0))
+        conn.execute(table.delete().where(table.c.project_id == dropped))
+        row = dict(conn.execute(table.select().where(table.c.project_id == kept)).one()._mapping)
+        conn.execute(table.insert().values(dict(row, project_id=orphan)))
+
+    with engine.connect() as conn:
+        missing, stale, orphaned = summary.check(conn)
+    assert dropped in missing and kept in stale and orphan in orphaned
+
+    with engine.begin() as conn:
+        summary.rebuild(conn)
+    with engine.connect() as conn:
+        assert summary.check(conn) == ([], [], [])
+    assert db_session.get(ProjectSummary, kept).total_spend == 100.0
+    assert db_session.get(ProjectSummary, dropped).units_sold == 4
+    assert db_session.get(ProjectSummary, orphan) is None
+
+
+def test_bulk_delete_drops_summary_rows(client, db_session, make_project):
+    project_ids = [make_project(design={'cost': 5.0}) for _ in range(3)]
+    response = client.post('/projects/delete', json={'ids': project_ids[:2]})
+    assert response.status_code == 200, response.get_json()
+    assert [db_session.get(ProjectSummary, project_id) is None for project_id in project_ids] == [True, True, False]
+    with engine.connect() as conn:
+        assert summary.check(conn) == ([], [], [])
@@ -0,0 +1,13 @@
+import threading
+
+import tasks
+
+
+def test_every_keeps_resubmitting():
+    runs = threading.Semaphore(0)
+    stop = tasks.every(0.01, runs.release)
+    try:
+        for _ in range(3):
+            assert runs.acquire(timeout=5)
+    finally:
+        stop.set()
@@ -0,0 +1,81 @@
+import bulk
+import transitions
+from models import Project
+
+
+def test_new_project_does_not_inherit_a_deleted_projects_history(client, db_session, make_project):
+    deleted = make_project(current_stage='CONCEPT')
+    project = db_session.get(Project, deleted)
+    project.current_stage = 'DESIGN'
+    db_session.commit()
+    db_session.remove()
+    assert client.post('/projects/delete', json={'ids': [deleted]}).status_code == 200
+
+    created = make_project(current_stage='MODELING')
+    assert created > deleted
+    assert [row.to_stage for row in transitions.history(created)] == ['MODELING']
+    assert [row.to_stage for row in transitions.history(deleted)] == ['CONCEPT', 'DESIGN']
+
+
+def test_bulk_import_does_not_reuse_deleted_ids(client, db_session, make_project):
+    deleted = make_project()
+    assert client.post('/projects/delete', json={'ids': [deleted]}).status_code == 200
+    assert bulk.import_records([(2, {'project_name': 'After delete', 'creator_name': 'Reuse',
+                                     'current_stage': 'CONCEPT'})]) == (1, 0)
+    imported = db_session.query(Project.id).filter(Project.creator_name == 'Reuse').scalar()
+    assert imported > deleted
+    assert transitions.history(deleted) and [row.to_stage for row in transitions.history(imported)] == ['CONCEPT']
+
+
+def _stages(project_id):
+    return [(row.from_stage, row.to_stage, row.changed_at.date().isoformat(), row.derived)
+            for row in transitions.history(project_id)]
+
+
+def test_history_is_derived_from_stage_dates_then_recorded(client, db_session, make_project):
+    project_id = make_project(current_stage='PROTOTYPE', first_contact_date='2024-01-10',
+                              design={'start_date': '2024-02-01'}, modeling={'start_date': '2024-01-20'})
+    # Dates out of order never make time run backwards; the undated current stage takes the latest date.
+    assert _stages(project_id) == [
+        (None, 'CONCEPT', '2024-01-10', True),
+        ('CONCEPT', 'DESIGN', '2024-02-01', True),
+        ('DESIGN', 'MODELING', '2024-02-01', True),
+        ('MODELING', 'PROTOTYPE', '2024-02-01', True),
+    ]
+    project = db_session.get(Project, project_id)
+    project.current_stage = 'CONTRACT'
+    db_session.commit()
+    db_session.remove()
+    assert _stages(project_id)[-1][:2] == ('PROTOTYPE', 'CONTRACT') and not _stages(project_id)[-1][3]
+
+    items = client.get(f'/api/v1/projects/{project_id}/transitions').get_json()['items']
+    assert [item['to_stage'] for item in items] == ['CONCEPT', 'DESIGN', 'MODELING', 'PROTOTYPE', 'CONTRACT']
+    assert client.get('/api/v1/projects/999999999/transitions').status_code == 404
+
+
+def test_funnel_and_time_in_stage_count_each_project(db_session, make_project):
+    funnel, stays = {row['stage']: row for row in transitions.funnel()}, transitions.time_in_stage()
+    make_project(current_stage='MODELING', first_contact_date='2024-01-01', design={'start_date': '2024-01-11'})
+    cancelled = make_project(current_stage='DESIGN')
+    project = db_session.get(Project, cancelled)
+    project.current_stage = 'CANCELLED'
+    db_session.commit()
+    db_session.remove()
+    funnel_after, stays_after = {row['stage']: row for row in transitions.funnel()}, transitions.time_in_stage()
+
+    def reached(stage):
+        return funnel_after[stage]['reached'] - funnel[stage]['reached']
+
+    assert [reached(stage) for stage in ('CONCEPT', 'DESIGN', 'MODELING', 'PROTOTYPE')] == [2, 2, 1, 0]
+    assert funnel_after['DESIGN']['cancelled_from'] - funnel['DESIGN']['cancelled_from'] == 1
+    design = funnel_after['DESIGN']
+    assert design['conversion'] == design['reached'] / funnel_after['CONCEPT']['reached']
+
+    def completed(stats, stage):
+        return stats[stage]['completed']['count'] if stats[stage]['completed'] else 0
+
+    # CONCEPT and DESIGN stays ended for the first project; DESIGN ended for the cancelled one.
+    assert completed(stays_after, 'CONCEPT') - completed(stays, 'CONCEPT') == 1
+    assert completed(stays_after, 'DESIGN') - completed(stays, 'DESIGN') == 2
+    assert stays_after['MODELING']['open'] - stays['MODELING']['open'] == 1
+    assert stays_after['CANCELLED']['open'] - stays['CANCELLED']['open'] == 1
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import uploads
+from models import File
+
+
+def _file(status, claimed_at=None):
+    return File(filename='f.txt', file_path='/nonexistent/f.txt', upload_date=datetime.now(), file_type='txt',
+                status=status, claimed_at=claimed_at)
+
+
+def test_resume_leaves_live_claims_alone(app, db_session, monkeypatch):
+    queued = []
+    monkeypatch.setattr(uploads, 'queue_uploads', lambda store, file_ids: queued.extend(file_ids))
+    rows = [_file(uploads.PENDING),
+            _file(uploads.PROCESSING, datetime.utcnow()),
+            _file(uploads.PROCESSING, datetime.utcnow() - timedelta(hours=2))]
+    db_session.add_all(rows)
+    db_session.commit()
+    pending, live, abandoned = (row.id for row in rows)
+    db_session.remove()
+
+    uploads.resume_pending_uploads(None, claim_timeout=timedelta(hours=1))
+
+    assert pending in queued and abandoned in queued and live not in queued
+    assert db_session.get(File, live).status == uploads.PROCESSING
+    assert db_session.get(File, abandoned).status == uploads.PENDING
+
+
+def test_unhashed_legacy_file_has_no_thumbnail(client, db_session, make_project):
+    from models import Design
+    project_id = make_project(design={'artist': 'Ana'})
+    design = db_session.query(Design).filter_by(project_id=project_id).one()
+    legacy = File(filename='sketch.png', file_path='/nonexistent/sketch.png', upload_date=datetime.now(),
+                  file_type='png', status=uploads.STORED, design_id=design.id)
+    db_session.add(legacy)
+    db_session.commit()
+    file_id = legacy.id
+    db_session.remove()
+
+    assert client.get(f'/files/{file_id}/thumbnail/small').status_code == 404
+    page = client.get(f'/project/{project_id}/edit').get_data(as_text=True)
+    assert 'sketch.png' in page and f'/files/{file_id}/thumbnail/' not in page
+
+
+def test_spooled_upload_is_stored_without_rereading(app, client, db_session, make_project, monkeypatch):
+    import hashlib
+    from io import BytesIO
+    import storage
+    queued = []
+    monkeypatch.setattr('routes.attachments.queue_uploads', lambda store, file_ids: queued.extend(file_ids))
+    project_id = make_project(design={'artist': 'Ana'})
+    response = client.post(f'/api/v1/projects/{project_id}/stages/design/attachments',
+                           data={'files': (BytesIO(b'sketch bytes'), 'sketch.txt')})
+    assert response.status_code == 202
+    file_id, = queued
+
+    def no_reads(*args, **kwargs):
+        raise AssertionError("the spooled upload was read back")
+
+    monkeypatch.setattr(storage, 'open', no_reads, raising=False)
+    uploads.process_upload(app.extensions['content_store'], file_id)
+    stored = db_session.get(File, file_id)
+    assert stored.status == uploads.STORED
+    assert (stored.sha256, stored.size) == (hashlib.sha256(b'sketch bytes').hexdigest(), len(b'sketch bytes'))
+    assert stored.file_path.endswith(stored.sha256)
+
+
+def test_reclaimed_upload_already_moved_into_the_store_is_stored(app, db_session):
+    from io import BytesIO
+    store = app.extensions['content_store']
+    spooled = store.spool(BytesIO(b'moved before the worker died'))
+    row = File(filename='f.txt', file_path=spooled.path, sha256=spooled.sha256, size=spooled.size,
+               upload_date=datetime.now(), file_type='txt', status=uploads.PENDING)
+    db_session.add(row)
+    db_session.commit()
+    file_id = row.id
+    db_session.remove()
+    # The dead worker's move into the store, without the status update after it.
+    store.save_spooled(spooled.path, spooled.sha256, spooled.size)
+
+    uploads.process_upload(store, file_id)
+
+    stored = db_session.get(File, file_id)
+    assert stored.status == uploads.STORED
+    assert stored.file_path == store.path_for(spooled.sha256)
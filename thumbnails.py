@@ -0,0 +1,122 @@
+"""Resized previews of image attachments, kept in a size-capped disk cache.
+
+Variants are keyed by the attachment's content hash, so they never go stale
+and can be served with a strong ETag. The least recently used variants are
+evicted once the cache grows past ``max_bytes``. Pillow is optional; without
+it :func:`available` is False and no previews are generated. It is only
+imported when the first preview is built, which keeps it out of worker
+start-up.
+"""
+import importlib.util
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+SIZES = {'small': 160, 'medium': 480, 'large': 1024}
+IMAGE_TYPES = {'png', 'jpg', 'jpeg', 'gif'}
+
+
+_PIL = importlib.util.find_spec('PIL') is not None
+
+
+def available():
+    return _PIL
+
+
+def _pillow():
+    from PIL import Image, ImageOps
+    return Image, ImageOps
+
+
+def is_image(file_type):
+    return (file_type or '').lower() in IMAGE_TYPES
+
+
+def output_format(file_type):
+    # Photos stay JPEG; PNG and GIF sources may carry transparency.
+    return 'JPEG' if (file_type or '').lower() in ('jpg', 'jpeg') else 'PNG'
+
+
+class ThumbnailCache:
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total = None
+
+    def variant_path(self, digest, size, file_type):
+        return os.path.join(self.root, digest[:2], f'{digest}-{size}.{output_format(file_type).lower()}')
+
+    def get(self, source_path, digest, size, file_type):
+        """Return the path of the ``size`` variant, generating it on a miss."""
+        path = self.variant_path(digest, size, file_type)
+        try:
+            os.utime(path)  # mtime doubles as the LRU clock
+            return path
+        except FileNotFoundError:
+            pass
+        self._generate(source_path, path, SIZES[size], output_format(file_type))
+        self._account(os.path.getsize(path), keep=path)
+        return path
+
+    def _generate(self, source_path, path, max_edge, image_format):
+        Image, ImageOps = _pillow()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with Image.open(source_path) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_edge, max_edge))
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    if image_format == 'JPEG':
+                        image.convert('RGB').save(out, 'JPEG', quality=85, optimize=True)
+                    else:
+                        image.save(out, 'PNG', optimize=True)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    def _entries(self):
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _account(self, added, keep):
+        with self._lock:
+            if self._total is None:
+                self._total = sum(size for _, size, _ in self._entries())
+            else:
+                self._total += added
+            if self._total <= self.max_bytes:
+                return
+            # Evict down to 90% of the cap so we do not rescan on every miss.
+            target = self.max_bytes * 0.9
+            for _, size, path in sorted(self._entries()):
+                if self._total <= target:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                    self._total -= size
+                except FileNotFoundError:
+                    pass
+
+    def pregenerate(self, source_path, digest, file_type, sizes=('small',)):
+        if not available() or not is_image(file_type):
+            return
+        for size in sizes:
+            try:
+                self.get(source_path, digest, size, file_type)
+            except Exception as e:
+                logger.warning("Could not build %s preview of %s: %s", size, source_path, e)
@@ -0,0 +1,281 @@
+"""Stage-transition history: when each project entered each stage.
+
+``stage_transitions`` gets a row whenever a project's ``current_stage``
+changes. Like ``project_summary`` it is written for the projects a
+transaction touched before that transaction commits (see :mod:`changes`):
+one ``INSERT ... SELECT`` compares each project's stage with the latest row
+of its history. Rows are never updated or deleted.
+
+A project without any history -- new, bulk-imported, or from before this
+table existed -- has one reconstructed from its stage dates (first contact,
+design/modeling/prototype/production/launch start, contract sent, launch
+end), marked ``derived``. Stages without a date are skipped, except the
+current one, which is dated at the latest known date.
+
+The funnel and time-in-stage queries read only this table and its indexes.
+
+Run ``python transitions.py backfill`` to reconstruct history for every
+project that has none.
+"""
+import argparse
+import logging
+import sys
+from datetime import datetime
+from sqlalchemy import DateTime, Integer, and_, bindparam, case, cast, exists, func, literal, select
+from database import db_session, engine
+from models import (Project, StageTransition, Design, Modeling, Prototype, Contract, Production, Launch,
+                    STAGES)
+from analytics import PERCENTILES, days_between, histogram_stats
+from queries import chunks, executemany
+import changes
+
+stage_transitions = StageTransition.__table__
+
+# Pipeline order, and the date each stage is taken to have started on when
+# history is reconstructed.
+PIPELINE = [
+    ('CONCEPT', Project.first_contact_date),
+    ('DESIGN', Design.start_date),
+    ('MODELING', Modeling.start_date),
+    ('PROTOTYPE', Prototype.start_date),
+    ('CONTRACT', Contract.sent_date),
+    ('PRODUCTION', Production.start_date),
+    ('LAUNCHED', Launch.start_date),
+    ('COMPLETED', Launch.end_date),
+]
+FUNNEL_STAGES = [stage for stage, _ in PIPELINE]
+CANCELLED = 'CANCELLED'
+
+_COLUMNS = ['project_id', 'from_stage', 'to_stage', 'changed_at', 'derived']
+
+
+def _latest_stage(project_id):
+    return (
+        select(stage_transitions.c.to_stage)
+        .where(stage_transitions.c.project_id == project_id)
+        .order_by(stage_transitions.c.changed_at.desc(), stage_transitions.c.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+def _changed_select():
+    projects = Project.__table__
+    current = select(
+        projects.c.id,
+        projects.c.current_stage,
+        _latest_stage(projects.c.id).label('latest'),
+    ).where(projects.c.id.in_(bindparam('ids', expanding=True))).subquery()
+    return (
+        select(current.c.id, current.c.latest, current.c.current_stage,
+               bindparam('now', type_=DateTime), literal(False))
+        .where(current.c.latest != current.c.current_stage)
+    )
+
+
+def dates_select(where=None):
+    """Projects with the dates their history is derived from."""
+    projects = Project.__table__
+    source = projects
+    for _, model in STAGES:
+        if any(column.class_ is model for _, column in PIPELINE):
+            table = model.__table__
+            source = source.outerjoin(table, table.c.project_id == projects.c.id)
+    query = select(
+        projects.c.id,
+        projects.c.current_stage,
+        *[column.label(stage) for stage, column in PIPELINE],
+    ).select_from(source)
+    return query if where is None else query.where(where)
+
+
+def untracked_select(where=None):
+    """:func:`dates_select` for the projects without history."""
+    untracked = ~exists().where(stage_transitions.c.project_id == Project.__table__.c.id)
+    return dates_select(untracked if where is None else and_(untracked, where))
+
+
+# Built once: these statements are costly to construct and run on every commit.
+_RECORD_CHANGES = stage_transitions.insert().from_select(_COLUMNS, _changed_select())
+_UNTRACKED = untracked_select(Project.__table__.c.id.in_(bindparam('ids', expanding=True)))
+_DATES = dates_select(Project.__table__.c.id.in_(bindparam('ids', expanding=True)))
+
+
+def _as_datetime(value):
+    if isinstance(value, datetime) or value is None:
+        return value
+    return datetime(value.year, value.month, value.day)
+
+
+def derive_history(row, now):
+    """Transition rows reconstructed for one :func:`untracked_select` row."""
+    current = row.current_stage
+    mapping = row._mapping
+    if current in FUNNEL_STAGES:
+        candidates = FUNNEL_STAGES[:FUNNEL_STAGES.index(current) + 1]
+    else:
+        candidates = FUNNEL_STAGES
+    dated = [(stage, _as_datetime(mapping[stage])) for stage in candidates if mapping[stage] is not None]
+    if not dated or dated[-1][0] != current:
+        latest = max((when for _, when in dated), default=None)
+        # A project with no dates at all is only known to be in its stage now.
+        dated.append((current, latest))
+    history, previous, floor = [], None, None
+    for stage, when in dated:
+        derived = when is not None
+        when = when or now
+        # Dates entered out of order must not make time run backwards.
+        if floor is not None and when < floor:
+            when = floor
+        history.append({'project_id': row.id, 'from_stage': previous, 'to_stage': stage,
+                        'changed_at': when, 'derived': derived})
+        previous, floor = stage, when
+    return history
+
+
+def _insert_history(bind, rows):
+    """Insert :func:`derive_history` rows, a few per project, through the driver."""
+    dialect = bind.get_bind().dialect if hasattr(bind, 'get_bind') else bind.dialect
+    to_db = stage_transitions.c.changed_at.type.bind_processor(dialect) or (lambda value: value)
+    executemany(bind, stage_transitions, _COLUMNS, [
+        (row['project_id'], row['from_stage'], row['to_stage'], to_db(row['changed_at']), row['derived'])
+        for row in rows
+    ])
+
+
+def _insert_derived(bind, query, ids, now):
+    rows = [history for row in bind.execute(query, {'ids': ids}) for history in derive_history(row, now)]
+    if rows:
+        _insert_history(bind, rows)
+
+
+def record(bind, project_ids, now=None, created_ids=()):
+    """Append transitions for ``project_ids``: stage changes, and derived history for untracked projects.
+
+    ``created_ids`` were inserted by this transaction, so they have no
+    history to compare with; theirs is derived without looking.
+    """
+    now = now or datetime.utcnow().replace(microsecond=0)
+    created = set(project_ids) & set(created_ids)
+    for chunk in chunks(set(project_ids) - created):
+        bind.execute(_RECORD_CHANGES, {'ids': chunk, 'now': now})
+        _insert_derived(bind, _UNTRACKED, chunk, now)
+    for chunk in chunks(created):
+        _insert_derived(bind, _DATES, chunk, now)
+
+
+@changes.before_commit
+def _record_touched(session, project_ids):
+    record(session, project_ids, created_ids=changes.created(session))
+
+
+def backfill(bind, batch_size=5000):
+    """Derive history for every project that has none; returns the number of projects."""
+    now = datetime.utcnow().replace(microsecond=0)
+    projects = Project.__table__
+    done, after = 0, 0
+    while True:
+        batch = bind.execute(
+            untracked_select(projects.c.id > after).order_by(projects.c.id).limit(batch_size)
+        ).all()
+        if not batch:
+            return done
+        _insert_history(bind, [history for row in batch for history in derive_history(row, now)])
+        done += len(batch)
+        after = batch[-1].id
+
+
+def history(project_id):
+    """A project's transitions, oldest first."""
+    return db_session.execute(
+        select(stage_transitions)
+        .where(stage_transitions.c.project_id == project_id)
+        .order_by(stage_transitions.c.changed_at, stage_transitions.c.id)
+    ).all()
+
+
+def funnel():
+    """How many projects reached each pipeline stage (or a later one), with conversion rates.
+
+    ``conversion`` is the share of projects that reached the previous stage
+    and went on to this one; ``cancelled_from`` counts cancellations out of
+    the stage.
+    """
+    rank = case({stage: index for index, stage in enumerate(FUNNEL_STAGES)},
+                value=stage_transitions.c.to_stage, else_=-1)
+    furthest = (
+        select(func.max(rank).label('furthest'))
+        .group_by(stage_transitions.c.project_id)
+        .subquery()
+    )
+    reached_at = dict(db_session.execute(
+        select(furthest.c.furthest, func.count()).group_by(furthest.c.furthest)
+    ).all())
+    cancelled_from = dict(db_session.execute(
+        select(stage_transitions.c.from_stage, func.count())
+        .where(stage_transitions.c.to_stage == CANCELLED)
+        .group_by(stage_transitions.c.from_stage)
+    ).all())
+
+    stages, reached, previous = [], sum(count for index, count in reached_at.items() if index >= 0), None
+    for index, stage in enumerate(FUNNEL_STAGES):
+        stages.append({
+            'stage': stage,
+            'reached': reached,
+            'conversion': reached / previous if previous else None,
+            'cancelled_from': cancelled_from.get(stage, 0),
+        })
+        previous = reached
+        reached -= reached_at.get(index, 0)
+    return stages
+
+
+def time_in_stage(percentiles=PERCENTILES):
+    """Whole days spent in each stage: count, mean and percentiles of completed stays, plus open stays.
+
+    A stay ends at the project's next transition; the project's current
+    stage is an open stay and only counted. As in
+    :func:`analytics.stage_duration_stats`, the database returns a histogram.
+    """
+    ordering = dict(partition_by=stage_transitions.c.project_id,
+                    order_by=(stage_transitions.c.changed_at, stage_transitions.c.id))
+    stays = select(
+        stage_transitions.c.to_stage.label('stage'),
+        stage_transitions.c.changed_at.label('entered'),
+        func.lead(stage_transitions.c.changed_at).over(**ordering).label('left'),
+    ).subquery()
+    days = cast(days_between(stays.c.entered, stays.c.left), Integer)
+    histogram, open_stays = {}, {}
+    for stage, closed, whole_days, count in db_session.execute(
+        select(stays.c.stage, stays.c.left.isnot(None), days, func.count())
+        .group_by(stays.c.stage, stays.c.left.isnot(None), days)
+        .order_by(stays.c.stage, days)
+    ):
+        if closed:
+            histogram.setdefault(stage, []).append((whole_days, count))
+        else:
+            open_stays[stage] = open_stays.get(stage, 0) + count
+    stats = {}
+    for stage in FUNNEL_STAGES + [CANCELLED]:
+        values = histogram_stats(histogram[stage], percentiles) if stage in histogram else None
+        stats[stage] = {'completed': values, 'open': open_stays.get(stage, 0)}
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('backfill', help='derive history for projects that have none')
+    args = parser.parse_args(argv)
+
+    from database import init_db
+    init_db()
+    with engine.begin() as conn:
+        if args.command == 'backfill':
+            print(f"Derived history for {backfill(conn)} projects")
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""Background processing of form uploads.
+
+The request only spools each upload to disk and records a ``pending`` File
+row next to the project metadata. Hashing, deduplication and the move into
+the content store happen on the background queue once that transaction has
+committed, and the row is updated to ``stored`` (or ``failed``).
+
+Chunked uploads (``ChunkedUpload``) fill their spool file over several
+requests and join the same pipeline when they are finalized.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, or_
+from database import db_session
+from models import File, ChunkedUpload, UploadChunk
+import tasks
+import changes
+from storage import remove_unreferenced
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+PROCESSING = 'processing'
+STORED = 'stored'
+FAILED = 'failed'
+
+# Callables run on the background thread after an upload is stored, as
+# ``hook(path, sha256, file_type)``; e.g. preview generation.
+stored_hooks = []
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
+
+
+def spool_uploads(files, store, allowed_file, fields=None):
+    """Spool every allowed upload in ``files`` (a request's MultiDict).
+
+    ``fields`` limits the spooled uploads to those field names; anything
+    else the client sent is never written to disk. Returns ``{field name:
+    [(original filename, StoredFile), ...]}``, each :class:`storage.StoredFile`
+    naming the spool file with the digest and size taken while writing it.
+    Called before the request writes to the database so no write lock is
+    held while upload bodies are copied to disk.
+    """
+    spooled = {}
+    for field in files:
+        if fields is not None and field not in fields:
+            continue
+        for upload in files.getlist(field):
+            if upload and allowed_file(upload.filename):
+                spooled.setdefault(field, []).append((upload.filename, store.spool(upload.stream)))
+    return spooled
+
+
+def discard_spooled(spooled):
+    remove_spooled(spooled_file.path for entries in spooled.values() for _, spooled_file in entries)
+
+
+def remove_spooled(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def missing_ranges(chunks, length):
+    """``[start, end)`` byte ranges of ``length`` not covered by ``(start, length)`` chunks."""
+    missing, covered = [], 0
+    for start, size in sorted(chunks):
+        if start > covered:
+            missing.append([covered, start])
+        covered = max(covered, start + size)
+    if covered < length:
+        missing.append([covered, length])
+    return missing
+
+
+def expire_chunked_uploads(max_age):
+    """Drop chunked uploads started more than ``max_age`` ago, and the spool files of unfinished ones."""
+    cutoff = datetime.utcnow() - max_age
+    try:
+        expired = ChunkedUpload.query.filter(ChunkedUpload.created_at < cutoff).all()
+        upload_ids = [upload.id for upload in expired]
+        # A finalized upload's spool file belongs to its File row now.
+        abandoned = [upload.spool_path for upload in expired if upload.file_id is None]
+        if upload_ids:
+            UploadChunk.query.filter(UploadChunk.upload_id.in_(upload_ids)).delete(synchronize_session=False)
+            ChunkedUpload.query.filter(ChunkedUpload.id.in_(upload_ids)).delete(synchronize_session=False)
+            db_session.commit()
+    finally:
+        db_session.remove()
+    remove_spooled(abandoned)
+    return len(upload_ids)
+
+
+def process_upload(store, file_id):
+    try:
+        claimed = (File.query.filter(File.id == file_id, File.status == PENDING)
+                   .update({File.status: PROCESSING, File.claimed_at: datetime.utcnow()},
+                           synchronize_session=False))
+        db_session.commit()
+        if not claimed:
+            return
+        file = File.query.get(file_id)
+        spool_path, file_type = file.file_path, file.file_type
+        try:
+            # Hashed while it was spooled (or verified, for chunked uploads); not read again here.
+            stored = store.save_spooled(spool_path, file.sha256, file.size)
+        except OSError as e:
+            logger.error("Storing upload %s failed: %s", file_id, e)
+            (File.query.filter(File.id == file_id, File.status == PROCESSING)
+             .update({File.status: FAILED}, synchronize_session=False))
+            changes.mark_files(db_session, [file])
+            db_session.commit()
+            return
+        updated = (File.query.filter(File.id == file_id)
+                   .update({File.file_path: stored.path,
+                            File.sha256: stored.sha256,
+                            File.size: stored.size,
+                            File.status: STORED}, synchronize_session=False))
+        changes.mark_files(db_session, [file])
+        db_session.commit()
+        if not updated:
+            # The row was deleted with its project while we were storing it.
+            remove_unreferenced([stored.path])
+            return
+        for hook in stored_hooks:
+            hook(stored.path, stored.sha256, file_type)
+    finally:
+        db_session.remove()
+
+
+def queue_uploads(store, file_ids):
+    for file_id in file_ids:
+        tasks.submit(process_upload, store, file_id)
+
+
+def resume_pending_uploads(store, claim_timeout=timedelta(hours=1)):
+    """Re-queue uploads left pending, and reclaim those whose worker died while processing them.
+
+    Every worker runs this when it starts, while other workers may be busy
+    with uploads: a ``processing`` row is only taken back once its claim is
+    older than ``claim_timeout``. Queuing a ``pending`` row twice is harmless,
+    since :func:`process_upload` claims it atomically.
+    """
+    abandoned = and_(File.status == PROCESSING,
+                     or_(File.claimed_at.is_(None), File.claimed_at < datetime.utcnow() - claim_timeout))
+    try:
+        file_ids = [file_id for (file_id,) in
+                    db_session.query(File.id).filter(or_(File.status == PENDING, abandoned))]
+        if file_ids:
+            File.query.filter(File.id.in_(file_ids), abandoned).update({File.status: PENDING},
+                                                                       synchronize_session=False)
+            db_session.commit()
+    finally:
+        db_session.remove()
+    queue_uploads(store, file_ids)
+    return len(file_ids)